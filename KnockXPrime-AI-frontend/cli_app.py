@@ -8,6 +8,7 @@ import httpx
 import json
 import os
 import sys
+import uuid
 from datetime import datetime
 from typing import Optional, Dict, Any
 
@@ -26,6 +27,10 @@ import click
 # Initialize Rich console
 console = Console()
 
+# Session turns are resent on timeouts and these statuses, with the same Idempotency-Key
+SEND_ATTEMPTS = 3
+RETRY_STATUSES = {502, 503, 504}
+
 class KnockXPrimeClient:
     def __init__(self, base_url: str = "http://localhost:8000"):
         self.base_url = base_url
@@ -138,6 +143,46 @@ class KnockXPrimeClient:
             )
             return {"status_code": response.status_code, "data": response.json()}
     
+    async def create_session(self, messages: list, max_tokens: int = 1000) -> Dict[str, Any]:
+        """Start a server-side conversation, optionally seeded with earlier messages"""
+        if not self.api_key:
+            return {"status_code": 401, "data": {"detail": "Not authenticated"}}
+        
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                f"{self.base_url}/api/v1/sessions/",
+                headers=headers,
+                json={"messages": messages, "max_tokens": max_tokens, "temperature": 0.7}
+            )
+            return {"status_code": response.status_code, "data": response.json()}
+    
+    async def send_session_message(self, session_id: str, content: str) -> Dict[str, Any]:
+        """Send only the new message; the server keeps the history"""
+        if not self.api_key:
+            return {"status_code": 401, "data": {"detail": "Not authenticated"}}
+        
+        # One key for every attempt: a retry gets the first reply instead of adding the turn twice
+        headers = {"Authorization": f"Bearer {self.api_key}", "Idempotency-Key": str(uuid.uuid4())}
+        async with httpx.AsyncClient() as client:
+            for attempt in range(SEND_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(attempt)
+                try:
+                    response = await client.post(
+                        f"{self.base_url}/api/v1/sessions/{session_id}/messages",
+                        headers=headers,
+                        json={"content": content},
+                        timeout=60.0
+                    )
+                except httpx.TransportError:
+                    # Timed out or dropped: the turn may be running, so send it again with the same key
+                    if attempt == SEND_ATTEMPTS - 1:
+                        raise
+                    continue
+                if response.status_code not in RETRY_STATUSES or attempt == SEND_ATTEMPTS - 1:
+                    return {"status_code": response.status_code, "data": response.json()}
+    
     async def get_usage(self) -> Dict[str, Any]:
         """Get usage statistics"""
         if not self.api_key:
@@ -156,6 +201,7 @@ class KnockXPrimeCLI:
     def __init__(self):
         self.client = KnockXPrimeClient()
         self.conversation_history = []
+        self.session_id = None
     
     def display_banner(self):
         """Display the application banner"""
@@ -439,6 +485,7 @@ class KnockXPrimeCLI:
                 
                 if user_input.lower() == 'clear':
                     self.conversation_history = []
+                    self.session_id = None
                     console.print("🧹 [yellow]Conversation history cleared[/yellow]")
                     continue
                 
@@ -454,7 +501,7 @@ class KnockXPrimeCLI:
                 ) as progress:
                     task = progress.add_task("🤖 AI is thinking...", total=None)
                     
-                    result = await self.client.chat_completion(self.conversation_history)
+                    result = await self.send_message(user_input)
                 
                 if result["status_code"] == 200:
                     response_data = result["data"]
@@ -508,10 +555,26 @@ class KnockXPrimeCLI:
             except Exception as e:
                 console.print(f"❌ [red]Error: {str(e)}[/red]")
     
+    async def send_message(self, content: str) -> Dict[str, Any]:
+        """Send one turn through a server-side session, starting one when needed"""
+        for _ in range(2):
+            if self.session_id is None:
+                # Seed a new session with what was said before (e.g. if the old one expired)
+                created = await self.client.create_session(self.conversation_history[:-1])
+                if created["status_code"] != 201:
+                    return created
+                self.session_id = created["data"]["id"]
+            result = await self.client.send_session_message(self.session_id, content)
+            if result["status_code"] != 404:
+                return result
+            self.session_id = None
+        return result
+    
     def logout(self):
         """Logout user"""
         self.client.clear_session()
         self.conversation_history = []
+        self.session_id = None
         console.print("👋 [yellow]Logged out successfully[/yellow]")
     
     async def run(self):
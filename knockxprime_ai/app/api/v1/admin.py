@@ -1,8 +1,18 @@
 from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi.responses import PlainTextResponse
 from typing import List, Optional
 from datetime import date, datetime, timedelta
 from app.core.auth import get_current_user
-from app.core.database import db
+from app.core.database import db, query_budget
+from app.core.config import settings
+from app.core import metrics
+from app.core.tracing import tracer, otlp_payload
+from app.core.loop_monitor import loop_monitor
+from app.core.profiler import profiler
+from app.core.usage_cache import usage_cache
+from app.core.admission import grok_admission
+from app.core.json_response import FastJSONResponse
+from app.services.grok_service import grok_service
 
 router = APIRouter()
 
@@ -27,6 +37,7 @@ async def verify_admin_user(current_user: dict = Depends(get_current_user)):
 
 
 @router.get("/stats/overview")
+@query_budget(9)
 async def admin_overview(admin_user: dict = Depends(verify_admin_user)):
     """Get admin dashboard overview"""
     
@@ -89,6 +100,7 @@ async def admin_overview(admin_user: dict = Depends(verify_admin_user)):
 
 
 @router.get("/users")
+@query_budget(3)
 async def list_users(
     limit: int = 50,
     offset: int = 0,
@@ -114,17 +126,19 @@ async def list_users(
     
     users = await db.fetch(query, *params)
     
-    return {
+    # Rows carry UUID, datetime and Decimal values, which FastJSONResponse encodes natively
+    return FastJSONResponse({
         "users": [dict(user) for user in users],
         "pagination": {
             "limit": limit,
             "offset": offset,
             "has_more": len(users) == limit
         }
-    }
+    })
 
 
 @router.get("/usage/top-users")
+@query_budget(3)
 async def top_users_by_usage(
     limit: int = 10,
     admin_user: dict = Depends(verify_admin_user)
@@ -145,13 +159,14 @@ async def top_users_by_usage(
         LIMIT $2
     """, current_month, limit)
     
-    return {
+    return FastJSONResponse({
         "top_users": [dict(user) for user in top_users],
         "month": current_month.isoformat()
-    }
+    })
 
 
 @router.post("/users/{user_id}/reset-usage")
+@query_budget(4)
 async def reset_user_usage(
     user_id: str,
     admin_user: dict = Depends(verify_admin_user)
@@ -173,7 +188,8 @@ async def reset_user_usage(
         UPDATE usage 
         SET tokens_used = 0, requests = 0, updated_at = NOW()
         WHERE user_id = $1 AND month = $2
-    """, user_id, current_month)
+    """, user_id, current_month, idempotent=True)
+    usage_cache.invalidate(user_id)
     
     return {
         "message": f"Usage reset for user {user['username']}",
@@ -183,6 +199,7 @@ async def reset_user_usage(
 
 
 @router.get("/system/health")
+@query_budget(3)
 async def system_health(admin_user: dict = Depends(verify_admin_user)):
     """Get detailed system health information"""
     
@@ -200,10 +217,96 @@ async def system_health(admin_user: dict = Depends(verify_admin_user)):
         },
         "api": {
             "status": "healthy",
-            "uptime": "N/A"  # You could track this
+            "uptime": f"{int(metrics.uptime_seconds())}s",
+            "requests_in_flight": metrics.http_requests_in_flight.value(),
+            "event_loop_lag_seconds": round(metrics.event_loop_lag_current.value(), 4),
+            "event_loop_stalls": loop_monitor.stall_count
         },
         "external_services": {
-            "grok_api": "unknown"  # You could ping Grok API
+            "grok_api": grok_service.health_status(),
+            "grok_admission": grok_admission.stats(),
+            "grok_upstreams": grok_service.pool.stats()
         },
         "timestamp": datetime.utcnow().isoformat()
-    }
\ No newline at end of file
+    }
+
+
+@router.get("/system/traces")
+@query_budget(2)
+async def recent_traces(
+    limit: int = 20,
+    min_duration_ms: float = 0.0,
+    admin_user: dict = Depends(verify_admin_user)
+):
+    """List recently sampled request traces, slowest filter optional"""
+    
+    traces = tracer.ring_buffer.recent(limit, min_duration_ms)
+    
+    return {
+        "sample_rate": tracer.sampler.rate,
+        "traces": [
+            {
+                "trace_id": trace["trace_id"],
+                "name": trace["name"],
+                "duration_ms": trace["duration_ms"],
+                "span_count": trace["span_count"]
+            }
+            for trace in traces
+        ]
+    }
+
+
+@router.get("/system/traces/{trace_id}")
+@query_budget(2)
+async def get_trace(trace_id: str, admin_user: dict = Depends(verify_admin_user)):
+    """Get one trace as an OTLP/JSON export payload"""
+    
+    trace = tracer.ring_buffer.find(trace_id)
+    if not trace:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Trace not found or no longer buffered"
+        )
+    
+    return otlp_payload(trace["spans"])
+
+
+@router.get("/system/stalls")
+@query_budget(2)
+async def recent_stalls(limit: int = 20, admin_user: dict = Depends(verify_admin_user)):
+    """Recent event loop stalls with the blocking stack and request"""
+    
+    return {
+        "threshold_ms": settings.loop_stall_threshold_ms,
+        "total_stalls": loop_monitor.stall_count,
+        "stalls": loop_monitor.recent(limit)
+    }
+
+
+@router.get("/system/profiles")
+@query_budget(2)
+async def recent_profiles(limit: int = 20, admin_user: dict = Depends(verify_admin_user)):
+    """Recently captured request profiles, newest first"""
+    
+    return {
+        "enabled": settings.profiler_enabled,
+        "interval_ms": settings.profiler_interval_ms,
+        "slow_threshold_ms": settings.profiler_slow_threshold_ms,
+        "sample_every": settings.profiler_sample_every,
+        "profiles": profiler.recent(limit)
+    }
+
+
+@router.get("/system/profiles/{request_id}", response_class=PlainTextResponse)
+@query_budget(2)
+async def get_profile(request_id: str, admin_user: dict = Depends(verify_admin_user)):
+    """Get one request profile as collapsed stacks for flamegraph.pl or speedscope"""
+    
+    profile = profiler.find(request_id)
+    if not profile:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Profile not found or no longer retained"
+        )
+    
+    return PlainTextResponse(profile.collapsed())
@@ -1,67 +1,156 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+import asyncio
+from fastapi import APIRouter, HTTPException, status, Depends, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import Optional, Union
 from app.core.auth import get_current_user
-from app.schemas.chat_schema import ChatRequest, ChatResponse, UsageInfo
-from app.services.grok_service import grok_service
+from app.schemas.chat_schema import ChatRequest, ChatBatchRequest, ChatResponse, UsageInfo
+from app.services.chat_completion import run_chat_completion
 from app.services.billing_guard import billing_guard
+from app.services.chat_batch import ChatBatchRun
 from app.core.daily_usage import daily_usage_service
+from app.core.database import query_budget
+from app.core.json_response import FastJSONResponse
+from app.core.config import settings
+from app.core.inflight import user_inflight
+from app.core.loop_monitor import request_id_var
+from app.core import idempotency
+from app.core.idempotency import idempotency_store, StoredResponse
+from app.services.upstream_pool import upstream_pool
+from app.services.chat_passthrough import (
+    RawChatRequest, parse_chat_request, splice_field, request_schema
+)
 
 router = APIRouter()
 
 
-@router.post("/completions", response_model=dict)
+async def read_chat_request(http_request: Request) -> Union[ChatRequest, RawChatRequest]:
+    """Parse the body fully, or in pass-through mode only as far as billing needs"""
+    body = await http_request.body()
+    if settings.chat_passthrough:
+        return RawChatRequest(body)
+    return parse_chat_request(body)
+
+
+@router.post(
+    "/completions",
+    response_class=FastJSONResponse,
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": request_schema()}}}}
+)
+@query_budget(6)
 async def chat_completion(
-    request: ChatRequest,
-    current_user: dict = Depends(get_current_user)
+    http_request: Request,
+    current_user: dict = Depends(get_current_user),
+    request: Union[ChatRequest, RawChatRequest] = Depends(read_chat_request),
+    idempotency_key: Optional[str] = Header(None)
 ):
     """Handle chat completion requests with billing enforcement"""
     
+    if idempotency_key is None:
+        return await complete_chat(current_user, request, request_id_var.get())
+    
+    # Retries with the same key attach to the first call or replay its response
+    idempotency.check_key(idempotency_key)
+    request_fingerprint = idempotency.fingerprint(b"completions", await http_request.body())
+    op_id = idempotency.op_id(current_user['id'], idempotency_key)
+    return await idempotency_store.call(
+        current_user['id'], idempotency_key, request_fingerprint,
+        lambda: complete_chat(current_user, request, op_id)
+    )
+
+
+async def complete_chat(current_user: dict, request: Union[ChatRequest, RawChatRequest],
+                        op_id: Optional[str]) -> Response:
+    """One chat completion, billed once under op_id"""
+    grok_result, usage_info = await run_chat_completion(current_user, request, op_id)
+    
+    # Add usage info to response
+    if isinstance(request, RawChatRequest):
+        return Response(splice_field(grok_result, "usage_info", usage_info), media_type="application/json")
+    grok_result['usage_info'] = usage_info
+    
+    # Upstream JSON plus plain ints and strings: no need for the generic encoder
+    return FastJSONResponse(grok_result)
+
+
+@router.post("/batch", response_class=StreamingResponse)
+@query_budget(8)
+async def chat_batch(
+    batch: ChatBatchRequest,
+    http_request: Request,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Run many chat completions at once, streaming NDJSON results as they finish"""
+    
+    if len(batch.requests) > settings.chat_batch_max_items:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"A batch may contain at most {settings.chat_batch_max_items} requests"
+        )
+    
+    op_id = request_id_var.get()
+    pending = None
+    if idempotency_key is not None:
+        # A retry streams the same batch from its first line instead of running it again
+        idempotency.check_key(idempotency_key)
+        request_fingerprint = idempotency.fingerprint(b"batch", await http_request.body())
+        stored, running = idempotency_store.lookup(current_user['id'], idempotency_key, request_fingerprint)
+        if stored is not None:
+            return stored.response(replayed=True)
+        if running is not None:
+            run = await asyncio.shield(running)
+            return StreamingResponse(
+                run.stream(), media_type="application/x-ndjson", headers={idempotency.REPLAYED_HEADER: "true"}
+            )
+        op_id = idempotency.op_id(current_user['id'], idempotency_key)
+        pending = asyncio.get_running_loop().create_future()
+        pending.add_done_callback(lambda future: future.cancelled() or future.exception())
+        idempotency_store.begin(current_user['id'], idempotency_key, request_fingerprint, pending)
+    
     try:
-        # Validate request against user's plan limits (daily)
-        validation_result = await billing_guard.validate_request(current_user, request)
-        
-        # Make request to Grok API
-        grok_response = await grok_service.chat_completion(request)
-        
-        # Extract actual token usage
-        actual_tokens = billing_guard.extract_token_usage(grok_response)
-        
-        # Log usage (use actual tokens if available, otherwise use estimate)
-        tokens_to_log = actual_tokens if actual_tokens > 0 else validation_result['estimated_tokens']
-        await billing_guard.log_usage(current_user['id'], tokens_to_log)
+        upstream_pool.check()
         
-        # Add usage info to response
-        daily_usage = await daily_usage_service.get_daily_usage(current_user['id'])
-        grok_response['usage_info'] = {
-            "tokens_used_today": daily_usage['tokens_used'],
-            "tokens_remaining_today": max(0, daily_usage['max_tokens'] - daily_usage['tokens_used']),
-            "requests_made_today": daily_usage['requests'],
-            "requests_remaining_today": max(0, daily_usage['max_requests'] - daily_usage['requests']),
-            "plan_name": daily_usage['plan_name'],
-            "max_tokens_daily": daily_usage['max_tokens'],
-            "max_requests_daily": daily_usage['max_requests']
-        }
-        
-        return grok_response
-        
-    except HTTPException:
+        # The slot is released by the batch task once it has settled
+        slot = await user_inflight.acquire(current_user)
+        try:
+            reservation = await billing_guard.reserve_batch(current_user, batch.requests, op_id)
+        except BaseException:
+            user_inflight.release(slot)
+            raise
+    except BaseException as e:
+        if pending is not None:
+            idempotency_store.finish(current_user['id'], idempotency_key, None)
+            if isinstance(e, Exception):
+                pending.set_exception(e)
+            else:
+                pending.cancel()
         raise
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error processing chat request: {str(e)}"
-        )
+    
+    def on_finish():
+        user_inflight.release(slot)
+        if pending is not None:
+            idempotency_store.finish(current_user['id'], idempotency_key, StoredResponse(
+                b"".join(run.lines), media_type="application/x-ndjson"
+            ))
+    
+    concurrency = min(batch.max_concurrency or settings.chat_batch_max_concurrency, settings.chat_batch_max_concurrency)
+    run = ChatBatchRun(
+        current_user, batch.requests, reservation, concurrency, on_finish,
+        op_id=op_id, cancel_on_disconnect=pending is None
+    ).start()
+    if pending is not None:
+        pending.set_result(run)
+    return StreamingResponse(run.stream(), media_type="application/x-ndjson")
 
 
 @router.get("/usage")
+@query_budget(4)
 async def get_chat_usage(current_user: dict = Depends(get_current_user)):
     """Get current usage information"""
     
-    daily_usage = await daily_usage_service.get_daily_usage(current_user['id'])
-    if not daily_usage:
-        await daily_usage_service.create_daily_usage_record(current_user['id'])
-        daily_usage = await daily_usage_service.get_daily_usage(current_user['id'])
+    daily_usage = await daily_usage_service.get_usage_snapshot(current_user['id'])
     
-    return {
+    return FastJSONResponse({
         "tokens_used": daily_usage['tokens_used'],
         "tokens_remaining": max(0, daily_usage['max_tokens'] - daily_usage['tokens_used']),
         "requests_made": daily_usage['requests'],
@@ -70,4 +159,4 @@ async def get_chat_usage(current_user: dict = Depends(get_current_user)):
         "max_tokens": daily_usage['max_tokens'],
         "max_requests": daily_usage['max_requests'],
         "period": "daily"
-    }
\ No newline at end of file
+    })
\ No newline at end of file
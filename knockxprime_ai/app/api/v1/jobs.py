@@ -0,0 +1,103 @@
+from fastapi import APIRouter, HTTPException, status, Depends, Query
+from app.core.auth import get_current_user
+from app.core.admission import plan_priority
+from app.core.config import settings
+from app.core.database import query_budget
+from app.core.job_store import job_store, FINISHED
+from app.core.json_response import FastJSONResponse
+from app.schemas.chat_schema import ChatJobRequest
+
+router = APIRouter()
+
+
+async def get_own_job(job_id: str, current_user: dict) -> dict:
+    """Load a job, hiding other users' jobs behind a 404"""
+    job = await job_store.get(job_id)
+    if not job or job['user_id'] != str(current_user['id']):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+
+def job_view(job: dict) -> dict:
+    job = dict(job)
+    job.pop('user_id', None)
+    job['completed_items'] = job['succeeded'] + job['failed'] + job['cancelled']
+    return job
+
+
+@router.post("/", status_code=status.HTTP_202_ACCEPTED)
+@query_budget(1)
+async def submit_job(
+    job_request: ChatJobRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Queue chat completions to run in the background; poll the job for progress"""
+
+    if len(job_request.requests) > settings.job_max_items:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"A job may contain at most {settings.job_max_items} requests"
+        )
+
+    job = await job_store.submit(
+        current_user['id'],
+        plan_priority(current_user),
+        [chat_request.model_dump() for chat_request in job_request.requests]
+    )
+    return FastJSONResponse(job_view(job), status_code=status.HTTP_202_ACCEPTED)
+
+
+@router.get("/")
+@query_budget(1)
+async def list_jobs(
+    limit: int = Query(20, ge=1, le=100),
+    current_user: dict = Depends(get_current_user)
+):
+    """List the user's most recent jobs"""
+    jobs = await job_store.list(current_user['id'], limit)
+    return FastJSONResponse({"jobs": [job_view(job) for job in jobs]})
+
+
+@router.get("/{job_id}")
+@query_budget(1)
+async def get_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Get a job's status and progress"""
+    return FastJSONResponse(job_view(await get_own_job(job_id, current_user)))
+
+
+@router.get("/{job_id}/results")
+@query_budget(1)
+async def get_job_results(
+    job_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: dict = Depends(get_current_user)
+):
+    """Page through finished items in index order; next_offset is null once the job is done and read"""
+    job = await get_own_job(job_id, current_user)
+    # Chunks are recorded in index order, so finished items form a prefix
+    results = await job_store.results(job_id, offset, limit)
+
+    if results:
+        next_offset = results[-1]['index'] + 1
+    else:
+        next_offset = offset
+    if len(results) < limit and job['status'] in FINISHED:
+        next_offset = None
+
+    return FastJSONResponse({
+        "job_id": job_id,
+        "status": job['status'],
+        "results": results,
+        "next_offset": next_offset
+    })
+
+
+@router.post("/{job_id}/cancel")
+@query_budget(1)
+async def cancel_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Cancel a job; items already running finish and are billed, the rest are dropped"""
+    job = await get_own_job(job_id, current_user)
+    if job['status'] not in FINISHED:
+        job = await job_store.cancel(job_id)
+    return FastJSONResponse(job_view(job))
@@ -1,21 +1,38 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends, Request, Response
 from typing import List
 from app.core.auth import get_current_user
-from app.core.plans import get_all_plans, get_plan_by_id
-from app.core.database import db
+from app.core.plans import plan_catalog, get_all_plans, get_plan_by_id, get_plan_comparison
+from app.core.database import db, query_budget
+from app.core.config import settings
+from app.core.http_cache import make_etag, conditional
+from app.core.usage_cache import usage_cache
 
 router = APIRouter()
 
+PLANS_CACHE_CONTROL = f"public, max-age={settings.plans_cache_max_age}"
+
+
+async def catalog_etag(*parts: str) -> str:
+    """ETag that changes whenever the plan catalog does"""
+    snapshot = await plan_catalog.get()
+    return make_etag(snapshot.version, *parts)
+
 
 @router.get("/", response_model=List[dict])
-async def list_plans():
+@query_budget(1)
+async def list_plans(request: Request, response: Response):
     """Get all available subscription plans"""
+    etag = await catalog_etag("list")
+    cached = conditional(request, response, etag, PLANS_CACHE_CONTROL)
+    if cached:
+        return cached
     plans = await get_all_plans()
     return plans
 
 
 @router.get("/{plan_id}")
-async def get_plan(plan_id: str):
+@query_budget(1)
+async def get_plan(plan_id: str, request: Request, response: Response):
     """Get specific plan details"""
     plan = await get_plan_by_id(plan_id)
     if not plan:
@@ -23,10 +40,14 @@ async def get_plan(plan_id: str):
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Plan not found"
         )
+    cached = conditional(request, response, await catalog_etag("plan", plan_id), PLANS_CACHE_CONTROL)
+    if cached:
+        return cached
     return plan
 
 
 @router.post("/upgrade")
+@query_budget(2)
 async def upgrade_plan(
     new_plan_id: str,
     current_user: dict = Depends(get_current_user)
@@ -54,6 +75,7 @@ async def upgrade_plan(
         "UPDATE users SET plan_id = $1, updated_at = NOW() WHERE id = $2",
         new_plan_id, current_user['id']
     )
+    usage_cache.invalidate(current_user['id'])
     
     return {
         "message": "Plan upgraded successfully",
@@ -64,31 +86,10 @@ async def upgrade_plan(
 
 
 @router.get("/compare/pricing")
-async def compare_plans():
+@query_budget(1)
+async def compare_plans(request: Request, response: Response):
     """Get plan comparison data"""
-    plans = await get_all_plans()
-    
-    comparison = []
-    for plan in plans:
-        tokens_per_dollar = plan['max_tokens'] / plan['price'] if plan['price'] > 0 else float('inf')
-        comparison.append({
-            "name": plan['name'],
-            "price": plan['price'],
-            "max_tokens": plan['max_tokens'],
-            "max_requests": plan['max_requests'],
-            "tokens_per_dollar": round(tokens_per_dollar, 2) if tokens_per_dollar != float('inf') else "Unlimited",
-            "features": {
-                "api_access": True,
-                "usage_analytics": True,
-                "email_support": plan['price'] > 0,
-                "priority_support": plan['price'] >= 10.00,
-                "daily_limits": True
-            }
-        })
-    
-    return {
-        "plans": comparison,
-        "currency": "USD",
-        "billing_cycle": "monthly",
-        "limits": "daily"
-    }
\ No newline at end of file
+    cached = conditional(request, response, await catalog_etag("compare"), PLANS_CACHE_CONTROL)
+    if cached:
+        return cached
+    return await get_plan_comparison()
@@ -0,0 +1,139 @@
+import uuid
+from typing import Optional
+from fastapi import APIRouter, HTTPException, status, Depends, Header, Request, Response
+from app.core.auth import get_current_user
+from app.core import idempotency
+from app.core.idempotency import idempotency_store
+from app.core.daily_usage import new_op_id
+from app.core.database import query_budget
+from app.core.json_response import FastJSONResponse
+from app.core.loop_monitor import request_id_var
+from app.core.session_store import Conversation, session_store
+from app.schemas.chat_schema import ChatSessionCreate, ChatSessionMessage
+from app.services.chat_completion import run_chat_completion
+
+router = APIRouter()
+
+
+async def get_own_session(session_id: str, current_user: dict) -> Conversation:
+    """Load a session, hiding other users' sessions behind a 404"""
+    try:
+        uuid.UUID(session_id)
+    except ValueError:
+        conversation = None
+    else:
+        conversation = await session_store.get(current_user['id'], session_id)
+    if conversation is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
+    return conversation
+
+
+@router.post("/", status_code=status.HTTP_201_CREATED)
+@query_budget(2)
+async def create_session(
+    session: ChatSessionCreate,
+    current_user: dict = Depends(get_current_user)
+):
+    """Start a conversation; later turns send only the new message"""
+    conversation = await session_store.create(
+        current_user['id'], session.model, session.system, session.max_tokens, session.temperature,
+        [(message.role, message.content) for message in session.messages]
+    )
+    return FastJSONResponse(conversation.view(), status_code=status.HTTP_201_CREATED)
+
+
+@router.get("/{session_id}")
+@query_budget(3)
+async def get_session(session_id: str, current_user: dict = Depends(get_current_user)):
+    """Get a session with its full history"""
+    conversation = await get_own_session(session_id, current_user)
+    return FastJSONResponse(conversation.view(include_messages=True))
+
+
+@router.delete("/{session_id}")
+@query_budget(2)
+async def delete_session(session_id: str, current_user: dict = Depends(get_current_user)):
+    """Delete a session and its history"""
+    try:
+        uuid.UUID(session_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
+    try:
+        deleted = await session_store.delete(current_user['id'], session_id)
+    except Exception as e:
+        # The delete may or may not have happened; a retry answers 404 if it did
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error deleting session: {str(e)}"
+        )
+    if not deleted:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
+    return FastJSONResponse({"message": "Session deleted"})
+
+
+@router.post("/{session_id}/messages", response_class=FastJSONResponse)
+@query_budget(10)
+async def send_message(
+    session_id: str,
+    message: ChatSessionMessage,
+    http_request: Request,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Send the next user message; the server adds the history and stores both sides of the turn"""
+    conversation = await get_own_session(session_id, current_user)
+    if idempotency_key is None:
+        return await run_turn(current_user, conversation, message, request_id_var.get() or new_op_id())
+
+    # A retried turn attaches to the first one or replays it instead of being added twice
+    idempotency.check_key(idempotency_key)
+    request_fingerprint = idempotency.fingerprint(b"session:" + session_id.encode(), await http_request.body())
+    op_id = idempotency.op_id(current_user['id'], idempotency_key)
+    return await idempotency_store.call(
+        current_user['id'], idempotency_key, request_fingerprint,
+        lambda: run_turn(current_user, conversation, message, op_id)
+    )
+
+
+def reply_content(grok_response: dict) -> str:
+    """The assistant's reply to store; 500 when the response has none"""
+    choices = grok_response.get('choices')
+    choice = choices[0] if isinstance(choices, list) and choices else None
+    message = choice.get('message') if isinstance(choice, dict) else None
+    content = message.get('content') if isinstance(message, dict) else None
+    if not isinstance(message, dict) or not isinstance(content, (str, type(None))):
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Error processing chat request: Upstream response has no reply to store"
+        )
+    return content or ""
+
+
+async def run_turn(current_user: dict, conversation: Conversation, message: ChatSessionMessage,
+                   op_id: str) -> Response:
+    """One turn: the completion is billed and the turn appended under op_id"""
+    # Turns of one session run one at a time, so each sees the reply before it
+    async with session_store.lock(conversation.id):
+        # Loaded before the wait, so possibly without the turn that held the lock
+        conversation = await get_own_session(conversation.id, current_user)
+        request = conversation.chat_request(message.content, message.max_tokens, message.temperature)
+        grok_response, usage_info = await run_chat_completion(current_user, request, op_id)
+
+        reply = reply_content(grok_response)
+        try:
+            saved = await session_store.append(
+                conversation, [("user", message.content), ("assistant", reply)], op_id
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error saving the turn to the session: {str(e)}"
+            )
+        if not saved:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
+
+        grok_response['usage_info'] = usage_info
+        grok_response['session'] = {"id": conversation.id, "message_count": len(conversation.messages)}
+        return FastJSONResponse(grok_response)
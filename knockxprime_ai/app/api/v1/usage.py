@@ -2,26 +2,25 @@ from fastapi import APIRouter, Depends
 from typing import List
 from datetime import date, datetime, timedelta
 from app.core.auth import get_current_user
-from app.core.database import db
+from app.core.database import db, query_budget
 from app.schemas.usage_schema import UsageStats, MonthlyUsage
 from app.core.daily_usage import daily_usage_service
+from app.core.json_response import FastJSONResponse
 
 router = APIRouter()
 
 
 @router.get("/current")
+@query_budget(4)
 async def get_current_usage(current_user: dict = Depends(get_current_user)):
     """Get current day usage statistics"""
-    usage = await daily_usage_service.get_daily_usage(current_user['id'])
-    if not usage:
-        await daily_usage_service.create_daily_usage_record(current_user['id'])
-        usage = await daily_usage_service.get_daily_usage(current_user['id'])
+    usage = await daily_usage_service.get_usage_snapshot(current_user['id'])
     
     tokens_remaining = max(0, usage['max_tokens'] - usage['tokens_used'])
     requests_remaining = max(0, usage['max_requests'] - usage['requests'])
     usage_percentage = (usage['tokens_used'] / usage['max_tokens']) * 100
     
-    return {
+    return FastJSONResponse({
         "user_id": current_user['id'],
         "tokens_used": usage['tokens_used'],
         "requests": usage['requests'],
@@ -32,16 +31,18 @@ async def get_current_usage(current_user: dict = Depends(get_current_user)):
         "tokens_remaining": tokens_remaining,
         "requests_remaining": requests_remaining,
         "usage_percentage": round(usage_percentage, 2)
-    }
+    })
 
 
 @router.get("/daily")
+@query_budget(4)
 async def get_daily_usage(current_user: dict = Depends(get_current_user)):
     """Get today's usage statistics"""
     return await get_current_usage(current_user)
 
 
 @router.get("/monthly")
+@query_budget(2)
 async def get_monthly_usage(current_user: dict = Depends(get_current_user)):
     """Get current month usage statistics"""
     current_month = date.today().replace(day=1)
@@ -75,6 +76,7 @@ async def get_monthly_usage(current_user: dict = Depends(get_current_user)):
 
 
 @router.get("/history", response_model=List[MonthlyUsage])
+@query_budget(2)
 async def get_usage_history(
     months: int = 6,
     current_user: dict = Depends(get_current_user)
@@ -107,31 +109,25 @@ async def get_usage_history(
 
 
 @router.get("/stats")
+@query_budget(5)
 async def get_usage_analytics(current_user: dict = Depends(get_current_user)):
     """Get detailed usage analytics"""
     
     # Get today's usage
-    today_usage = await daily_usage_service.get_daily_usage(current_user['id'])
-    if not today_usage:
-        await daily_usage_service.create_daily_usage_record(current_user['id'])
-        today_usage = await daily_usage_service.get_daily_usage(current_user['id'])
+    today_usage = await daily_usage_service.get_usage_snapshot(current_user['id'])
     
     # Get yesterday's usage for comparison
     yesterday = date.today() - timedelta(days=1)
-    yesterday_usage = await db.fetchrow("""
-        SELECT tokens_used, requests
-        FROM usage
-        WHERE user_id = $1 AND day = $2
-    """, current_user['id'], yesterday)
+    yesterday_usage = await daily_usage_service.get_day_totals(current_user['id'], yesterday)
     
     # Calculate trends
-    yesterday_tokens = yesterday_usage['tokens_used'] if yesterday_usage else 0
-    yesterday_requests = yesterday_usage['requests'] if yesterday_usage else 0
+    yesterday_tokens = yesterday_usage['tokens_used']
+    yesterday_requests = yesterday_usage['requests']
     
     token_trend = today_usage['tokens_used'] - yesterday_tokens
     request_trend = today_usage['requests'] - yesterday_requests
     
-    return {
+    return FastJSONResponse({
         "today": {
             "tokens_used": today_usage['tokens_used'],
             "requests": today_usage['requests'],
@@ -152,4 +148,4 @@ async def get_usage_analytics(current_user: dict = Depends(get_current_user)):
             "max_requests": today_usage['max_requests'],
             "price": current_user.get('price', 0)
         }
-    }
\ No newline at end of file
+    })
\ No newline at end of file
@@ -1,15 +1,17 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends, Request
 from datetime import timedelta
 from app.core.auth import hash_password, verify_password, generate_api_key, create_access_token, get_current_user
-from app.core.database import db
+from app.core.database import db, query_budget
 from app.core.plans import get_plan_by_name, get_default_plan
 from app.schemas.user_schema import UserRegister, UserLogin, UserResponse, TokenResponse, UserProfile
 from app.core.config import settings
+from app.core.http_cache import conditional_model
 
 router = APIRouter()
 
 
 @router.post("/register", response_model=UserResponse)
+@query_budget(3)
 async def register_user(user_data: UserRegister):
     """Register a new user"""
     
@@ -34,25 +36,18 @@ async def register_user(user_data: UserRegister):
     hashed_password = hash_password(user_data.password)
     api_key = generate_api_key()
     
-    # Create user
-    user_id = await db.fetchval("""
+    # Create user; plan details come from the catalog
+    user = await db.fetchrow("""
         INSERT INTO users (username, email, hashed_pass, api_key, plan_id)
         VALUES ($1, $2, $3, $4, $5)
-        RETURNING id
+        RETURNING id, username, email, created_at
     """, user_data.username, user_data.email, hashed_password, api_key, plan['id'])
     
-    # Get created user with plan info
-    user = await db.fetchrow("""
-        SELECT u.id, u.username, u.email, u.created_at, p.name as plan_name, p.max_tokens
-        FROM users u
-        JOIN plans p ON u.plan_id = p.id
-        WHERE u.id = $1
-    """, user_id)
-    
-    return UserResponse(**dict(user))
+    return UserResponse(**dict(user), plan_name=plan['name'], max_tokens=plan['max_tokens'])
 
 
 @router.post("/login", response_model=TokenResponse)
+@query_budget(1)
 async def login_user(user_data: UserLogin):
     """Login user and return JWT token"""
     
@@ -93,10 +88,11 @@ async def login_user(user_data: UserLogin):
 
 
 @router.get("/profile", response_model=UserProfile)
-async def get_user_profile(current_user: dict = Depends(get_current_user)):
+@query_budget(1)
+async def get_user_profile(request: Request, current_user: dict = Depends(get_current_user)):
     """Get current user profile"""
     
-    return UserProfile(
+    profile = UserProfile(
         id=current_user['id'],
         username=current_user['username'],
         email=current_user['email'],
@@ -107,9 +103,13 @@ async def get_user_profile(current_user: dict = Depends(get_current_user)):
         created_at=current_user['created_at'],
         updated_at=current_user['updated_at']
     )
+    
+    # Per-user and contains the API key: browsers may keep it, shared caches may not
+    return conditional_model(request, profile, "private, no-cache", vary="Authorization")
 
 
 @router.post("/regenerate-api-key")
+@query_budget(2)
 async def regenerate_api_key(current_user: dict = Depends(get_current_user)):
     """Regenerate user's API key"""
     
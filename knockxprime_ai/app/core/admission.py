@@ -0,0 +1,293 @@
+"""
+Admission control for upstream (Grok) calls
+
+Each worker admits at most max_concurrency upstream calls at once, and all
+workers together at most global_max_concurrency. Callers beyond that wait in
+a priority queue where higher-priced plans are served first. Queueing is
+bounded three ways:
+
+- every waiter has a deadline (queue_timeout);
+- the queue has a maximum length;
+- CoDel-style shedding: once queue delay has stayed above `target` for a
+  full `interval`, new arrivals are turned away with 503 + Retry-After
+  instead of queueing, until a request gets through below target again.
+
+When the queue is full or shedding, an arrival that outranks the
+lowest-priority waiter takes its place and that waiter is shed instead.
+"""
+import asyncio
+import heapq
+import math
+import multiprocessing
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException, status
+
+from app.core import metrics
+from app.core.config import settings
+
+
+def plan_priority(user: Dict[str, Any]) -> float:
+    """Queue priority for a user; lower is served first, so higher-priced plans go ahead"""
+    return -float(user.get('price') or 0)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class GlobalSlots:
+    """Upstream slots shared by all workers
+
+    The table lives in shared memory created at import, so gunicorn workers
+    forked from the preloaded master share it. Each used slot holds the pid
+    of its owner, which lets slots held by a crashed worker be reclaimed.
+    Without a preloading master every process gets its own table.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._pids = multiprocessing.Array("i", size)
+
+    def try_acquire(self) -> Optional[int]:
+        pid = os.getpid()
+        with self._pids.get_lock():
+            for index in range(self.size):
+                if self._pids[index] == 0:
+                    self._pids[index] = pid
+                    return index
+            for index in range(self.size):
+                if not _pid_alive(self._pids[index]):
+                    self._pids[index] = pid
+                    return index
+        return None
+
+    def release(self, index: int):
+        with self._pids.get_lock():
+            if self._pids[index] == os.getpid():
+                self._pids[index] = 0
+
+    def in_use(self) -> int:
+        with self._pids.get_lock():
+            return sum(1 for pid in self._pids if pid)
+
+
+class _Waiter:
+    __slots__ = ("priority", "future", "enqueued_at")
+
+    def __init__(self, priority: float, future: asyncio.Future):
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class _Grant:
+    __slots__ = ("global_slot",)
+
+    def __init__(self, global_slot: Optional[int]):
+        self.global_slot = global_slot
+
+
+class AdmissionController:
+    """Concurrency governor with a plan-priority queue and delay-based shedding"""
+
+    def __init__(self, name: str, max_concurrency: int, global_max_concurrency: int = 0,
+                 max_queue: int = 256, queue_timeout: float = 10.0,
+                 target: float = 0.5, interval: float = 2.0, global_poll_interval: float = 0.01):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.target = target
+        self.interval = interval
+        self.global_poll_interval = global_poll_interval
+        self.global_slots = GlobalSlots(global_max_concurrency) if global_max_concurrency > 0 else None
+
+        self.active = 0
+        self.queued = 0
+        self._queue: List = []
+        self._sequence = 0
+        self._poll_handle: Optional[asyncio.TimerHandle] = None
+        self._service_time = 1.0
+
+        # CoDel state
+        self.dropping = False
+        self._first_above: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    @asynccontextmanager
+    async def slot(self, priority: float = 0.0):
+        """Hold an upstream slot for the duration of the block"""
+        if not self.enabled:
+            yield
+            return
+        grant = await self.acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(grant, time.monotonic() - started)
+
+    async def acquire(self, priority: float) -> _Grant:
+        if not self.queued:
+            grant = self._try_grant()
+            if grant is not None:
+                metrics.upstream_queue_wait.observe(0.0, upstream=self.name)
+                return grant
+
+        self._make_room(priority)
+        waiter = _Waiter(priority, asyncio.get_running_loop().create_future())
+        self._sequence += 1
+        heapq.heappush(self._queue, (priority, self._sequence, waiter))
+        self.queued += 1
+        self._update_gauges()
+        self._dispatch()
+
+        try:
+            return await asyncio.wait_for(waiter.future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._shed("deadline")
+        except asyncio.CancelledError:
+            # Granted just as the caller went away: hand the slot back
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                self.release(waiter.future.result(), None)
+            raise
+        finally:
+            if not waiter.future.done() or waiter.future.cancelled():
+                self._discard(waiter)
+
+    def release(self, grant: _Grant, service_time: Optional[float]):
+        self.active -= 1
+        if grant.global_slot is not None:
+            self.global_slots.release(grant.global_slot)
+        if service_time is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * service_time
+        self._update_gauges()
+        self._dispatch()
+
+    def _try_grant(self) -> Optional[_Grant]:
+        if self.active >= self.max_concurrency:
+            return None
+        global_slot = None
+        if self.global_slots is not None:
+            global_slot = self.global_slots.try_acquire()
+            if global_slot is None:
+                return None
+        self.active += 1
+        self._update_gauges()
+        return _Grant(global_slot)
+
+    def _dispatch(self):
+        """Hand free slots to waiters in priority order"""
+        while self._queue:
+            _, _, waiter = self._queue[0]
+            if waiter.future.done():
+                heapq.heappop(self._queue)
+                continue
+            grant = self._try_grant()
+            if grant is None:
+                # Slots freed by other workers send no wake-up, so poll for them
+                if self.active < self.max_concurrency:
+                    self._schedule_poll()
+                return
+            heapq.heappop(self._queue)
+            self.queued -= 1
+            now = time.monotonic()
+            sojourn = now - waiter.enqueued_at
+            metrics.upstream_queue_wait.observe(sojourn, upstream=self.name)
+            self._observe_delay(sojourn, now)
+            waiter.future.set_result(grant)
+        # An empty queue ends any standing delay
+        self._observe_delay(0.0, time.monotonic())
+        self._update_gauges()
+
+    def _schedule_poll(self):
+        if self._poll_handle is None:
+            def poll():
+                self._poll_handle = None
+                self._dispatch()
+            self._poll_handle = asyncio.get_running_loop().call_later(self.global_poll_interval, poll)
+
+    def _observe_delay(self, sojourn: float, now: float):
+        """CoDel: start shedding once delay has stayed above target for a whole interval"""
+        if sojourn < self.target:
+            self._first_above = None
+            self.dropping = False
+        elif self._first_above is None:
+            self._first_above = now + self.interval
+        elif now >= self._first_above:
+            self.dropping = True
+
+    def _make_room(self, priority: float):
+        """Shed the arrival, or the lowest-priority waiter if the arrival outranks it"""
+        if not self.dropping and self.queued < self.max_queue:
+            return
+        reason = "overload" if self.dropping else "queue_full"
+        live = [entry for entry in self._queue if not entry[2].future.done()]
+        if live:
+            worst = max(live, key=lambda entry: (entry[0], entry[1]))
+            if priority < worst[0]:
+                self._discard(worst[2])
+                worst[2].future.set_exception(self._shed(reason))
+                return
+        raise self._shed(reason)
+
+    def _discard(self, waiter: _Waiter):
+        """Count a waiter out of the queue without a slot; its heap entry is dropped lazily"""
+        self.queued -= 1
+        self._update_gauges()
+
+    def _shed(self, reason: str) -> HTTPException:
+        metrics.upstream_shed.inc(upstream=self.name, reason=reason)
+        # Roughly how long the backlog ahead of a new arrival takes to drain
+        backlog = (self.queued + 1) * self._service_time / max(1, self.max_concurrency)
+        retry_after = max(1, math.ceil(backlog))
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={
+                "error": "Service overloaded",
+                "message": "Too many requests are waiting for the AI service. Please retry shortly.",
+                "reason": reason,
+                "retry_after": retry_after
+            },
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    def _update_gauges(self):
+        metrics.upstream_in_flight.set(self.active, upstream=self.name)
+        metrics.upstream_queue_depth.set(self.queued, upstream=self.name)
+        metrics.upstream_shedding.set(1 if self.dropping else 0, upstream=self.name)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.active,
+            "max_concurrency": self.max_concurrency,
+            "global_in_flight": self.global_slots.in_use() if self.global_slots else None,
+            "global_max_concurrency": self.global_slots.size if self.global_slots else None,
+            "queued": self.queued,
+            "shedding": self.dropping,
+        }
+
+
+# Created at import so a preloading gunicorn master shares the global slots with its workers
+grok_admission = AdmissionController(
+    "grok",
+    max_concurrency=settings.upstream_max_concurrency,
+    global_max_concurrency=settings.upstream_global_max_concurrency,
+    max_queue=settings.upstream_max_queue,
+    queue_timeout=settings.upstream_queue_timeout,
+    target=settings.upstream_queue_target_ms / 1000,
+    interval=settings.upstream_queue_interval_ms / 1000
+)
@@ -5,8 +5,10 @@ from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
 
+from app.core import deadline
 from app.core.config import settings
 from app.core.database import db
+from app.core.tracing import traced, set_attribute
 
 # Try passlib first, fallback to bcrypt
 try:
@@ -59,7 +61,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 async def get_user_by_api_key(api_key: str):
     """Get user by API key"""
     user = await db.fetchrow("""
-        SELECT u.*, p.name as plan_name, p.max_tokens, p.price
+        SELECT u.*, p.name as plan_name, p.max_tokens, p.price, p.max_concurrent
         FROM users u
         JOIN plans p ON u.plan_id = p.id
         WHERE u.api_key = $1
@@ -74,10 +76,25 @@ async def get_user_by_api_key(api_key: str):
     return dict(user)
 
 
+async def get_user_by_id(user_id):
+    """Get user by id with plan details, or None"""
+    user = await db.fetchrow("""
+        SELECT u.*, p.name as plan_name, p.max_tokens, p.price, p.max_concurrent
+        FROM users u
+        JOIN plans p ON u.plan_id = p.id
+        WHERE u.id = $1
+    """, user_id)
+    return dict(user) if user else None
+
+
+@traced("auth.get_current_user")
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get current user from API key"""
     api_key = credentials.credentials
-    return await get_user_by_api_key(api_key)
+    user = await get_user_by_api_key(api_key)
+    set_attribute("user.plan", user.get('plan_name'))
+    deadline.apply_plan(user.get('plan_name'))
+    return user
 
 
 async def verify_jwt_token(token: str):
@@ -0,0 +1,215 @@
+"""
+Circuit breakers for upstream (Grok-compatible) calls, one per upstream
+
+Calls are counted in a rolling window of one-second buckets. Once the window
+holds at least min_calls, the circuit opens when the share of failed calls
+(timeouts, transport errors, 429 and 5xx) reaches failure_rate, or the share
+of calls slower than slow_call_seconds reaches slow_call_rate. While open,
+calls fail at once with 503 + Retry-After. After open_seconds the circuit is
+half-open: up to half_open_calls probes go through, and the circuit closes
+when they all succeed or opens again on the first failure. A call cancelled
+by its request's deadline after slow_call_seconds counts as a slow failure.
+
+State is per worker process; each worker trips on what it observes.
+"""
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List
+
+import httpx
+from fastapi import HTTPException, status
+
+from app.core import deadline, metrics
+from app.core.config import settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def is_failure(error: BaseException) -> bool:
+    """Errors that say the upstream is unhealthy, as opposed to a bad request"""
+    if isinstance(error, httpx.HTTPStatusError):
+        code = error.response.status_code
+        return code == 429 or code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class CircuitBreaker:
+    """Rolling-window breaker with half-open probing"""
+
+    def __init__(self, name: str, window_seconds: int, min_calls: int, failure_rate: float,
+                 slow_call_seconds: float, slow_call_rate: float, open_seconds: float,
+                 half_open_calls: int, enabled: bool = True,
+                 is_failure: Callable[[BaseException], bool] = is_failure, service: str = "The AI service"):
+        self.name = name
+        self.enabled = enabled
+        self.is_failure = is_failure
+        self.service = service
+        self.window_seconds = max(1, int(window_seconds))
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(1, half_open_calls)
+        # Per bucket: [second, calls, failures, slow calls]
+        self._buckets: List[List[int]] = [[0, 0, 0, 0] for _ in range(self.window_seconds)]
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probes = 0
+        self._probe_successes = 0
+        metrics.circuit_state.set(STATE_VALUES[CLOSED], breaker=name)
+
+    def allows(self) -> bool:
+        """Whether a call would be let through now, moving an expired open circuit to half-open"""
+        if not self.enabled:
+            return True
+        if self.state == OPEN and self.retry_after() <= 0:
+            self._transition(HALF_OPEN)
+        return not (self.state == OPEN or (self.state == HALF_OPEN and self._probes >= self.half_open_calls))
+
+    def check(self):
+        """Fail fast with 503 while open; call before spending anything on a request"""
+        if not self.allows():
+            raise self.reject()
+
+    def retry_after(self) -> float:
+        """Seconds until an open circuit lets probes through; 0 when not open"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    @asynccontextmanager
+    async def call(self):
+        """Run one upstream call under the breaker, recording its outcome"""
+        if not self.enabled:
+            yield
+            return
+        self.check()
+        probe = self.state == HALF_OPEN
+        if probe:
+            self._probes += 1
+        started = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            duration = time.monotonic() - started
+            if self.is_failure(e) or self._hung(e, duration):
+                self._record(False, duration, probe)
+            elif probe:
+                # Cancelled or a client error: says nothing about upstream health
+                self._probes -= 1
+            raise
+        else:
+            self._record(True, time.monotonic() - started, probe)
+
+    def _hung(self, error: BaseException, duration: float) -> bool:
+        """A call the request's deadline cut short after it had already run slow
+
+        Shorter cut-off calls say nothing about the upstream (the client may have
+        asked for a tight deadline), so they are not counted.
+        """
+        if not isinstance(error, asyncio.CancelledError) or duration < self.slow_call_seconds:
+            return False
+        left = deadline.remaining()
+        return left is not None and left <= 0
+
+    def _record(self, success: bool, duration: float, probe: bool):
+        slow = duration >= self.slow_call_seconds
+        now = int(time.monotonic())
+        bucket = self._buckets[now % self.window_seconds]
+        if bucket[0] != now:
+            bucket[:] = [now, 0, 0, 0]
+        bucket[1] += 1
+        bucket[2] += 0 if success else 1
+        bucket[3] += 1 if slow else 0
+
+        if self.state == HALF_OPEN and probe:
+            self._probes -= 1
+            if not success or slow:
+                self._open()
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_calls:
+                self._transition(CLOSED)
+        elif self.state == CLOSED:
+            calls, failures, slow_calls = self._window()
+            if calls >= self.min_calls and (
+                failures / calls >= self.failure_rate or slow_calls / calls >= self.slow_call_rate
+            ):
+                self._open()
+
+    def _window(self):
+        oldest = int(time.monotonic()) - self.window_seconds
+        calls = failures = slow_calls = 0
+        for second, bucket_calls, bucket_failures, bucket_slow in self._buckets:
+            if second > oldest:
+                calls += bucket_calls
+                failures += bucket_failures
+                slow_calls += bucket_slow
+        return calls, failures, slow_calls
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self._transition(OPEN)
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        print(f"Circuit {self.name}: {self.state} -> {state}")
+        self.state = state
+        self._probes = 0
+        self._probe_successes = 0
+        if state == CLOSED:
+            # Start the window fresh so the calls that tripped the circuit don't trip it again
+            for bucket in self._buckets:
+                bucket[:] = [0, 0, 0, 0]
+        metrics.circuit_transitions.inc(breaker=self.name, state=state)
+        metrics.circuit_state.set(STATE_VALUES[state], breaker=self.name)
+
+    def reject(self) -> HTTPException:
+        metrics.circuit_rejections.inc(breaker=self.name)
+        retry_after = max(1, math.ceil(self.retry_after()))
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={
+                "error": "Service unavailable",
+                "message": f"{self.service} is failing right now. Please retry shortly.",
+                "reason": "circuit_open",
+                "retry_after": retry_after
+            },
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        calls, failures, slow_calls = self._window()
+        return {
+            "enabled": self.enabled,
+            "state": self.state,
+            "window_calls": calls,
+            "failure_rate": round(failures / calls, 3) if calls else 0.0,
+            "slow_call_rate": round(slow_calls / calls, 3) if calls else 0.0,
+            "retry_after_seconds": round(self.retry_after(), 1),
+            "trips": self.trips,
+        }
+
+
+def upstream_breaker(name: str) -> CircuitBreaker:
+    """Breaker for one upstream, configured by the GROK_BREAKER_* settings"""
+    return CircuitBreaker(
+        name,
+        window_seconds=settings.grok_breaker_window_seconds,
+        min_calls=settings.grok_breaker_min_calls,
+        failure_rate=settings.grok_breaker_failure_rate,
+        slow_call_seconds=settings.grok_breaker_slow_call_ms / 1000,
+        slow_call_rate=settings.grok_breaker_slow_call_rate,
+        open_seconds=settings.grok_breaker_open_seconds,
+        half_open_calls=settings.grok_breaker_half_open_calls,
+        enabled=settings.grok_breaker_enabled
+    )
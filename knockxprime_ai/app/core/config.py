@@ -11,6 +11,96 @@ class Settings(BaseSettings):
     # Grok API
     grok_api_key: str = os.getenv("GROK_API_KEY", "")
     grok_base_url: str = "https://api.x.ai/v1"
+    grok_coalesce_enabled: bool = os.getenv("GROK_COALESCE_ENABLED", "true").lower() == "true"
+    chat_batch_max_items: int = int(os.getenv("CHAT_BATCH_MAX_ITEMS", 100))
+    chat_batch_max_concurrency: int = int(os.getenv("CHAT_BATCH_MAX_CONCURRENCY", 8))
+    
+    # Upstream admission control (0 disables a cap)
+    upstream_max_concurrency: int = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", 32))
+    upstream_global_max_concurrency: int = int(os.getenv("UPSTREAM_GLOBAL_MAX_CONCURRENCY", 64))
+    upstream_max_queue: int = int(os.getenv("UPSTREAM_MAX_QUEUE", 256))
+    upstream_queue_timeout: float = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", 10))
+    upstream_queue_target_ms: float = float(os.getenv("UPSTREAM_QUEUE_TARGET_MS", 500))
+    upstream_queue_interval_ms: float = float(os.getenv("UPSTREAM_QUEUE_INTERVAL_MS", 2000))
+    
+    # Upstream pool (UPSTREAMS) and hedged requests
+    upstream_hedging_enabled: bool = os.getenv("UPSTREAM_HEDGING_ENABLED", "false").lower() == "true"
+    upstream_hedge_min_delay_ms: float = float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY_MS", 100))
+    upstream_hedge_max_ratio: float = float(os.getenv("UPSTREAM_HEDGE_MAX_RATIO", 0.1))
+    
+    @property
+    def upstreams(self) -> List[dict]:
+        """Chat upstreams from UPSTREAMS (JSON list) or the single Grok endpoint"""
+        upstreams_env = os.getenv("UPSTREAMS")
+        if upstreams_env:
+            try:
+                import json
+                upstreams = json.loads(upstreams_env)
+                if isinstance(upstreams, list) and upstreams:
+                    return upstreams
+            except ValueError:
+                pass
+            print("Invalid UPSTREAMS, using GROK_API_KEY")
+        return [{"name": "grok", "base_url": self.grok_base_url, "api_key": self.grok_api_key}]
+    
+    # Grok circuit breaker (per upstream)
+    grok_breaker_enabled: bool = os.getenv("GROK_BREAKER_ENABLED", "true").lower() == "true"
+    grok_breaker_window_seconds: int = int(os.getenv("GROK_BREAKER_WINDOW_SECONDS", 30))
+    grok_breaker_min_calls: int = int(os.getenv("GROK_BREAKER_MIN_CALLS", 20))
+    grok_breaker_failure_rate: float = float(os.getenv("GROK_BREAKER_FAILURE_RATE", 0.5))
+    grok_breaker_slow_call_ms: float = float(os.getenv("GROK_BREAKER_SLOW_CALL_MS", 20000))
+    grok_breaker_slow_call_rate: float = float(os.getenv("GROK_BREAKER_SLOW_CALL_RATE", 0.8))
+    grok_breaker_open_seconds: float = float(os.getenv("GROK_BREAKER_OPEN_SECONDS", 30))
+    grok_breaker_half_open_calls: int = int(os.getenv("GROK_BREAKER_HALF_OPEN_CALLS", 3))
+    
+    # Job queue (SQLite, drained by `python -m app.worker`)
+    job_store_path: str = os.getenv("JOB_STORE_PATH", "data/jobs.sqlite3")
+    job_lease_seconds: float = float(os.getenv("JOB_LEASE_SECONDS", 300))
+    job_max_items: int = int(os.getenv("JOB_MAX_ITEMS", 10000))
+    job_worker_concurrency: int = int(os.getenv("JOB_WORKER_CONCURRENCY", 4))
+    job_poll_interval: float = float(os.getenv("JOB_POLL_INTERVAL", 1))
+    job_worker_in_web: bool = os.getenv("JOB_WORKER_IN_WEB", "false").lower() == "true"
+    job_rate_default: float = float(os.getenv("JOB_RATE_DEFAULT", 30))
+    
+    @property
+    def job_rates(self) -> dict:
+        """Job items per minute by plan name, from JOB_RATE_PER_MINUTE (JSON) or defaults"""
+        rates_env = os.getenv("JOB_RATE_PER_MINUTE")
+        if rates_env:
+            try:
+                import json
+                return {name: float(rate) for name, rate in json.loads(rates_env).items()}
+            except (ValueError, AttributeError):
+                print("Invalid JOB_RATE_PER_MINUTE, using defaults")
+        return {"Baby Free": 6, "Leveler": 30, "Log Min": 60, "High Max": 240}
+    
+    # Request deadlines (seconds); keep them under the gunicorn worker timeout
+    request_timeout_default: float = float(os.getenv("REQUEST_TIMEOUT_DEFAULT", 25))
+    request_timeout_max: float = float(os.getenv("REQUEST_TIMEOUT_MAX", 28))
+    
+    @property
+    def request_timeouts(self) -> dict:
+        """Request deadline in seconds by plan name, from REQUEST_TIMEOUT_PER_PLAN (JSON) or defaults"""
+        timeouts_env = os.getenv("REQUEST_TIMEOUT_PER_PLAN")
+        if timeouts_env:
+            try:
+                import json
+                return {name: float(seconds) for name, seconds in json.loads(timeouts_env).items()}
+            except (ValueError, AttributeError):
+                print("Invalid REQUEST_TIMEOUT_PER_PLAN, using defaults")
+        return {"Baby Free": 15, "Leveler": 20, "Log Min": 25, "High Max": 28}
+    
+    # Speculative execution: paid users whose cached usage stays under this share of each daily
+    # limit have the quota check run alongside the Grok call, and usage written after the response
+    speculative_execution_enabled: bool = os.getenv("SPECULATIVE_EXECUTION_ENABLED", "true").lower() == "true"
+    speculative_max_usage: float = float(os.getenv("SPECULATIVE_MAX_USAGE", 0.5))
+    
+    # Per-user in-flight chat requests (plans.max_concurrent; the default covers plans without one)
+    user_max_concurrent_default: int = int(os.getenv("USER_MAX_CONCURRENT_DEFAULT", 4))
+    user_inflight_wait_ms: float = float(os.getenv("USER_INFLIGHT_WAIT_MS", 250))
+    user_inflight_table_size: int = int(os.getenv("USER_INFLIGHT_TABLE_SIZE", 2048))
+    # Forward chat bodies to Grok as raw bytes instead of re-encoding them
+    chat_passthrough: bool = os.getenv("CHAT_PASSTHROUGH", "false").lower() == "true"
     
     # JWT
     secret_key: str = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
@@ -62,6 +152,76 @@ class Settings(BaseSettings):
     rate_limit_requests: int = int(os.getenv("RATE_LIMIT_REQUESTS", 100))
     rate_limit_window: int = int(os.getenv("RATE_LIMIT_WINDOW", 60))
     
+    # Metrics
+    metrics_enabled: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    metrics_token: str = os.getenv("METRICS_TOKEN", "")
+    metrics_multiproc_dir: str = os.getenv("METRICS_MULTIPROC_DIR", "")
+    metrics_flush_interval: float = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+    
+    # Neon retries and circuit breaker
+    neon_timeout: float = float(os.getenv("NEON_TIMEOUT", 30))
+    neon_retry_max_attempts: int = int(os.getenv("NEON_RETRY_MAX_ATTEMPTS", 3))
+    neon_retry_base_ms: float = float(os.getenv("NEON_RETRY_BASE_MS", 50))
+    neon_retry_max_backoff_ms: float = float(os.getenv("NEON_RETRY_MAX_BACKOFF_MS", 1000))
+    neon_retry_budget_ms: float = float(os.getenv("NEON_RETRY_BUDGET_MS", 15000))
+    neon_breaker_enabled: bool = os.getenv("NEON_BREAKER_ENABLED", "true").lower() == "true"
+    neon_breaker_min_calls: int = int(os.getenv("NEON_BREAKER_MIN_CALLS", 20))
+    neon_breaker_failure_rate: float = float(os.getenv("NEON_BREAKER_FAILURE_RATE", 0.5))
+    neon_breaker_open_seconds: float = float(os.getenv("NEON_BREAKER_OPEN_SECONDS", 10))
+    
+    # Per-request query budgets: "off", "warn" (log) or "strict" (fail the request)
+    db_query_budget_mode: str = os.getenv(
+        "DB_QUERY_BUDGET_MODE", "strict" if os.getenv("ENVIRONMENT") == "test" else "warn"
+    )
+    db_repeated_query_threshold: int = int(os.getenv("DB_REPEATED_QUERY_THRESHOLD", 3))
+    # Share one Neon call among identical concurrent reads (opt-in)
+    db_coalesce_reads: bool = os.getenv("DB_COALESCE_READS", "false").lower() == "true"
+    
+    # Tracing
+    tracing_enabled: bool = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+    trace_sample_rate: float = float(os.getenv("TRACE_SAMPLE_RATE", 0.1))
+    trace_buffer_size: int = int(os.getenv("TRACE_BUFFER_SIZE", 200))
+    trace_export_file: str = os.getenv("TRACE_EXPORT_FILE", "")
+    
+    # Event loop monitoring
+    loop_monitor_enabled: bool = os.getenv("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+    loop_monitor_interval: float = float(os.getenv("LOOP_MONITOR_INTERVAL", 0.1))
+    loop_stall_threshold_ms: float = float(os.getenv("LOOP_STALL_THRESHOLD_MS", 200))
+    loop_stall_history: int = int(os.getenv("LOOP_STALL_HISTORY", 50))
+    
+    # Plan catalog
+    plan_catalog_refresh_interval: float = float(os.getenv("PLAN_CATALOG_REFRESH_INTERVAL", 60))
+    plans_cache_max_age: int = int(os.getenv("PLANS_CACHE_MAX_AGE", 60))
+    
+    # Usage snapshot cache
+    usage_cache_ttl: float = float(os.getenv("USAGE_CACHE_TTL", 5))
+    usage_cache_max_entries: int = int(os.getenv("USAGE_CACHE_MAX_ENTRIES", 10000))
+    
+    # Conversation sessions
+    session_cache_ttl: float = float(os.getenv("SESSION_CACHE_TTL", 300))
+    session_cache_max_entries: int = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", 1000))
+    session_compress_min_bytes: int = int(os.getenv("SESSION_COMPRESS_MIN_BYTES", 256))
+    session_max_context_messages: int = int(os.getenv("SESSION_MAX_CONTEXT_MESSAGES", 100))
+    
+    # Idempotency keys
+    idempotency_ttl: float = float(os.getenv("IDEMPOTENCY_TTL", 3600))
+    idempotency_max_entries: int = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", 10000))
+    idempotency_max_body_bytes: int = int(os.getenv("IDEMPOTENCY_MAX_BODY_BYTES", 1048576))
+    
+    # Response compression
+    compression_enabled: bool = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+    compression_minimum_size: int = int(os.getenv("COMPRESSION_MINIMUM_SIZE", 1024))
+    compression_gzip_level: int = int(os.getenv("COMPRESSION_GZIP_LEVEL", 5))
+    compression_brotli_quality: int = int(os.getenv("COMPRESSION_BROTLI_QUALITY", 4))
+    compression_zstd_level: int = int(os.getenv("COMPRESSION_ZSTD_LEVEL", 3))
+    
+    # Sampling profiler (opt-in)
+    profiler_enabled: bool = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+    profiler_interval_ms: float = float(os.getenv("PROFILER_INTERVAL_MS", 10))
+    profiler_slow_threshold_ms: float = float(os.getenv("PROFILER_SLOW_THRESHOLD_MS", 1000))
+    profiler_sample_every: int = int(os.getenv("PROFILER_SAMPLE_EVERY", 0))
+    profiler_history: int = int(os.getenv("PROFILER_HISTORY", 20))
+    
     class Config:
         env_file = ".env"
 
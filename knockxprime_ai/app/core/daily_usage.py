@@ -2,14 +2,107 @@
 Daily usage tracking and limits for request-based plans
 """
 from datetime import date, datetime
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 import uuid
 from app.core.database import db
+from app.core.tracing import traced
+from app.core.usage_cache import usage_cache
+
+# Usage writes record an operation id in usage_ops in the same statement and
+# apply nothing when the id is already there, so the retry policy may resend
+# them after a timeout without counting usage twice.
+
+APPLY_MONTHLY_USAGE = """
+    WITH op AS (
+        INSERT INTO usage_ops (id) VALUES ($6) ON CONFLICT DO NOTHING RETURNING id
+    )
+    INSERT INTO usage (user_id, tokens_used, requests, month, day)
+    SELECT $1::uuid, $2::integer, $3::integer, $4::date, $5::date FROM op
+    ON CONFLICT (user_id, month) 
+    DO UPDATE SET 
+        tokens_used = usage.tokens_used + EXCLUDED.tokens_used,
+        requests = usage.requests + EXCLUDED.requests,
+        updated_at = NOW()
+"""
+
+# Applies usage to today's row and reads it back with plan limits in one statement.
+# The op is only recorded when the row exists, so the caller can create it and resend.
+APPLY_DAILY_USAGE = """
+    WITH op AS (
+        INSERT INTO usage_ops (id)
+        SELECT $5::text WHERE EXISTS (SELECT 1 FROM usage WHERE user_id = $3 AND day = $4)
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    ),
+    updated AS (
+        UPDATE usage
+        SET tokens_used = tokens_used + $1,
+            requests = requests + $2,
+            updated_at = NOW()
+        WHERE user_id = $3 AND day = $4 AND EXISTS (SELECT 1 FROM op)
+        RETURNING *
+    ),
+    applied AS (
+        SELECT * FROM updated
+        UNION ALL
+        -- Already applied by an earlier attempt: the row as it stands
+        SELECT * FROM usage WHERE user_id = $3 AND day = $4 AND NOT EXISTS (SELECT 1 FROM op)
+    )
+    SELECT applied.*, p.name as plan_name, p.max_tokens, p.max_requests
+    FROM applied
+    JOIN users usr ON applied.user_id = usr.id
+    JOIN plans p ON usr.plan_id = p.id
+"""
+
+# Same, but only when both counters stay within the plan's daily limits
+RESERVE_DAILY_USAGE = """
+    WITH op AS (
+        INSERT INTO usage_ops (id)
+        SELECT $5::text
+        FROM usage
+        JOIN users usr ON usr.id = usage.user_id
+        JOIN plans p ON usr.plan_id = p.id
+        WHERE usage.user_id = $3 AND usage.day = $4
+          AND usage.requests + $2 <= p.max_requests
+          AND usage.tokens_used + $1 <= p.max_tokens
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    ),
+    reserved AS (
+        UPDATE usage
+        SET tokens_used = usage.tokens_used + $1,
+            requests = usage.requests + $2,
+            updated_at = NOW()
+        FROM users usr
+        JOIN plans p ON usr.plan_id = p.id
+        WHERE usage.user_id = $3 AND usage.day = $4 AND usr.id = usage.user_id
+          AND usage.requests + $2 <= p.max_requests
+          AND usage.tokens_used + $1 <= p.max_tokens
+          AND EXISTS (SELECT 1 FROM op)
+        RETURNING usage.*, p.name as plan_name, p.max_tokens, p.max_requests
+    )
+    SELECT * FROM reserved
+    UNION ALL
+    -- Reserved by an earlier attempt: the row as it stands
+    SELECT u.*, p.name as plan_name, p.max_tokens, p.max_requests
+    FROM usage u
+    JOIN users usr ON u.user_id = usr.id
+    JOIN plans p ON usr.plan_id = p.id
+    WHERE u.user_id = $3 AND u.day = $4
+      AND NOT EXISTS (SELECT 1 FROM op)
+      AND EXISTS (SELECT 1 FROM usage_ops WHERE id = $5)
+"""
+
+
+def new_op_id() -> str:
+    """Id for one logical usage write; each statement of it appends its own suffix"""
+    return uuid.uuid4().hex
 
 
 class DailyUsageService:
     
     @staticmethod
+    @traced("daily_usage.get_daily_usage")
     async def get_daily_usage(user_id: str) -> Optional[Dict]:
         """Get current day usage for user"""
         current_day = date.today()
@@ -22,9 +115,39 @@ class DailyUsageService:
             WHERE u.user_id = $1 AND u.day = $2
         """, user_id, current_day)
         
-        return dict(usage) if usage else None
+        if not usage:
+            return None
+        usage = dict(usage)
+        usage_cache.put(user_id, current_day, usage)
+        return usage
+    
+    @staticmethod
+    @traced("daily_usage.get_usage_snapshot")
+    async def get_usage_snapshot(user_id: str) -> Dict:
+        """Current day usage, served from the snapshot cache while fresh"""
+        usage = usage_cache.get(user_id, date.today())
+        if usage is None:
+            usage = await DailyUsageService.get_daily_usage(user_id)
+        if usage is None:
+            usage = await DailyUsageService.create_daily_usage_record(user_id)
+        return usage
     
     @staticmethod
+    async def get_day_totals(user_id: str, day: date) -> Dict:
+        """Tokens and requests for another day, cached like the current snapshot"""
+        totals = usage_cache.get(user_id, day)
+        if totals is None:
+            row = await db.fetchrow("""
+                SELECT tokens_used, requests
+                FROM usage
+                WHERE user_id = $1 AND day = $2
+            """, user_id, day)
+            totals = dict(row) if row else {'tokens_used': 0, 'requests': 0}
+            usage_cache.put(user_id, day, totals)
+        return totals
+    
+    @staticmethod
+    @traced("daily_usage.create_daily_usage_record")
     async def create_daily_usage_record(user_id: str) -> Dict:
         """Create new daily usage record"""
         current_day = date.today()
@@ -34,46 +157,103 @@ class DailyUsageService:
             INSERT INTO usage (user_id, tokens_used, requests, month, day)
             VALUES ($1, 0, 0, $2, $3)
             ON CONFLICT (user_id, day) DO NOTHING
-        """, user_id, current_month, current_day)
+        """, user_id, current_month, current_day, idempotent=True)
         
         return await DailyUsageService.get_daily_usage(user_id)
     
     @staticmethod
-    async def update_daily_usage(user_id: str, tokens_consumed: int, requests_increment: int = 1):
-        """Update daily usage statistics"""
+    @traced("daily_usage.update_daily_usage")
+    async def update_daily_usage(user_id: str, tokens_consumed: int, requests_increment: int = 1,
+                                 op_id: Optional[str] = None) -> Dict:
+        """Update daily usage statistics and return the new daily snapshot"""
         current_day = date.today()
         current_month = current_day.replace(day=1)
+        op_id = op_id or new_op_id()
         
-        # Ensure usage record exists
-        await DailyUsageService.create_daily_usage_record(user_id)
+        # Monthly first, so the daily row read back below reflects both writes
+        await db.execute(
+            APPLY_MONTHLY_USAGE, user_id, tokens_consumed, requests_increment, current_month, current_day,
+            f"{op_id}:m", idempotent=True
+        )
         
-        # Update daily usage
-        await db.execute("""
-            UPDATE usage 
-            SET tokens_used = tokens_used + $1,
-                requests = requests + $2,
-                updated_at = NOW()
-            WHERE user_id = $3 AND day = $4
-        """, tokens_consumed, requests_increment, user_id, current_day)
+        # Update daily usage, creating today's record first if it is missing
+        usage = await db.fetchrow(
+            APPLY_DAILY_USAGE, tokens_consumed, requests_increment, user_id, current_day, f"{op_id}:d",
+            idempotent=True
+        )
+        if not usage:
+            await DailyUsageService.create_daily_usage_record(user_id)
+            usage = await db.fetchrow(
+                APPLY_DAILY_USAGE, tokens_consumed, requests_increment, user_id, current_day, f"{op_id}:d",
+                idempotent=True
+            )
         
-        # Also update monthly usage
-        await db.execute("""
-            INSERT INTO usage (user_id, tokens_used, requests, month, day)
-            VALUES ($1, $2, $3, $4, $5)
-            ON CONFLICT (user_id, month) 
-            DO UPDATE SET 
-                tokens_used = usage.tokens_used + $2,
-                requests = usage.requests + $3,
-                updated_at = NOW()
-        """, user_id, tokens_consumed, requests_increment, current_month, current_day)
+        # Write through so the usage endpoints see this request immediately
+        usage = dict(usage) if usage else {}
+        if usage:
+            usage_cache.put(user_id, current_day, usage)
+        return usage
+    
+    @staticmethod
+    @traced("daily_usage.reserve_daily_usage")
+    async def reserve_daily_usage(user_id: str, tokens: int, requests: int,
+                                  op_id: Optional[str] = None) -> Tuple[bool, Dict]:
+        """Add tokens and requests to today's row only if both stay within the plan
+
+        Returns whether the reservation was made, and today's usage after it
+        (or as it stands, when it was refused).
+        """
+        current_day = date.today()
+        op_id = f"{op_id or new_op_id()}:r"
+        
+        usage = await db.fetchrow(RESERVE_DAILY_USAGE, tokens, requests, user_id, current_day, op_id, idempotent=True)
+        if usage is None:
+            current = await DailyUsageService.get_daily_usage(user_id)
+            if current is not None:
+                return False, current
+            current = await DailyUsageService.create_daily_usage_record(user_id)
+            usage = await db.fetchrow(
+                RESERVE_DAILY_USAGE, tokens, requests, user_id, current_day, op_id, idempotent=True
+            )
+            if usage is None:
+                return False, current
+        
+        usage = dict(usage)
+        usage_cache.put(user_id, current_day, usage)
+        return True, usage
     
     @staticmethod
+    @traced("daily_usage.settle_reservation")
+    async def settle_reservation(user_id: str, reserved_tokens: int, reserved_requests: int,
+                                 tokens_used: int, requests_made: int, op_id: Optional[str] = None) -> Dict:
+        """Replace a reservation on today's row with what was actually used"""
+        current_day = date.today()
+        current_month = current_day.replace(day=1)
+        op_id = op_id or new_op_id()
+        
+        await db.execute(
+            APPLY_MONTHLY_USAGE, user_id, tokens_used, requests_made, current_month, current_day,
+            f"{op_id}:m", idempotent=True
+        )
+        usage = await db.fetchrow(
+            APPLY_DAILY_USAGE, tokens_used - reserved_tokens, requests_made - reserved_requests,
+            user_id, current_day, f"{op_id}:d", idempotent=True
+        )
+        
+        usage = dict(usage) if usage else {}
+        if usage:
+            # Refunds can lower the counters, so replace the snapshot instead of merging
+            usage_cache.invalidate(user_id)
+            usage_cache.put(user_id, current_day, usage)
+        return usage
+    
+    @staticmethod
+    @traced("daily_usage.check_daily_limits")
     async def check_daily_limits(user_id: str, requested_tokens: int) -> tuple[bool, Dict]:
         """Check if user can make request within daily limits"""
         usage = await DailyUsageService.get_daily_usage(user_id)
         if not usage:
-            await DailyUsageService.create_daily_usage_record(user_id)
-            usage = await DailyUsageService.get_daily_usage(user_id)
+            usage = await DailyUsageService.create_daily_usage_record(user_id)
         
         # Check daily request limit
         requests_after = usage['requests'] + 1
@@ -1,10 +1,113 @@
 import httpx
 import json
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
 from typing import Optional, Dict, List, Any
 import uuid
 from datetime import datetime
 from app.core.config import settings
-from app.core.neon_utils import execute_with_retry, NeonAPIError
+from app.core.neon_utils import execute_with_retry, convert_params_for_neon, NeonAPIError
+from app.core.singleflight import SingleFlight
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised in strict mode when an endpoint issues more queries than it declared"""
+
+
+def query_budget(max_queries: int):
+    """Declare how many Neon queries an endpoint may issue per request"""
+    def decorator(endpoint):
+        endpoint.__query_budget__ = max_queries
+        return endpoint
+    return decorator
+
+
+def normalize_statement(query: str) -> str:
+    """Collapse whitespace so the same statement groups together"""
+    return re.sub(r"\s+", " ", query).strip()
+
+
+_READ_STATEMENT = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+_WRITE_KEYWORD = re.compile(
+    r"\b(insert|update|delete|merge|truncate|create|alter|drop|grant|nextval|setval|"
+    r"for\s+(no\s+key\s+)?(update|share)|for\s+key\s+share)\b",
+    re.IGNORECASE
+)
+
+
+def is_read_only(query: str) -> bool:
+    """Conservative check: a SELECT (or CTE) with no data-modifying keyword anywhere"""
+    return bool(_READ_STATEMENT.match(query)) and not _WRITE_KEYWORD.search(query)
+
+
+class QueryTracker:
+    """Neon queries issued while serving one request"""
+    
+    def __init__(self, scope: Optional[Dict[str, Any]] = None):
+        self.scope = scope
+        self.queries = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement: Optional[str] = None
+        self.statements: Counter = Counter()
+        # Database write sequence after this request's latest write; reads must not predate it
+        self.last_write_seq = 0
+    
+    @property
+    def budget(self) -> Optional[int]:
+        """Budget declared on the routed endpoint, once routing has happened"""
+        endpoint = self.scope.get("endpoint") if self.scope else None
+        return getattr(endpoint, "__query_budget__", None)
+    
+    @property
+    def over_budget(self) -> bool:
+        return self.budget is not None and self.queries > self.budget
+    
+    def record(self, query: str, duration: float):
+        statement = normalize_statement(query)
+        self.queries += 1
+        self.total_time += duration
+        self.statements[statement] += 1
+        if duration >= self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_statement = statement
+        
+        if self.over_budget and settings.db_query_budget_mode == "strict":
+            raise QueryBudgetExceeded(
+                f"Query budget of {self.budget} exceeded: query #{self.queries} was {statement[:200]}"
+            )
+    
+    def repeated_statements(self) -> List[Dict[str, Any]]:
+        """Statements issued often enough in one request to suggest an N+1 pattern"""
+        threshold = settings.db_repeated_query_threshold
+        return [
+            {"statement": statement[:120], "count": count}
+            for statement, count in self.statements.most_common()
+            if count >= threshold
+        ]
+    
+    def server_timing(self) -> str:
+        """Server-Timing header value"""
+        entries = [f'db;dur={self.total_time * 1000:.1f};desc="{self.queries} queries"']
+        if self.queries:
+            entries.append(f"db-slowest;dur={self.slowest_time * 1000:.1f}")
+        return ", ".join(entries)
+    
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "db_queries": self.queries,
+            "db_time_ms": round(self.total_time * 1000, 1),
+            "db_slowest_ms": round(self.slowest_time * 1000, 1),
+            "db_slowest_statement": self.slowest_statement[:120] if self.slowest_statement else None,
+            "db_query_budget": self.budget,
+            "db_repeated_statements": self.repeated_statements(),
+        }
+
+
+# Tracker for the request being served; None outside requests (startup, scripts)
+query_tracker: ContextVar[Optional[QueryTracker]] = ContextVar("query_tracker", default=None)
 
 
 class NeonRestDatabase:
@@ -14,23 +117,54 @@ class NeonRestDatabase:
             "Authorization": f"Bearer {settings.neon_api_key}",
             "Content-Type": "application/json"
         }
+        self.reads = SingleFlight("db")
+        # Bumped whenever a write finishes, so coalesced reads can be ordered after it
+        self.write_seq = 0
     
-    async def execute_query(self, query: str, params: List = None) -> Dict[str, Any]:
-        """Execute a query using Neon REST API with retry logic"""
+    async def execute_query(self, query: str, params: List = None, idempotent: bool = False) -> Dict[str, Any]:
+        """Execute a query using Neon REST API with retry logic
+
+        Writes are retried after ambiguous failures only when idempotent is set,
+        i.e. when running the statement twice has the effect of running it once.
+        """
+        started = time.perf_counter()
+        tracker = query_tracker.get()
+        neon_params = convert_params_for_neon(tuple(params or ()))
+        read_only = is_read_only(query)
         try:
-            return await execute_with_retry(query, params)
+            if read_only and tracker is not None and settings.db_coalesce_reads:
+                return await self._coalesced_read(query, neon_params, tracker)
+            return await execute_with_retry(query, neon_params, idempotent or read_only)
         except NeonAPIError as e:
             print(f"Database error: {e.message}")
             raise Exception(f"Database operation failed: {e.message}")
+        finally:
+            if not read_only:
+                self.write_seq += 1
+                if tracker is not None:
+                    tracker.last_write_seq = self.write_seq
+            if tracker is not None:
+                tracker.record(query, time.perf_counter() - started)
     
-    async def execute(self, query: str, *args):
+    async def _coalesced_read(self, query: str, neon_params: tuple, tracker: QueryTracker) -> Dict[str, Any]:
+        """Share one Neon call among identical concurrent reads that all start after their own writes"""
+        key = (normalize_statement(query), json.dumps(neon_params, default=str))
+        result, _ = await self.reads.do(
+            key,
+            lambda: execute_with_retry(query, neon_params, idempotent=True),
+            version=self.write_seq,
+            min_version=tracker.last_write_seq
+        )
+        return result
+    
+    async def execute(self, query: str, *args, idempotent: bool = False):
         """Execute a query (for compatibility)"""
-        result = await self.execute_query(query, list(args))
+        result = await self.execute_query(query, list(args), idempotent)
         return result.get("rowCount", 0)
     
-    async def fetch(self, query: str, *args):
+    async def fetch(self, query: str, *args, idempotent: bool = False):
         """Fetch multiple rows"""
-        result = await self.execute_query(query, list(args))
+        result = await self.execute_query(query, list(args), idempotent)
         rows = result.get("rows", [])
         columns = result.get("fields", [])
         
@@ -40,9 +174,9 @@ class NeonRestDatabase:
             for row in rows
         ]
     
-    async def fetchrow(self, query: str, *args):
+    async def fetchrow(self, query: str, *args, idempotent: bool = False):
         """Fetch single row"""
-        rows = await self.fetch(query, *args)
+        rows = await self.fetch(query, *args, idempotent=idempotent)
         return rows[0] if rows else None
     
     async def fetchval(self, query: str, *args):
@@ -73,10 +207,14 @@ async def create_tables():
             price NUMERIC(10,2) NOT NULL,
             max_tokens INTEGER NOT NULL,
             max_requests INTEGER NOT NULL DEFAULT 100,
+            max_concurrent INTEGER,
             created_at TIMESTAMP DEFAULT NOW()
         )
     """)
     
+    # Per-plan in-flight request cap (NULL falls back to USER_MAX_CONCURRENT_DEFAULT)
+    await db.execute("ALTER TABLE plans ADD COLUMN IF NOT EXISTS max_concurrent INTEGER")
+    
     # Users table
     await db.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -107,6 +245,15 @@ async def create_tables():
         )
     """)
     
+    # Applied usage writes, so a write retried after a timeout is not applied twice
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS usage_ops (
+            id TEXT PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    await db.execute("DELETE FROM usage_ops WHERE created_at < NOW() - INTERVAL '2 days'")
+    
     # Sessions table (optional)
     await db.execute("""
         CREATE TABLE IF NOT EXISTS sessions (
@@ -124,18 +271,26 @@ async def create_tables():
 async def insert_default_plans():
     """Insert default subscription plans"""
     plans = [
-        ("Baby Free", 0.00, 1000, 10),
-        ("Leveler", 4.00, 5000, 100),
-        ("Log Min", 10.00, 20000, 500),
-        ("High Max", 100.00, 100000, 2000)
+        ("Baby Free", 0.00, 1000, 10, 1),
+        ("Leveler", 4.00, 5000, 100, 2),
+        ("Log Min", 10.00, 20000, 500, 4),
+        ("High Max", 100.00, 100000, 2000, 10)
     ]
     
-    for name, price, max_tokens, max_requests in plans:
+    for name, price, max_tokens, max_requests, max_concurrent in plans:
         existing = await db.fetchrow(
             "SELECT id FROM plans WHERE name = $1", name
         )
         if not existing:
             await db.execute(
-                "INSERT INTO plans (name, price, max_tokens, max_requests) VALUES ($1, $2, $3, $4)",
-                name, price, max_tokens, max_requests
-            )
\ No newline at end of file
+                "INSERT INTO plans (name, price, max_tokens, max_requests, max_concurrent) VALUES ($1, $2, $3, $4, $5)",
+                name, price, max_tokens, max_requests, max_concurrent
+            )
+    
+    # Plans created before max_concurrent existed get the default caps once
+    await db.execute("""
+        UPDATE plans SET max_concurrent = defaults.max_concurrent
+        FROM (VALUES ('Baby Free', 1), ('Leveler', 2), ('Log Min', 4), ('High Max', 10))
+            AS defaults(name, max_concurrent)
+        WHERE plans.name = defaults.name AND plans.max_concurrent IS NULL
+    """)
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""
+Per-request deadlines
+
+Each request gets a deadline when it arrives (see DeadlineMiddleware): the
+client's X-Request-Timeout in seconds, capped at REQUEST_TIMEOUT_MAX, or else
+the plan's default once the user is authenticated (REQUEST_TIMEOUT_PER_PLAN,
+falling back to REQUEST_TIMEOUT_DEFAULT). Defaults stay under the gunicorn
+worker timeout so a request gives up cleanly instead of being killed.
+
+The deadline lives in a contextvar, so tasks started for the request inherit
+it. Neon calls and their retries, admission queueing and upstream calls
+shrink their timeouts to the time left, and fail with 504 once it is spent.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+from app.core import metrics
+from app.core.config import settings
+
+HEADER = "x-request-timeout"
+
+
+class Deadline:
+    """When the current request must be answered by (time.monotonic)"""
+
+    __slots__ = ("started", "expires", "explicit")
+
+    def __init__(self, seconds: float, explicit: bool = False):
+        self.started = time.monotonic()
+        self.expires = self.started + seconds
+        # Set by the client: plan defaults don't override it
+        self.explicit = explicit
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+
+deadline_var: ContextVar[Optional[Deadline]] = ContextVar("deadline", default=None)
+
+
+def from_header(value: Optional[str]) -> Deadline:
+    """Deadline for a new request; malformed or non-positive header values are ignored"""
+    try:
+        seconds = float(value) if value is not None else 0.0
+    except ValueError:
+        seconds = 0.0
+    if seconds > 0:
+        return Deadline(min(seconds, settings.request_timeout_max), explicit=True)
+    return Deadline(settings.request_timeout_max)
+
+
+def apply_plan(plan_name: Optional[str]):
+    """Narrow the request's deadline to its plan default, unless the client set one"""
+    current = deadline_var.get()
+    if current is None or current.explicit:
+        return
+    seconds = settings.request_timeouts.get(plan_name, settings.request_timeout_default)
+    current.expires = min(current.expires, current.started + seconds)
+
+
+def drop_default():
+    """Clear a deadline the client didn't ask for, in work that may stream past it"""
+    current = deadline_var.get()
+    if current is not None and not current.explicit:
+        deadline_var.set(None)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left for the current request; None outside a request"""
+    current = deadline_var.get()
+    return current.remaining() if current is not None else None
+
+
+def expires_at() -> Optional[float]:
+    current = deadline_var.get()
+    return current.expires if current is not None else None
+
+
+def check():
+    """Raise 504 if the current request's deadline has passed"""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise exceeded()
+
+
+def timeout(default: float) -> float:
+    """A call's timeout shrunk to the time left; raises 504 when none is"""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise exceeded()
+    return min(default, left)
+
+
+@asynccontextmanager
+async def bounded():
+    """Cancel the block when the deadline passes, raising 504"""
+    left = remaining()
+    if left is None:
+        yield
+        return
+    if left <= 0:
+        raise exceeded()
+    try:
+        async with asyncio.timeout(left):
+            yield
+    except TimeoutError:
+        raise exceeded()
+
+
+def exceeded() -> HTTPException:
+    metrics.deadlines_exceeded.inc()
+    return HTTPException(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+        detail={
+            "error": "Deadline exceeded",
+            "message": "The request could not be completed within its time limit.",
+            "reason": "deadline_exceeded"
+        }
+    )
@@ -0,0 +1,60 @@
+"""
+HTTP conditional request helpers (ETag / If-None-Match)
+"""
+import hashlib
+from typing import Optional
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from app.core import metrics
+
+
+def make_etag(*parts: str) -> str:
+    """Strong ETag from the values that determine a representation"""
+    digest = hashlib.sha1(":".join(parts).encode()).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison against If-None-Match, as RFC 9110 requires for GET"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in header.split(","))
+
+
+def cache_headers(etag: str, cache_control: str, vary: Optional[str] = None) -> dict:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if vary:
+        headers["Vary"] = vary
+    return headers
+
+
+def not_modified(etag: str, cache_control: str, vary: Optional[str] = None) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag, cache_control, vary))
+
+
+def conditional(request: Request, response: Response, etag: str, cache_control: str,
+                vary: Optional[str] = None) -> Optional[Response]:
+    """304 when the client already has this version, else tag the outgoing response"""
+    hit = etag_matches(request, etag)
+    metrics.record_cache("http_etag", hit)
+    if hit:
+        return not_modified(etag, cache_control, vary)
+    response.headers.update(cache_headers(etag, cache_control, vary))
+    return None
+
+
+def conditional_model(request: Request, model: BaseModel, cache_control: str,
+                      vary: Optional[str] = None) -> Response:
+    """Serialize once, tag with a content hash and answer 304 when it matches"""
+    body = model.model_dump_json().encode()
+    etag = f'"{hashlib.sha1(body).hexdigest()[:32]}"'
+    hit = etag_matches(request, etag)
+    metrics.record_cache("http_etag", hit)
+    if hit:
+        return not_modified(etag, cache_control, vary)
+    return Response(body, media_type=JSONResponse.media_type, headers=cache_headers(etag, cache_control, vary))
@@ -0,0 +1,159 @@
+"""
+Idempotency keys for chat requests
+
+A request sent with an Idempotency-Key header runs at most once per user and
+key while its result is remembered. The call runs in a task of its own, so a
+client that times out and retries attaches to the call still in flight
+instead of starting a second one, and once it has finished the stored
+response is replayed with an Idempotent-Replayed header. Only successful
+responses are kept (TTL + LRU, per worker); a failed call forgets the key so
+a retry runs again. Reusing a key for a different request body is a 422.
+
+Billing uses an op id derived from the key, so even a retry that lands on
+another worker applies its usage increments exactly once.
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException, Response, status
+
+from app.core import metrics
+from app.core.config import settings
+
+MAX_KEY_LENGTH = 255
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def fingerprint(*parts: bytes) -> str:
+    """Hash identifying the request a key was first used with"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def op_id(user_id: str, key: str) -> str:
+    """Usage op id for a keyed request, the same on every worker"""
+    return "idem:" + hashlib.sha256(f"{user_id}:{key}".encode()).hexdigest()[:32]
+
+
+def check_key(key: str):
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"
+        )
+
+
+class StoredResponse:
+    """Body, status and headers of a finished response"""
+
+    __slots__ = ("body", "status_code", "media_type", "headers")
+
+    def __init__(self, body: bytes, status_code: int = 200, media_type: Optional[str] = None,
+                 headers: Optional[Dict[str, str]] = None):
+        self.body = body
+        self.status_code = status_code
+        self.media_type = media_type
+        self.headers = headers or {}
+
+    @classmethod
+    def of(cls, response: Response) -> "StoredResponse":
+        return cls(bytes(response.body), response.status_code, response.media_type, dict(response.headers))
+
+    def response(self, replayed: bool = False) -> Response:
+        headers = dict(self.headers)
+        if replayed:
+            headers[REPLAYED_HEADER] = "true"
+        return Response(self.body, status_code=self.status_code, media_type=self.media_type, headers=headers)
+
+
+class IdempotencyStore:
+    """Finished responses (TTL + LRU) and calls in flight, keyed by (user_id, key)"""
+
+    def __init__(self, ttl: float, max_entries: int, max_body_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self._done: "OrderedDict[Tuple[str, str], Tuple[float, str, StoredResponse]]" = OrderedDict()
+        self._running: Dict[Tuple[str, str], Tuple[str, Any]] = {}
+
+    def lookup(self, user_id: str, key: str, request_fingerprint: str) -> Tuple[Optional[StoredResponse], Any]:
+        """(stored response, None) once finished, (None, handle) while running, else (None, None)"""
+        entry_key = (str(user_id), key)
+        entry = self._done.get(entry_key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._done[entry_key]
+            entry = None
+        if entry is not None:
+            self._check(entry[1], request_fingerprint)
+            self._done.move_to_end(entry_key)
+            metrics.record_cache("idempotency", True)
+            return entry[2], None
+        running = self._running.get(entry_key)
+        if running is not None:
+            self._check(running[0], request_fingerprint)
+            metrics.record_cache("idempotency", True)
+            return None, running[1]
+        metrics.record_cache("idempotency", False)
+        return None, None
+
+    @staticmethod
+    def _check(stored_fingerprint: str, request_fingerprint: str):
+        if stored_fingerprint != request_fingerprint:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail={
+                    "error": "Idempotency key reused",
+                    "message": "This Idempotency-Key was already used with a different request."
+                }
+            )
+
+    def begin(self, user_id: str, key: str, request_fingerprint: str, handle: Any):
+        """Register a call in flight that duplicates can attach to"""
+        self._running[(str(user_id), key)] = (request_fingerprint, handle)
+
+    def finish(self, user_id: str, key: str, stored: Optional[StoredResponse]):
+        """End the call in flight, remembering its response if it succeeded"""
+        entry_key = (str(user_id), key)
+        running = self._running.pop(entry_key, None)
+        if stored is None or running is None or self.ttl <= 0:
+            return
+        if not 200 <= stored.status_code < 300 or len(stored.body) > self.max_body_bytes:
+            return
+        self._done[entry_key] = (time.monotonic() + self.ttl, running[0], stored)
+        self._done.move_to_end(entry_key)
+        while len(self._done) > self.max_entries:
+            self._done.popitem(last=False)
+
+    async def call(self, user_id: str, key: str, request_fingerprint: str,
+                   handler: Callable[[], Awaitable[Response]]) -> Response:
+        """Run handler once per key; duplicates wait for it or get the stored response"""
+        stored, running = self.lookup(user_id, key, request_fingerprint)
+        if stored is not None:
+            return stored.response(replayed=True)
+        replayed = running is not None
+        if running is None:
+            running = asyncio.create_task(self._run(user_id, key, handler))
+            # Nobody may be left to await a call whose clients all went away
+            running.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self.begin(user_id, key, request_fingerprint, running)
+        # The call carries on if this client disconnects, so a retry can attach to it
+        stored = await asyncio.shield(running)
+        return stored.response(replayed=replayed)
+
+    async def _run(self, user_id: str, key: str, handler: Callable[[], Awaitable[Response]]) -> StoredResponse:
+        stored = None
+        try:
+            stored = StoredResponse.of(await handler())
+            return stored
+        finally:
+            self.finish(user_id, key, stored)
+
+
+idempotency_store = IdempotencyStore(
+    settings.idempotency_ttl, settings.idempotency_max_entries, settings.idempotency_max_body_bytes
+)
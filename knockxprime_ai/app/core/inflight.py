@@ -0,0 +1,181 @@
+"""
+Per-user in-flight request limits
+
+Each in-flight request holds one entry (user key, owner pid) in a table in
+shared memory created at import, so gunicorn workers forked from the
+preloaded master enforce one limit between them. Entries are placed near the
+slot the user's key hashes to, so the cross-process lock is held for a short
+bounded probe rather than a scan of the whole table. Entries owned by a
+worker that died are cleared when they would block a claim. Without a
+preloading master the limit applies per process.
+"""
+import asyncio
+import hashlib
+import math
+import multiprocessing
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, status
+
+from app.core import metrics
+from app.core.config import settings
+
+POLL_INTERVAL = 0.02
+# Slots searched from the one a user's key hashes to
+PROBE_LENGTH = 64
+
+
+def _user_key(user_id: Any) -> int:
+    """Stable non-zero 63-bit key for a user id, the same in every worker"""
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+    return (int.from_bytes(digest, "big") >> 1) or 1
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class InFlightTable:
+    """Fixed-size shared table of (user key, pid) entries, one per in-flight request
+
+    A user's entries all sit within PROBE_LENGTH slots of the slot their key
+    hashes to, so claiming an entry reads that window only. Owners are
+    checked for liveness only when the window looks full, for the user or
+    for everyone, since that is when a dead worker's entries get in the way.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.probe = min(size, PROBE_LENGTH)
+        self._entries = multiprocessing.Array("q", size * 2)
+        # Unsynchronized view for reads and writes made while holding the lock
+        self._raw = self._entries.get_obj()
+
+    def try_acquire(self, key: int, limit: int) -> Optional[int]:
+        """Claim an entry if the user holds fewer than limit; None when at the limit"""
+        home = key % self.size
+        window = [(home + offset) % self.size for offset in range(self.probe)]
+        with self._entries.get_lock():
+            held, free = self._scan(key, window)
+            if held >= limit or free is None:
+                # Only the user's own entries matter unless the window has no room at all
+                held, free = self._scan(key, window, reap=True, reap_others=free is None)
+            if held >= limit:
+                return None
+            if free is None:
+                # Window full: fail open rather than reject unrelated users
+                return -1
+            self._raw[free * 2] = key
+            self._raw[free * 2 + 1] = os.getpid()
+            return free
+
+    def _scan(self, key: int, window, reap: bool = False, reap_others: bool = False):
+        """Count the user's entries in the window and find its first free slot
+
+        With reap, entries of the user (or of anyone, with reap_others) whose
+        owner has died are cleared first.
+        """
+        entries = self._raw
+        pid = os.getpid()
+        held = 0
+        free = None
+        for index in window:
+            owner = entries[index * 2 + 1]
+            if (owner and reap and owner != pid and (reap_others or entries[index * 2] == key)
+                    and not _pid_alive(owner)):
+                entries[index * 2] = 0
+                entries[index * 2 + 1] = 0
+                owner = 0
+            if not owner:
+                if free is None:
+                    free = index
+            elif entries[index * 2] == key:
+                held += 1
+        return held, free
+
+    def release(self, index: int):
+        if index < 0:
+            return
+        with self._entries.get_lock():
+            if self._raw[index * 2 + 1] == os.getpid():
+                self._raw[index * 2] = 0
+                self._raw[index * 2 + 1] = 0
+
+
+class UserInFlightLimiter:
+    """Cap concurrent requests per user, waiting briefly for a slot before returning 429"""
+
+    def __init__(self, table_size: int, default_limit: int, wait: float):
+        self.table = InFlightTable(table_size)
+        self.default_limit = default_limit
+        self.wait = wait
+
+    def limit_for(self, user: Dict[str, Any]) -> int:
+        limit = user.get('max_concurrent')
+        return int(limit) if limit is not None else self.default_limit
+
+    @asynccontextmanager
+    async def hold(self, user: Dict[str, Any]):
+        """Count the block as one in-flight request for the user; released on any exit"""
+        index = await self.acquire(user)
+        try:
+            yield
+        finally:
+            self.release(index)
+
+    async def acquire(self, user: Dict[str, Any]) -> int:
+        """Take one of the user's slots, for holders that outlive a single block; pair with release()"""
+        limit = self.limit_for(user)
+        if limit <= 0:
+            return -1
+        return await self._acquire(_user_key(user['id']), limit, user)
+
+    def release(self, index: int):
+        self.table.release(index)
+
+    async def _acquire(self, key: int, limit: int, user: Dict[str, Any]) -> int:
+        deadline = time.monotonic() + self.wait
+        while True:
+            index = self.table.try_acquire(key, limit)
+            if index is not None:
+                return index
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Releases in other workers send no wake-up, so poll until the deadline
+            await asyncio.sleep(min(POLL_INTERVAL, remaining))
+
+        metrics.rate_limit_rejections.inc(limiter="user_in_flight")
+        retry_after = max(1, math.ceil(self.wait))
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail={
+                "error": "Too many concurrent requests",
+                "message": f"Your plan allows {limit} requests in flight at once. "
+                           f"Wait for one to finish before sending another.",
+                "max_concurrent": limit,
+                "plan_name": user.get('plan_name'),
+                "upgrade_required": user.get('plan_name') == 'Baby Free'
+            },
+            headers={
+                "Retry-After": str(retry_after),
+                "X-Concurrency-Limit": str(limit),
+                "X-Concurrency-Remaining": "0"
+            }
+        )
+
+
+user_inflight = UserInFlightLimiter(
+    settings.user_inflight_table_size,
+    settings.user_max_concurrent_default,
+    settings.user_inflight_wait_ms / 1000
+)
@@ -0,0 +1,308 @@
+"""
+Durable job queue for chat workloads
+
+Jobs and their items live in a local SQLite database in WAL mode, shared by
+the web workers (which submit, poll and cancel) and the job worker process
+(which drains it). Requests and results are stored as zlib-compressed JSON.
+A running job is leased to one worker; a lease that is not renewed expires
+and the job is picked up again, resuming from its pending items.
+
+sqlite3 calls block, so the async methods run them in a thread.
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.json_response import dumps
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+CANCELLED = "cancelled"
+FINISHED = (COMPLETED, CANCELLED)
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        priority REAL NOT NULL,
+        total INTEGER NOT NULL,
+        succeeded INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        cancelled INTEGER NOT NULL DEFAULT 0,
+        tokens_billed INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        lease_owner TEXT,
+        lease_expires REAL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created_at);
+    CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, created_at);
+    CREATE TABLE IF NOT EXISTS job_items (
+        job_id TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        request BLOB NOT NULL,
+        status_code INTEGER,
+        result BLOB,
+        tokens INTEGER,
+        PRIMARY KEY (job_id, idx)
+    ) WITHOUT ROWID;
+"""
+
+JOB_COLUMNS = (
+    "id, user_id, status, total, succeeded, failed, cancelled, tokens_billed, created_at, started_at, finished_at"
+)
+
+
+def pack(value: Any) -> bytes:
+    return zlib.compress(dumps(value), 6)
+
+
+def unpack(blob: Optional[bytes]) -> Any:
+    return _loads(zlib.decompress(blob)) if blob is not None else None
+
+
+class JobStore:
+    """Jobs and items in SQLite; one connection per thread"""
+
+    def __init__(self, path: str, lease_seconds: float = 60.0):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._init_lock:
+                if not self._initialized:
+                    connection.executescript(SCHEMA)
+                    self._initialized = True
+        return connection
+
+    async def _run(self, fn, *args):
+        return await asyncio.to_thread(fn, *args)
+
+    # Submission and queries (web workers)
+
+    def _submit(self, user_id: str, priority: float, requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+        job_id = str(uuid.uuid4())
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT INTO jobs (id, user_id, status, priority, total, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, user_id, QUEUED, priority, len(requests), time.time())
+            )
+            connection.executemany(
+                "INSERT INTO job_items (job_id, idx, request) VALUES (?, ?, ?)",
+                ((job_id, index, pack(request)) for index, request in enumerate(requests))
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return self._get(job_id)
+
+    async def submit(self, user_id: str, priority: float, requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Queue a job; lower priority values are drained first"""
+        return await self._run(self._submit, str(user_id), priority, requests)
+
+    def _get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self._get, job_id)
+
+    def _list(self, user_id: str, limit: int) -> List[Dict[str, Any]]:
+        rows = self._connect().execute(
+            f"SELECT {JOB_COLUMNS} FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    async def list(self, user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+        return await self._run(self._list, str(user_id), limit)
+
+    def _results(self, job_id: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+        rows = self._connect().execute("""
+            SELECT idx, status, status_code, result, tokens FROM job_items
+            WHERE job_id = ? AND idx >= ? AND status != 'pending'
+            ORDER BY idx LIMIT ?
+        """, (job_id, offset, limit)).fetchall()
+        return [
+            {
+                "index": row["idx"],
+                "status": row["status"],
+                "status_code": row["status_code"],
+                "tokens": row["tokens"],
+                ("response" if row["status"] == "done" else "error"): unpack(row["result"]),
+            }
+            for row in rows
+        ]
+
+    async def results(self, job_id: str, offset: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        """Finished items from index offset onwards"""
+        return await self._run(self._results, job_id, offset, limit)
+
+    def _cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            job = connection.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job and job["status"] == QUEUED:
+                # Nothing is running, so the job can be closed right away
+                cancelled = connection.execute(
+                    "UPDATE job_items SET status = 'cancelled' WHERE job_id = ? AND status = 'pending'", (job_id,)
+                ).rowcount
+                connection.execute(
+                    "UPDATE jobs SET status = ?, cancelled = cancelled + ?, finished_at = ? WHERE id = ?",
+                    (CANCELLED, cancelled, time.time(), job_id)
+                )
+            elif job and job["status"] == RUNNING:
+                # The worker sees this between chunks and cancels the rest
+                connection.execute("UPDATE jobs SET status = ? WHERE id = ?", (CANCELLED, job_id))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return self._get(job_id)
+
+    async def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self._cancel, job_id)
+
+    # Draining (job worker)
+
+    def _claim(self, owner: str) -> Optional[Dict[str, Any]]:
+        """Lease the next queued job, or a leased one whose worker stopped renewing it
+
+        A job cancelled while its worker was gone keeps its status, so the new
+        owner only closes it.
+        """
+        now = time.time()
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("""
+                SELECT id FROM jobs
+                WHERE status = ? OR (status IN (?, ?) AND lease_expires < ?)
+                ORDER BY priority, created_at LIMIT 1
+            """, (QUEUED, RUNNING, CANCELLED, now)).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            connection.execute("""
+                UPDATE jobs SET status = CASE WHEN status = ? THEN status ELSE ? END,
+                    lease_owner = ?, lease_expires = ?, started_at = COALESCE(started_at, ?)
+                WHERE id = ?
+            """, (CANCELLED, RUNNING, owner, now + self.lease_seconds, now, row["id"]))
+            job = connection.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return dict(job)
+
+    async def claim(self, owner: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self._claim, owner)
+
+    def _pending_items(self, job_id: str, limit: int) -> List[Tuple[int, Dict[str, Any]]]:
+        rows = self._connect().execute(
+            "SELECT idx, request FROM job_items WHERE job_id = ? AND status = 'pending' ORDER BY idx LIMIT ?",
+            (job_id, limit)
+        ).fetchall()
+        return [(row["idx"], unpack(row["request"])) for row in rows]
+
+    async def pending_items(self, job_id: str, limit: int) -> List[Tuple[int, Dict[str, Any]]]:
+        return await self._run(self._pending_items, job_id, limit)
+
+    def _record(self, job_id: str, owner: str, outcomes: List[Tuple[int, str, int, Any, int]]) -> str:
+        """Store a chunk's outcomes, renew the lease and return the job's status"""
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "UPDATE job_items SET status = ?, status_code = ?, result = ?, tokens = ? "
+                "WHERE job_id = ? AND idx = ? AND status = 'pending'",
+                ((status, code, pack(result), tokens, job_id, index) for index, status, code, result, tokens in outcomes)
+            )
+            succeeded = sum(1 for outcome in outcomes if outcome[1] == "done")
+            connection.execute("""
+                UPDATE jobs SET succeeded = succeeded + ?, failed = failed + ?, tokens_billed = tokens_billed + ?,
+                    lease_expires = ?
+                WHERE id = ? AND lease_owner = ?
+            """, (succeeded, len(outcomes) - succeeded, sum(outcome[4] for outcome in outcomes),
+                  time.time() + self.lease_seconds, job_id, owner))
+            status = connection.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()["status"]
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return status
+
+    async def record(self, job_id: str, owner: str, outcomes: List[Tuple[int, str, int, Any, int]]) -> str:
+        return await self._run(self._record, job_id, owner, outcomes)
+
+    def _finish(self, job_id: str, owner: str):
+        """Close a drained job; items left pending (after a cancel or a quota stop) are cancelled"""
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            cancelled = connection.execute(
+                "UPDATE job_items SET status = 'cancelled' WHERE job_id = ? AND status = 'pending'", (job_id,)
+            ).rowcount
+            connection.execute("""
+                UPDATE jobs SET status = CASE WHEN status = ? THEN ? ELSE ? END,
+                    cancelled = cancelled + ?, finished_at = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE id = ? AND lease_owner = ?
+            """, (CANCELLED, CANCELLED, COMPLETED, cancelled, time.time(), job_id, owner))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    async def finish(self, job_id: str, owner: str):
+        await self._run(self._finish, job_id, owner)
+
+    def _release(self, job_id: str, owner: str):
+        job = self._get(job_id)
+        if job and job["status"] == CANCELLED:
+            self._finish(job_id, owner)
+            return
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ?",
+            (QUEUED, job_id, owner)
+        )
+
+    async def release(self, job_id: str, owner: str):
+        """Hand an unfinished job back to the queue (worker shutting down)"""
+        await self._run(self._release, job_id, owner)
+
+
+job_store = JobStore(settings.job_store_path, settings.job_lease_seconds)
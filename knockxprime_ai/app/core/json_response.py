@@ -0,0 +1,59 @@
+"""
+Fast JSON responses
+
+Uses orjson when it is installed and falls back to the standard library
+otherwise. UUID, datetime, date and Decimal values (as returned by Neon
+rows) are serialized natively, so handlers can return row dicts without
+running FastAPI's jsonable_encoder over them first.
+"""
+import json
+import uuid
+from datetime import date, datetime, time
+from decimal import Decimal
+from types import MappingProxyType
+from typing import Any
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _decimal(value: Decimal):
+    # Same convention as FastAPI's encoder: integral values stay integers
+    return int(value) if value.as_tuple().exponent >= 0 else float(value)
+
+
+def _default(obj: Any) -> Any:
+    """Types neither serializer handles on its own"""
+    if isinstance(obj, Decimal):
+        return _decimal(obj)
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    if isinstance(obj, MappingProxyType):
+        return dict(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if orjson is None:
+        if isinstance(obj, (datetime, date, time)):
+            return obj.isoformat()
+        if isinstance(obj, uuid.UUID):
+            return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    def dumps(content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(content: Any) -> bytes:
+        return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson (or compact stdlib json)"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
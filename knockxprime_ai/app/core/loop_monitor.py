@@ -0,0 +1,156 @@
+"""
+Event loop lag monitoring and stall detection
+
+A heartbeat coroutine records loop lag continuously. A watchdog thread
+notices when the heartbeat stops arriving and captures the Python stack
+of the loop thread while it is still blocked, together with the request
+that the running task was serving.
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional
+
+from app.core import metrics
+from app.core.config import settings
+
+# Request served by the current task; set by the request logging middleware
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# Task -> request id, so other threads can tell which request the loop is running
+task_requests: "weakref.WeakKeyDictionary[asyncio.Task, str]" = weakref.WeakKeyDictionary()
+
+
+def register_current_task(request_id: str):
+    """Attribute the running task to a request"""
+    task = asyncio.current_task()
+    if task is not None:
+        task_requests[task] = request_id
+
+
+def unregister_current_task():
+    task = asyncio.current_task()
+    if task is not None:
+        task_requests.pop(task, None)
+
+
+def request_for_task(task: Optional[asyncio.Task]) -> Optional[str]:
+    if task is None:
+        return None
+    try:
+        return task_requests.get(task)
+    except RuntimeError:
+        # Dictionary changed size while read from another thread
+        return None
+
+
+def _install_task_factory(loop: asyncio.AbstractEventLoop):
+    """Tasks created while serving a request inherit that request's id"""
+    previous = loop.get_task_factory()
+
+    def factory(loop, coro, **kwargs):
+        if previous is not None:
+            task = previous(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        request_id = request_id_var.get()
+        if request_id is not None:
+            task_requests[task] = request_id
+        return task
+
+    loop.set_task_factory(factory)
+
+
+def capture_thread_stack(thread_id: int, limit: int = 40) -> List[str]:
+    """Formatted stack of another thread, innermost frame last"""
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return []
+    return [line.rstrip() for line in traceback.format_list(traceback.extract_stack(frame, limit=limit))]
+
+
+class LoopMonitor:
+    """Heartbeat on the loop plus a watchdog thread that catches it blocked"""
+
+    def __init__(self, interval: float, stall_threshold: float, history_size: int):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=history_size)
+        self.stall_count = 0
+        self._last_beat = time.monotonic()
+        self._pending_stall: Optional[Dict[str, Any]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        _install_task_factory(self._loop)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-stall-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - scheduled - self.interval)
+            self._last_beat = time.monotonic()
+            metrics.event_loop_lag.observe(lag)
+            metrics.event_loop_lag_current.set(lag)
+
+            stall = self._pending_stall
+            if stall is not None:
+                # The watchdog saw this stall start; the heartbeat knows how long it lasted
+                self._pending_stall = None
+                stall["duration_ms"] = round(lag * 1000, 1)
+                metrics.event_loop_stall_duration.observe(lag)
+
+    def _watch(self):
+        check_every = max(0.005, self.stall_threshold / 4)
+        while not self._stop.wait(check_every):
+            blocked_for = time.monotonic() - self._last_beat - self.interval
+            if blocked_for < self.stall_threshold or self._pending_stall is not None:
+                continue
+            self._record_stall(blocked_for)
+
+    def _record_stall(self, blocked_for: float):
+        task = asyncio.current_task(self._loop) if self._loop is not None else None
+        stall = {
+            "detected_at": time.time(),
+            "blocked_ms_at_capture": round(blocked_for * 1000, 1),
+            "duration_ms": None,
+            "request_id": request_for_task(task),
+            "task": task.get_name() if task is not None else None,
+            "stack": capture_thread_stack(self._loop_thread_id),
+        }
+        self._pending_stall = stall
+        self.stalls.append(stall)
+        self.stall_count += 1
+        metrics.event_loop_stalls.inc()
+
+    def recent(self, limit: int) -> List[Dict[str, Any]]:
+        return list(reversed(self.stalls))[:limit]
+
+
+loop_monitor = LoopMonitor(
+    interval=settings.loop_monitor_interval,
+    stall_threshold=settings.loop_stall_threshold_ms / 1000,
+    history_size=settings.loop_stall_history
+)
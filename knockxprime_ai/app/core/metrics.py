@@ -0,0 +1,441 @@
+"""
+In-process metrics with Prometheus text exposition
+
+Metrics are plain Python objects updated on the event loop with no I/O.
+When METRICS_MULTIPROC_DIR is set (gunicorn), every worker periodically
+writes a snapshot of its metrics to that directory and a scrape of any
+worker merges the snapshots of all workers.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+from fastapi import APIRouter, HTTPException, Request, status
+from fastapi.responses import PlainTextResponse
+
+from app.core.config import settings
+
+PREFIX = "knockxprime_"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COMPRESSION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+RATIO_BUCKETS = (1, 1.5, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            samples = [[list(key), value if not isinstance(value, list) else list(value)]
+                       for key, value in self._values.items()]
+        return {
+            "type": self.kind,
+            "help": self.documentation,
+            "labelnames": list(self.labelnames),
+            "samples": samples,
+        }
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # Per-bucket counts followed by sum and count; cumulated at render time
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self) -> Dict:
+        data = super().snapshot()
+        data["buckets"] = list(self.buckets)
+        return data
+
+
+class MetricsRegistry:
+    """Holds every metric of this process and renders Prometheus text"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+
+registry = MetricsRegistry()
+
+
+# HTTP
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status")
+)
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "HTTP requests currently being processed"
+)
+
+# Neon
+db_queries_per_request = registry.histogram(
+    "db_queries_per_request", "Neon queries issued while serving one request", ("route",), COUNT_BUCKETS
+)
+db_query_budget_exceeded = registry.counter(
+    "db_query_budget_exceeded_total", "Requests that issued more queries than their endpoint declared", ("route",)
+)
+db_query_duration = registry.histogram(
+    "db_query_duration_seconds", "Latency of a single Neon REST round trip", ("operation", "outcome"),
+    DB_LATENCY_BUCKETS
+)
+db_retries = registry.counter(
+    "db_query_retries_total", "Neon calls retried, by statement type and failure class", ("operation", "kind")
+)
+
+# Grok upstream
+upstream_ttfb = registry.histogram(
+    "upstream_ttfb_seconds", "Time until the upstream returned response headers", ("upstream",)
+)
+upstream_duration = registry.histogram(
+    "upstream_request_duration_seconds", "Total upstream call latency including the body", ("upstream", "status")
+)
+upstream_in_flight = registry.gauge("upstream_in_flight", "Upstream calls holding an admission slot", ("upstream",))
+upstream_queue_depth = registry.gauge("upstream_queue_depth", "Calls waiting for an upstream admission slot", ("upstream",))
+upstream_queue_wait = registry.histogram(
+    "upstream_queue_wait_seconds", "Time spent waiting for an upstream admission slot", ("upstream",)
+)
+upstream_shed = registry.counter(
+    "upstream_shed_total", "Upstream calls rejected by admission control", ("upstream", "reason")
+)
+upstream_shedding = registry.gauge(
+    "upstream_shedding", "1 while admission control is shedding load because of sustained queue delay", ("upstream",)
+)
+singleflight_calls = registry.counter(
+    "singleflight_calls_total", "Coalescable calls that were issued or joined an identical in-flight call",
+    ("group", "result")
+)
+upstream_latency_ewma = registry.gauge(
+    "upstream_latency_ewma_seconds", "Moving average of time to first byte, used for routing", ("upstream",)
+)
+upstream_picks = registry.counter("upstream_picks_total", "Chat calls routed to each upstream", ("upstream",))
+upstream_hedges = registry.counter(
+    "upstream_hedges_total", "Hedged and failover calls by upstream and outcome", ("upstream", "result")
+)
+circuit_state = registry.gauge(
+    "circuit_breaker_state", "Circuit breaker state: 0 closed, 1 half-open, 2 open", ("breaker",)
+)
+circuit_transitions = registry.counter(
+    "circuit_breaker_transitions_total", "Circuit breaker state changes by the state entered", ("breaker", "state")
+)
+circuit_rejections = registry.counter(
+    "circuit_breaker_rejections_total", "Calls failed fast because the circuit was open", ("breaker",)
+)
+
+# Billing and limits
+tokens_billed = registry.counter("tokens_billed_total", "Tokens recorded against user quotas", ("plan",))
+rate_limit_rejections = registry.counter(
+    "rate_limit_rejections_total", "Requests rejected by a rate or quota limit", ("limiter",)
+)
+job_items = registry.counter("job_items_total", "Queued job items processed by the job worker", ("status",))
+speculative_calls = registry.counter(
+    "speculative_calls_total", "Grok calls started alongside the quota check, by whether the check passed",
+    ("result",)
+)
+
+# Deadlines
+deadlines_exceeded = registry.counter(
+    "request_deadlines_exceeded_total", "Requests failed with 504 because their deadline passed"
+)
+client_disconnects = registry.counter(
+    "client_disconnects_total", "Requests whose handler was cancelled because the client went away"
+)
+
+# Response compression
+compression_duration = registry.histogram(
+    "http_compression_seconds", "CPU time spent compressing one response body", ("encoding",), COMPRESSION_BUCKETS
+)
+compression_ratio = registry.histogram(
+    "http_compression_ratio", "Uncompressed / compressed size of a response body", ("encoding",), RATIO_BUCKETS
+)
+compression_bytes = registry.counter(
+    "http_compression_bytes_total", "Response body bytes before and after compression", ("encoding", "stage")
+)
+compression_skipped = registry.counter(
+    "http_compression_skipped_total", "Responses sent uncompressed although the client accepted an encoding",
+    ("reason",)
+)
+
+# Caches
+cache_requests = registry.counter("cache_requests_total", "Cache lookups by result", ("cache", "result"))
+
+# Runtime
+event_loop_lag = registry.histogram(
+    "event_loop_lag_seconds", "Delay between a scheduled wakeup and when the loop ran it", (), LAG_BUCKETS
+)
+event_loop_lag_current = registry.gauge("event_loop_lag_current_seconds", "Most recent event loop lag sample")
+event_loop_stalls = registry.counter("event_loop_stalls_total", "Times the loop was blocked past the stall threshold")
+event_loop_stall_duration = registry.histogram(
+    "event_loop_stall_seconds", "How long each detected loop stall lasted", (), LAG_BUCKETS
+)
+process_start_time = registry.gauge("process_start_time_seconds", "Start time of the worker since epoch")
+process_start_time.set(time.time())
+
+
+def mark_process_start():
+    """Reset the start time in a worker; set at import it would be the preloading master's"""
+    process_start_time.set(time.time())
+
+
+def record_cache(cache: str, hit: bool):
+    """Count a cache lookup"""
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def uptime_seconds() -> float:
+    return time.time() - process_start_time.value()
+
+
+def record_db_query(operation: str, outcome: str, duration: float):
+    """Record one Neon round trip"""
+    db_query_duration.observe(duration, operation=operation, outcome=outcome)
+
+
+# Multiprocess collection
+
+def _snapshot_path(directory: str, pid: int) -> Path:
+    return Path(directory) / f"metrics_{pid}.json"
+
+
+def write_snapshot():
+    """Write this worker's metrics where sibling workers can read them"""
+    directory = settings.metrics_multiproc_dir
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    path = _snapshot_path(directory, os.getpid())
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(registry.snapshot()))
+    os.replace(tmp_path, path)
+
+
+async def flush_snapshots_periodically():
+    """Background task that keeps this worker's snapshot fresh"""
+    while True:
+        await asyncio.sleep(settings.metrics_flush_interval)
+        try:
+            write_snapshot()
+        except OSError as e:
+            print(f"Metrics snapshot failed: {e}")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _archive_path(directory: str) -> Path:
+    return Path(directory) / "metrics_archive.json"
+
+
+def collect_snapshots() -> List[Tuple[int, Dict]]:
+    """Snapshots of every worker, or just this process in single-worker mode"""
+    directory = settings.metrics_multiproc_dir
+    if not directory:
+        return [(os.getpid(), registry.snapshot())]
+
+    write_snapshot()
+    snapshots = []
+    for path in Path(directory).glob("metrics_*.json"):
+        try:
+            pid = ARCHIVE_PID if path == _archive_path(directory) else int(path.stem.split("_", 1)[1])
+            snapshots.append((pid, json.loads(path.read_text())))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+# Pseudo-pid of the file holding counters from workers that have exited
+ARCHIVE_PID = -1
+
+
+def _add_samples(target: Dict, samples: List, suffix: Tuple[str, ...] = (), replace: bool = False):
+    for labels, value in samples:
+        key = tuple(labels) + suffix
+        current = target.get(key)
+        if replace or current is None:
+            target[key] = value
+        elif isinstance(value, list):
+            target[key] = [a + b for a, b in zip(current, value)]
+        else:
+            target[key] = current + value
+
+
+def merge_snapshots(snapshots: List[Tuple[int, Dict]]) -> Dict[str, Dict]:
+    """Sum counters and histograms across workers; gauges keep a pid label"""
+    merged: Dict[str, Dict] = {}
+    multi = len(snapshots) > 1
+    for pid, snapshot in snapshots:
+        alive = pid != ARCHIVE_PID and _pid_alive(pid)
+        for name, data in snapshot.items():
+            target = merged.setdefault(name, {**data, "samples": {}})
+            if data["type"] != "gauge":
+                _add_samples(target["samples"], data["samples"])
+            elif not multi:
+                _add_samples(target["samples"], data["samples"], replace=True)
+            elif alive:
+                target["labelnames"] = data["labelnames"] + ["pid"]
+                _add_samples(target["samples"], data["samples"], (str(pid),), replace=True)
+    return merged
+
+
+def archive_worker_snapshot(pid: int):
+    """Fold an exited worker's counters into the archive file (gunicorn child_exit)"""
+    directory = settings.metrics_multiproc_dir
+    path = _snapshot_path(directory, pid) if directory else None
+    if path is None or not path.exists():
+        return
+
+    archive_path = _archive_path(directory)
+    archive = json.loads(archive_path.read_text()) if archive_path.exists() else {}
+    for name, data in json.loads(path.read_text()).items():
+        if data["type"] == "gauge":
+            continue
+        target = archive.setdefault(name, {**data, "samples": []})
+        samples = {tuple(labels): value for labels, value in target["samples"]}
+        _add_samples(samples, data["samples"])
+        target["samples"] = [[list(labels), value] for labels, value in samples.items()]
+
+    tmp_path = archive_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(archive))
+    os.replace(tmp_path, archive_path)
+    path.unlink()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(merged: Dict[str, Dict]) -> str:
+    lines = []
+    for name, data in sorted(merged.items()):
+        lines.append(f"# HELP {name} {data['help']}")
+        lines.append(f"# TYPE {name} {data['type']}")
+        labelnames = data["labelnames"]
+        for labels, value in sorted(data["samples"].items()):
+            if data["type"] != "histogram":
+                lines.append(f"{name}{_labels(labelnames, labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(data["buckets"]) + [float("inf")], value[:-2]):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{name}_bucket{_labels(labelnames, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labelnames, labels)} {_number(value[-2])}")
+            lines.append(f"{name}_count{_labels(labelnames, labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint(request: Request):
+    """Prometheus scrape endpoint, behind METRICS_TOKEN outside development"""
+    if settings.metrics_token:
+        if request.headers.get("authorization") != f"Bearer {settings.metrics_token}":
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    elif settings.environment != "development":
+        # Labels name users' plans, upstreams and breaker state: never serve them openly
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Metrics token not configured")
+
+    body = render_prometheus(merge_snapshots(collect_snapshots()))
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
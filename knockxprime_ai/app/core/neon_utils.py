@@ -1,17 +1,29 @@
 """
 Neon Database REST API utilities and helpers
 """
+import asyncio
 import httpx
+import json
+import random
+import time
+from datetime import date, datetime
 from typing import Dict, Any, List, Optional
+from app.core import deadline as request_deadline
+from app.core import metrics
+from app.core.circuit_breaker import CircuitBreaker
 from app.core.config import settings
+from app.core.metrics import record_db_query
+from app.core.tracing import tracer, KIND_CLIENT
 
 
 class NeonAPIError(Exception):
     """Custom exception for Neon API errors"""
-    def __init__(self, message: str, status_code: int = None, response_data: Dict = None):
+    def __init__(self, message: str, status_code: int = None, response_data: Dict = None, kind: str = "fatal"):
         self.message = message
         self.status_code = status_code
         self.response_data = response_data
+        # Retry class: "safe", "ambiguous" or "fatal" (see RetryPolicy)
+        self.kind = kind
         super().__init__(self.message)
 
 
@@ -58,22 +70,138 @@ async def test_neon_connection() -> Dict[str, Any]:
         }
 
 
+def _error_data(response: httpx.Response) -> Optional[Dict]:
+    """Error body as a dict when it is JSON; Neon errors may come from a proxy as HTML or text"""
+    try:
+        data = response.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
 def format_neon_error(response: httpx.Response) -> str:
     """Format Neon API error response for logging"""
-    try:
-        error_data = response.json()
+    error_data = _error_data(response)
+    if error_data is not None:
         return f"Neon API Error {response.status_code}: {error_data.get('message', 'Unknown error')}"
-    except:
-        return f"Neon API Error {response.status_code}: {response.text}"
+    return f"Neon API Error {response.status_code}: {response.text[:500]}"
+
+
+def query_operation(query: str) -> str:
+    """Statement type used to label query metrics"""
+    words = query.split(None, 1)
+    operation = words[0].lower() if words else "unknown"
+    return operation if operation in ("select", "insert", "update", "delete", "with", "create") else "other"
 
 
 def convert_params_for_neon(args: tuple) -> List[Any]:
-    """Convert asyncpg-style parameters to Neon REST API format"""
-    return [str(arg) if arg is not None else None for arg in args]
+    """Convert asyncpg-style parameters to Neon REST API format
+
+    The API takes every parameter as text (or null) and lets Postgres cast it
+    to the placeholder's type, so values are sent in Postgres' input syntax.
+    """
+    return [_neon_param(arg) for arg in args]
+
+
+def _neon_param(arg: Any) -> Optional[str]:
+    if arg is None:
+        return None
+    if isinstance(arg, bool):
+        return "true" if arg else "false"
+    if isinstance(arg, (datetime, date)):
+        return arg.isoformat()
+    if isinstance(arg, (dict, list)):
+        return json.dumps(arg, default=str)
+    return str(arg)
+
+
+class RetryPolicy:
+    """How Neon calls are retried: which failures, how often, how long to wait
+
+    Failures fall into three classes:
+    - "safe": the statement never ran (connection refused, connect timeout,
+      429/503, or a SQLSTATE whose transaction was rolled back), so any
+      statement can be sent again;
+    - "ambiguous": it may have run (read timeout, dropped connection, other
+      5xx), so only reads and statements marked idempotent are retried;
+    - "fatal": it will fail the same way again (SQL errors, auth), never retried.
+
+    Waits use exponential backoff with full jitter, and attempts stop when the
+    next one could not finish within the call's deadline budget.
+    """
+
+    SAFE_STATUS = {429, 503}
+    AMBIGUOUS_STATUS = {500, 502, 504}
+    # serialization_failure, deadlock_detected, lock_not_available, too_many_connections, cannot_connect_now
+    SAFE_SQLSTATES = {"40001", "40P01", "55P03", "53300", "57P03"}
 
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float,
+                 budget: float, attempt_timeout: float):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.attempt_timeout = attempt_timeout
 
-async def execute_with_retry(query: str, params: List = None, max_retries: int = 3) -> Dict[str, Any]:
-    """Execute query with retry logic for transient failures"""
+    def backoff(self, attempt: int) -> float:
+        """Delay before retry number `attempt` (1-based)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def classify_response(self, response: httpx.Response, data: Optional[Dict]) -> str:
+        sqlstate = (data or {}).get("code")
+        if response.status_code in self.SAFE_STATUS or sqlstate in self.SAFE_SQLSTATES:
+            return "safe"
+        if response.status_code in self.AMBIGUOUS_STATUS:
+            return "ambiguous"
+        return "fatal"
+
+    @staticmethod
+    def classify_exception(error: httpx.RequestError) -> str:
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+            return "safe"
+        return "ambiguous"
+
+    def should_retry(self, kind: str, retry_ambiguous: bool) -> bool:
+        return kind == "safe" or (kind == "ambiguous" and retry_ambiguous)
+
+
+def _is_neon_failure(error: BaseException) -> bool:
+    """Errors that count against the Neon circuit: anything transient"""
+    return isinstance(error, NeonAPIError) and error.kind in ("safe", "ambiguous")
+
+
+neon_retry_policy = RetryPolicy(
+    max_attempts=settings.neon_retry_max_attempts,
+    base_delay=settings.neon_retry_base_ms / 1000,
+    max_delay=settings.neon_retry_max_backoff_ms / 1000,
+    budget=settings.neon_retry_budget_ms / 1000,
+    attempt_timeout=settings.neon_timeout
+)
+
+neon_breaker = CircuitBreaker(
+    "neon",
+    window_seconds=30,
+    min_calls=settings.neon_breaker_min_calls,
+    failure_rate=settings.neon_breaker_failure_rate,
+    slow_call_seconds=settings.neon_timeout,
+    slow_call_rate=1.0,
+    open_seconds=settings.neon_breaker_open_seconds,
+    half_open_calls=3,
+    enabled=settings.neon_breaker_enabled,
+    is_failure=_is_neon_failure,
+    service="The database"
+)
+
+
+async def execute_with_retry(query: str, params: List = None, idempotent: bool = False,
+                             policy: RetryPolicy = None) -> Dict[str, Any]:
+    """Execute a query, retrying transient failures under the retry policy
+
+    Failures that leave it unknown whether the statement ran are only retried
+    when the caller marks the statement idempotent (reads always are). Inside a
+    request, attempts and retries also fit within the request's deadline.
+    """
+    policy = policy or neon_retry_policy
     headers = {
         "Authorization": f"Bearer {settings.neon_api_key}",
         "Content-Type": "application/json"
@@ -84,34 +212,68 @@ async def execute_with_retry(query: str, params: List = None, max_retries: int =
         "params": params or []
     }
     
-    last_error = None
+    operation = query_operation(query)
+    deadline = time.monotonic() + policy.budget
+    request_expires = request_deadline.expires_at()
+    if request_expires is not None:
+        if request_expires <= time.monotonic():
+            raise request_deadline.exceeded()
+        deadline = min(deadline, request_expires)
+    attempt = 0
     
-    for attempt in range(max_retries):
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{settings.neon_api_url}/query",
-                    headers=headers,
-                    json=payload,
-                    timeout=30.0
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    error_msg = format_neon_error(response)
-                    if attempt == max_retries - 1:
-                        raise NeonAPIError(error_msg, response.status_code, response.json())
-                    last_error = error_msg
+    with tracer.start_span("neon.query", KIND_CLIENT, {
+        "db.system": "postgresql",
+        "db.operation": operation,
+        "db.statement": " ".join(query.split())[:200]
+    }) as span:
+        while True:
+            attempt += 1
+            span.set_attribute("db.attempts", attempt)
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                async with neon_breaker.call():
+                    try:
+                        async with httpx.AsyncClient() as client:
+                            response = await client.post(
+                                f"{settings.neon_api_url}/query",
+                                headers=headers,
+                                json=payload,
+                                timeout=max(0.001, min(policy.attempt_timeout, deadline - time.monotonic()))
+                            )
+                    except httpx.TimeoutException as e:
+                        outcome = "timeout"
+                        if request_expires is not None and time.monotonic() >= request_expires:
+                            # Cut short by the request's deadline: not Neon's fault, so not a breaker failure
+                            raise request_deadline.exceeded() from e
+                        raise NeonAPIError(
+                            f"Request timeout on attempt {attempt}: {str(e)}", kind=policy.classify_exception(e)
+                        )
+                    except httpx.RequestError as e:
+                        raise NeonAPIError(
+                            f"Request error on attempt {attempt}: {str(e)}", kind=policy.classify_exception(e)
+                        )
                     
-        except httpx.TimeoutException as e:
-            if attempt == max_retries - 1:
-                raise NeonAPIError(f"Request timeout after {max_retries} attempts: {str(e)}")
-            last_error = f"Timeout on attempt {attempt + 1}"
-            
-        except httpx.RequestError as e:
-            if attempt == max_retries - 1:
-                raise NeonAPIError(f"Request error after {max_retries} attempts: {str(e)}")
-            last_error = f"Request error on attempt {attempt + 1}: {str(e)}"
-    
-    raise NeonAPIError(f"All {max_retries} attempts failed. Last error: {last_error}")
\ No newline at end of file
+                    if response.status_code == 200:
+                        outcome = "ok"
+                        return response.json()
+                    data = _error_data(response)
+                    raise NeonAPIError(
+                        format_neon_error(response), response.status_code, data,
+                        kind=policy.classify_response(response, data)
+                    )
+            except NeonAPIError as e:
+                delay = policy.backoff(attempt)
+                if (attempt >= policy.max_attempts or not policy.should_retry(e.kind, idempotent)
+                        or time.monotonic() + delay >= deadline):
+                    span.set_attribute("db.error_kind", e.kind)
+                    if (request_expires is not None and attempt < policy.max_attempts
+                            and policy.should_retry(e.kind, idempotent) and time.monotonic() + delay >= request_expires):
+                        # It would have been retried, but the request has no time left
+                        raise request_deadline.exceeded() from e
+                    raise
+                metrics.db_retries.inc(operation=operation, kind=e.kind)
+                print(f"Retrying Neon query ({operation}) after {e.kind} failure ({e.message}) in {delay * 1000:.0f}ms")
+                await asyncio.sleep(delay)
+            finally:
+                record_db_query(operation, outcome, time.perf_counter() - started)
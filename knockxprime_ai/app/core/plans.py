@@ -1,36 +1,140 @@
-from typing import List, Dict, Optional
+import asyncio
+from types import MappingProxyType
+from typing import Any, List, Dict, Mapping, Optional, Tuple
 from app.core.database import db
+from app.core.config import settings
+from app.core import metrics
+
+PLAN_COLUMNS = (
+    "plans.id, plans.name, plans.price, plans.max_tokens, plans.max_requests, plans.max_concurrent, plans.created_at"
+)
+
+# Changes whenever any plan row is inserted, updated or deleted
+CATALOG_VERSION_QUERY = """
+    SELECT md5(COALESCE(string_agg(
+        id::text || ':' || name || ':' || price::text || ':' || max_tokens::text || ':' || max_requests::text
+            || ':' || COALESCE(max_concurrent::text, ''),
+        ',' ORDER BY id
+    ), '')) AS version
+    FROM plans
+"""
+
+
+def _plan_comparison(plans: Tuple[Mapping[str, Any], ...]) -> Dict[str, Any]:
+    """Build the /plans/compare/pricing payload"""
+    comparison = []
+    for plan in plans:
+        price = float(plan['price'])
+        tokens_per_dollar = plan['max_tokens'] / price if price > 0 else float('inf')
+        comparison.append({
+            "name": plan['name'],
+            "price": plan['price'],
+            "max_tokens": plan['max_tokens'],
+            "max_requests": plan['max_requests'],
+            "tokens_per_dollar": round(tokens_per_dollar, 2) if tokens_per_dollar != float('inf') else "Unlimited",
+            "features": {
+                "api_access": True,
+                "usage_analytics": True,
+                "email_support": price > 0,
+                "priority_support": price >= 10.00,
+                "daily_limits": True
+            }
+        })
+    
+    return {
+        "plans": comparison,
+        "currency": "USD",
+        "billing_cycle": "monthly",
+        "limits": "daily"
+    }
+
+
+class PlanCatalogSnapshot:
+    """Read-only view of every plan, indexed by id and name"""
+    
+    __slots__ = ("version", "plans", "by_id", "by_name", "comparison")
+    
+    def __init__(self, version: str, rows: List[Dict]):
+        self.version = version
+        self.plans = tuple(MappingProxyType(dict(row)) for row in rows)
+        self.by_id = MappingProxyType({str(plan['id']): plan for plan in self.plans})
+        self.by_name = MappingProxyType({plan['name']: plan for plan in self.plans})
+        self.comparison = _plan_comparison(self.plans)
+
+
+class PlanCatalog:
+    """Plans loaded once and swapped atomically when the version in Neon changes"""
+    
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.snapshot: Optional[PlanCatalogSnapshot] = None
+        self._lock = asyncio.Lock()
+    
+    async def get(self) -> PlanCatalogSnapshot:
+        """Current snapshot, loading it on first use"""
+        snapshot = self.snapshot
+        metrics.record_cache("plan_catalog", snapshot is not None)
+        if snapshot is None:
+            snapshot = await self.load()
+        return snapshot
+    
+    async def load(self) -> PlanCatalogSnapshot:
+        """Read all plans and publish a new snapshot"""
+        async with self._lock:
+            # Version read in the same statement, so it always matches the rows
+            rows = await db.fetch(f"""
+                SELECT {PLAN_COLUMNS}, v.version AS catalog_version
+                FROM plans CROSS JOIN ({CATALOG_VERSION_QUERY}) v
+                ORDER BY price ASC
+            """)
+            version = rows[0]['catalog_version'] if rows else ""
+            plans = [{k: v for k, v in dict(row).items() if k != 'catalog_version'} for row in rows]
+            self.snapshot = PlanCatalogSnapshot(version, plans)
+            return self.snapshot
+    
+    async def refresh_if_changed(self) -> bool:
+        """Reload only when the cheap version check disagrees with the snapshot"""
+        version = await db.fetchval(CATALOG_VERSION_QUERY)
+        if self.snapshot is not None and version == self.snapshot.version:
+            return False
+        await self.load()
+        return True
+    
+    def invalidate(self):
+        """Drop the snapshot after writing to plans; the next read reloads it"""
+        self.snapshot = None
+    
+    async def refresh_periodically(self):
+        """Background task that keeps the snapshot in line with Neon"""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                if await self.refresh_if_changed():
+                    print(f"Plan catalog reloaded (version {self.snapshot.version})")
+            except Exception as e:
+                print(f"Plan catalog refresh failed: {e}")
+
+
+plan_catalog = PlanCatalog(settings.plan_catalog_refresh_interval)
 
 
 async def get_all_plans() -> List[Dict]:
     """Get all available subscription plans"""
-    plans = await db.fetch("""
-        SELECT id, name, price, max_tokens, max_requests, created_at
-        FROM plans
-        ORDER BY price ASC
-    """)
-    return [dict(plan) for plan in plans]
+    snapshot = await plan_catalog.get()
+    return [dict(plan) for plan in snapshot.plans]
 
 
 async def get_plan_by_id(plan_id: str) -> Optional[Dict]:
     """Get plan by ID"""
-    plan = await db.fetchrow("""
-        SELECT id, name, price, max_tokens, max_requests, created_at
-        FROM plans
-        WHERE id = $1
-    """, plan_id)
-    
+    snapshot = await plan_catalog.get()
+    plan = snapshot.by_id.get(str(plan_id))
     return dict(plan) if plan else None
 
 
 async def get_plan_by_name(name: str) -> Optional[Dict]:
     """Get plan by name"""
-    plan = await db.fetchrow("""
-        SELECT id, name, price, max_tokens, max_requests, created_at
-        FROM plans
-        WHERE name = $1
-    """, name)
-    
+    snapshot = await plan_catalog.get()
+    plan = snapshot.by_name.get(name)
     return dict(plan) if plan else None
 
 
@@ -42,6 +146,12 @@ async def get_default_plan() -> Dict:
     return plan
 
 
+async def get_plan_comparison() -> Dict[str, Any]:
+    """Precomputed plan comparison"""
+    snapshot = await plan_catalog.get()
+    return snapshot.comparison
+
+
 class PlanLimits:
     """Plan limits and validation"""
     
@@ -0,0 +1,184 @@
+"""
+Statistical sampling profiler for slow requests
+
+While requests are in flight a side thread samples the event loop every
+few milliseconds. The stack of the running task is charged to its request
+as a "running" sample; requests whose tasks are suspended get a "waiting"
+sample built from their coroutine await chain. When a request finishes its
+collapsed-stack profile is kept only if it was slow or picked 1-in-N.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional
+
+from app.core.config import settings
+from app.core.loop_monitor import request_for_task, task_requests
+
+
+def _frame_label(code) -> str:
+    filename = code.co_filename
+    for marker in (f"{os.sep}site-packages{os.sep}", f"{os.sep}knockxprime_ai{os.sep}"):
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+            break
+    # Semicolons separate frames in the collapsed format
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+def collapse_thread_stack(frame) -> str:
+    """Outermost-first collapsed stack of the loop thread, starting at the running task"""
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        # Everything below the handle that stepped the task is loop machinery
+        if code.co_name == "_run" and code.co_filename.endswith(f"asyncio{os.sep}events.py"):
+            break
+        labels.append(_frame_label(code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def collapse_await_chain(coro) -> str:
+    """Collapsed stack of a suspended coroutine and everything it awaits"""
+    labels = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            if isinstance(coro, asyncio.Future):
+                labels.append("<future>")
+            break
+        labels.append(_frame_label(frame.f_code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return ";".join(labels)
+
+
+class RequestProfile:
+    """Samples collected for one request"""
+
+    __slots__ = ("request_id", "started_at", "samples", "method", "route", "duration_ms", "reason")
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started_at = time.time()
+        self.samples: Counter = Counter()
+        self.method = ""
+        self.route = ""
+        self.duration_ms = 0.0
+        self.reason = ""
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "route": self.route,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "reason": self.reason,
+            "samples": sum(self.samples.values()),
+        }
+
+    def collapsed(self) -> str:
+        """Brendan Gregg collapsed format, ready for flamegraph.pl or speedscope"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+
+class SamplingProfiler:
+    """Samples in-flight requests and keeps the profiles worth looking at"""
+
+    def __init__(self, interval_ms: float, slow_threshold_ms: float, sample_every: int, history_size: int):
+        self.interval = interval_ms / 1000
+        self.slow_threshold_ms = slow_threshold_ms
+        self.sample_every = sample_every
+        self.profiles: Deque[RequestProfile] = deque(maxlen=history_size)
+        self._active: Dict[str, RequestProfile] = {}
+        self._finished = 0
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+
+    def begin(self, request_id: str) -> Optional[RequestProfile]:
+        """Start collecting samples for a request; None when profiling is off"""
+        if not settings.profiler_enabled:
+            return None
+        if self._thread is None or not self._thread.is_alive():
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread_id = threading.get_ident()
+            self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+            self._thread.start()
+
+        profile = RequestProfile(request_id)
+        self._active[request_id] = profile
+        self._wake.set()
+        return profile
+
+    def end(self, profile: RequestProfile, method: str, route: str, duration: float):
+        """Stop sampling a request and keep its profile if it qualifies"""
+        self._active.pop(profile.request_id, None)
+        if not self._active:
+            self._wake.clear()
+
+        self._finished += 1
+        profile.method = method
+        profile.route = route
+        profile.duration_ms = round(duration * 1000, 1)
+        if profile.duration_ms >= self.slow_threshold_ms:
+            profile.reason = "slow"
+        elif self.sample_every and self._finished % self.sample_every == 0:
+            profile.reason = "sampled"
+        else:
+            return
+        if profile.samples:
+            self.profiles.append(profile)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            try:
+                self._sample()
+            except RuntimeError:
+                # Task registry changed size while we walked it; skip this tick
+                continue
+
+    def _sample(self):
+        active = dict(self._active)
+        if not active:
+            return
+
+        running_task = asyncio.current_task(self._loop)
+        running_request = request_for_task(running_task)
+
+        # Newest live task per request: later tasks sit deeper in the middleware chain
+        newest_tasks = {}
+        for task, request_id in list(task_requests.items()):
+            if request_id in active and not task.done():
+                newest_tasks[request_id] = task
+
+        for request_id, profile in active.items():
+            if request_id == running_request:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    profile.samples["running;" + collapse_thread_stack(frame)] += 1
+            elif request_id in newest_tasks:
+                stack = collapse_await_chain(newest_tasks[request_id].get_coro())
+                if stack:
+                    profile.samples["waiting;" + stack] += 1
+
+    def recent(self, limit: int) -> List[Dict[str, Any]]:
+        return [profile.summary() for profile in reversed(self.profiles)][:limit]
+
+    def find(self, request_id: str) -> Optional[RequestProfile]:
+        return next((p for p in self.profiles if p.request_id == request_id), None)
+
+
+profiler = SamplingProfiler(
+    interval_ms=settings.profiler_interval_ms,
+    slow_threshold_ms=settings.profiler_slow_threshold_ms,
+    sample_every=settings.profiler_sample_every,
+    history_size=settings.profiler_history
+)
@@ -0,0 +1,243 @@
+"""
+Conversation sessions
+
+A session keeps a conversation's history server-side so clients send only
+the new message each turn. History lives in sessions.session_data (JSONB)
+as a list of turns, each the turn's [role, content] pairs. Turns of at least
+SESSION_COMPRESS_MIN_BYTES are stored zlib-compressed ("z:" + base64) when
+that is smaller than the plain pairs.
+A turn is appended in place with one UPDATE that carries only that turn,
+and the UPDATE is a no-op when the same op id was the last one applied, so
+it can be retried safely.
+
+Decoded sessions are kept in a per-worker hot cache (TTL + LRU). A cached
+copy is used only after a one-column check that the row still exists and
+has not been written since. A session another worker deleted is then a 404
+before any upstream call is made or billed, and one it appended to is
+reloaded. Turns are serialized per session within a worker.
+"""
+import asyncio
+import base64
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.database import db
+from app.core.json_response import dumps
+from app.schemas.chat_schema import ChatMessage, ChatRequest
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+Message = Tuple[str, str]
+
+CREATE_SESSION = """
+    INSERT INTO sessions (user_id, session_data)
+    VALUES ($1, $2::jsonb)
+    RETURNING id, updated_at
+"""
+
+LOAD_SESSION = """
+    SELECT id, session_data, updated_at
+    FROM sessions
+    WHERE id = $1 AND user_id = $2
+"""
+
+# Whether a cached copy is still current, without fetching the history
+CHECK_SESSION = """
+    SELECT updated_at
+    FROM sessions
+    WHERE id = $1 AND user_id = $2
+"""
+
+# $3 is a one-element JSON array holding the new turn
+APPEND_TURN = """
+    UPDATE sessions
+    SET session_data = CASE
+            WHEN session_data->>'op' = $4 THEN session_data
+            ELSE session_data || jsonb_build_object('turns', (session_data->'turns') || $3::jsonb, 'op', $4::text)
+        END,
+        updated_at = NOW()
+    WHERE id = $1 AND user_id = $2
+    RETURNING jsonb_array_length(session_data->'turns') AS turns, updated_at
+"""
+
+DELETE_SESSION = "DELETE FROM sessions WHERE id = $1 AND user_id = $2"
+
+
+def encode_turn(messages: List[Message]) -> Any:
+    """A turn as stored: plain pairs, or compressed when that pays off"""
+    pairs = [[role, content] for role, content in messages]
+    raw = dumps(pairs)
+    if len(raw) >= settings.session_compress_min_bytes:
+        encoded = "z:" + base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+        # Compared as stored: base64 makes the compressed form a third larger
+        if len(encoded) < len(raw):
+            return encoded
+    return pairs
+
+
+def decode_turn(turn: Any) -> List[Message]:
+    if isinstance(turn, str):
+        turn = _loads(zlib.decompress(base64.b64decode(turn[2:])))
+    return [(role, content) for role, content in turn]
+
+
+class Conversation:
+    """A decoded session"""
+
+    def __init__(self, session_id: str, user_id: str, data: Dict[str, Any], updated_at: Any = None):
+        self.id = str(session_id)
+        self.user_id = str(user_id)
+        self.model = data.get('model') or "grok-beta"
+        self.system = data.get('system')
+        self.max_tokens = data.get('max_tokens') or 1000
+        self.temperature = data['temperature'] if data.get('temperature') is not None else 0.7
+        self.messages: List[Message] = [message for turn in data.get('turns') or () for message in decode_turn(turn)]
+        self.turns = len(data.get('turns') or ())
+        self.updated_at = updated_at
+
+    def chat_request(self, content: str, max_tokens: Optional[int] = None,
+                     temperature: Optional[float] = None) -> ChatRequest:
+        """Upstream request for the next turn: system prompt, recent history, new message"""
+        limit = settings.session_max_context_messages
+        messages = [("system", self.system)] if self.system else []
+        messages += self.messages[-limit:] if limit > 0 else self.messages
+        messages.append(("user", content))
+        # Stored messages were validated on the way in
+        return ChatRequest.model_construct(
+            messages=[ChatMessage.model_construct(role=role, content=text) for role, text in messages],
+            model=self.model,
+            max_tokens=max_tokens or self.max_tokens,
+            temperature=self.temperature if temperature is None else temperature,
+            stream=False
+        )
+
+    def view(self, include_messages: bool = False) -> Dict[str, Any]:
+        view = {
+            "id": self.id,
+            "model": self.model,
+            "system": self.system,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "message_count": len(self.messages),
+            "updated_at": self.updated_at,
+        }
+        if include_messages:
+            view["messages"] = [{"role": role, "content": content} for role, content in self.messages]
+        return view
+
+
+def _session_data(value: Any) -> Dict[str, Any]:
+    """JSONB arrives parsed from the Neon REST API, or as text from other drivers"""
+    if isinstance(value, (str, bytes)):
+        return _loads(value)
+    return value or {}
+
+
+class SessionStore:
+    """Sessions in Neon with a per-worker hot cache of decoded conversations"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._hot: "OrderedDict[str, Tuple[float, Conversation]]" = OrderedDict()
+        # Kept apart from the cache, which may be off or have dropped the session mid-turn
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        """The lock turns of a session take in this worker; dropped once no turn holds it"""
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        return lock
+
+    def _cache(self, conversation: Conversation):
+        if self.ttl <= 0:
+            return
+        self._hot[conversation.id] = (time.monotonic() + self.ttl, conversation)
+        self._hot.move_to_end(conversation.id)
+        while len(self._hot) > self.max_entries:
+            self._hot.popitem(last=False)
+
+    async def create(self, user_id: str, model: Optional[str], system: Optional[str],
+                     max_tokens: Optional[int], temperature: Optional[float],
+                     messages: List[Message]) -> Conversation:
+        data = {
+            "v": 1,
+            "model": model,
+            "system": system,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "turns": [encode_turn(messages)] if messages else [],
+        }
+        row = await db.fetchrow(CREATE_SESSION, user_id, dumps(data).decode())
+        conversation = Conversation(row['id'], user_id, data, row.get('updated_at'))
+        self._cache(conversation)
+        return conversation
+
+    async def get(self, user_id: str, session_id: str) -> Optional[Conversation]:
+        """The user's session, from the hot cache while current; None when missing or not theirs"""
+        entry = self._hot.get(session_id)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._hot[session_id]
+            entry = None
+        if entry is not None and entry[1].user_id != str(user_id):
+            metrics.record_cache("session", False)
+            return None
+        if entry is not None:
+            row = await db.fetchrow(CHECK_SESSION, session_id, user_id)
+            if not row:
+                # Deleted, possibly by another worker
+                metrics.record_cache("session", False)
+                self._hot.pop(session_id, None)
+                return None
+            if row.get('updated_at') == entry[1].updated_at:
+                metrics.record_cache("session", True)
+                self._hot.move_to_end(session_id)
+                return entry[1]
+            # Written by another worker since it was cached
+            self._hot.pop(session_id, None)
+        metrics.record_cache("session", False)
+
+        row = await db.fetchrow(LOAD_SESSION, session_id, user_id)
+        if not row:
+            return None
+        conversation = Conversation(row['id'], user_id, _session_data(row['session_data']), row.get('updated_at'))
+        self._cache(conversation)
+        return conversation
+
+    async def append(self, conversation: Conversation, messages: List[Message], op_id: str) -> bool:
+        """Append one turn, sending only that turn; False if the session is gone"""
+        row = await db.fetchrow(
+            APPEND_TURN, conversation.id, conversation.user_id, dumps([encode_turn(messages)]).decode(), op_id,
+            idempotent=True
+        )
+        if not row:
+            self._hot.pop(conversation.id, None)
+            return False
+        conversation.messages.extend(messages)
+        conversation.turns += 1
+        conversation.updated_at = row.get('updated_at')
+        if int(row['turns']) != conversation.turns:
+            # Another worker appended too: reload the whole history next time
+            self._hot.pop(conversation.id, None)
+        return True
+
+    async def delete(self, user_id: str, session_id: str) -> bool:
+        """Delete a session; False if it was missing or not theirs"""
+        self._hot.pop(session_id, None)
+        # Not marked idempotent: a retry after an ambiguous failure would find 0 rows and
+        # report a session it had just deleted as missing, so that failure is raised instead
+        return await db.execute(DELETE_SESSION, session_id, user_id) > 0
+
+
+session_store = SessionStore(settings.session_cache_ttl, settings.session_cache_max_entries)
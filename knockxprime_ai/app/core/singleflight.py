@@ -0,0 +1,64 @@
+"""
+Single-flight call coalescing
+
+Concurrent callers asking for the same key share one in-flight call and all
+receive its result (or its exception). Nothing is cached: once the call
+finishes, the next caller with that key issues a new one. The shared call
+runs in its own task, so one caller going away does not fail the others; it
+is cancelled only when every caller waiting on it has gone.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+from app.core import metrics
+
+
+class _Call:
+    __slots__ = ("task", "version", "waiters")
+
+    def __init__(self, task: asyncio.Task, version: int):
+        self.task = task
+        self.version = version
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Group of coalesced calls; name labels the metrics"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]],
+                 version: int = 0, min_version: int = 0) -> Tuple[Any, bool]:
+        """Result of fn(), shared with concurrent callers of the same key, and whether it was shared
+
+        A call started at a version below min_version is not joined; a new one
+        is issued and replaces it for later callers.
+        """
+        call = self._calls.get(key)
+        shared = call is not None and call.version >= min_version
+        if shared:
+            metrics.singleflight_calls.inc(group=self.name, result="coalesced")
+        else:
+            metrics.singleflight_calls.inc(group=self.name, result="issued")
+            call = _Call(asyncio.ensure_future(fn()), version)
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _, key=key, call=call: self._forget(key, call))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), shared
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def _forget(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Retrieve the exception so an abandoned call does not log "never retrieved"
+        if not call.task.cancelled():
+            call.task.exception()
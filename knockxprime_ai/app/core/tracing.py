@@ -0,0 +1,297 @@
+"""
+Minimal in-process tracing
+
+Spans nest through a contextvar, are sampled per trace and, once the root
+span ends, the whole trace is exported as OTLP/JSON to an in-memory ring
+buffer (served by the admin API) and optionally appended to a file.
+"""
+import functools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional
+
+from app.core.config import settings
+
+SERVICE_NAME = "knockxprime-ai"
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+# OTLP status codes
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class _Trace:
+    """Spans of one trace collected until the root span ends"""
+
+    __slots__ = ("trace_id", "sampled", "spans", "closed")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: List["Span"] = []
+        self.closed = False
+
+
+class Span:
+    """A timed operation with attributes and a parent"""
+
+    __slots__ = ("trace", "span_id", "parent_span_id", "local_root", "name", "kind", "attributes",
+                 "start_ns", "end_ns", "status_code", "status_message", "_token")
+
+    def __init__(self, trace: _Trace, name: str, parent_span_id: Optional[str] = None,
+                 kind: int = KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None,
+                 local_root: bool = False):
+        self.trace = trace
+        self.local_root = local_root
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes) if attributes and trace.sampled else {}
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.status_code = STATUS_UNSET
+        self.status_message = ""
+        self._token = None
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    @property
+    def sampled(self) -> bool:
+        return self.trace.sampled
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns or time.time_ns()
+        return (end_ns - self.start_ns) / 1_000_000
+
+    def set_attribute(self, key: str, value: Any):
+        if self.trace.sampled:
+            self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        self.status_code = STATUS_ERROR
+        self.status_message = f"{type(error).__name__}: {error}"[:300]
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if self.status_code == STATUS_UNSET and self.trace.sampled:
+            self.status_code = STATUS_OK
+        tracer.on_end(self)
+
+    def __enter__(self) -> "Span":
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.record_error(exc)
+        current_span.reset(self._token)
+        self.end()
+        return False
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or self.start_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": self.status_code},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class TraceIdRatioSampler:
+    """Sample a fixed fraction of new traces; children follow their parent"""
+
+    def __init__(self, rate: float):
+        self.rate = max(0.0, min(1.0, rate))
+
+    def should_sample(self) -> bool:
+        return self.rate >= 1.0 or (self.rate > 0.0 and random.random() < self.rate)
+
+
+def otlp_payload(spans: List[Span]) -> Dict[str, Any]:
+    """Wrap spans in an OTLP ExportTraceServiceRequest body"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [
+                _otlp_attribute("service.name", SERVICE_NAME),
+                _otlp_attribute("process.pid", os.getpid()),
+            ]},
+            "scopeSpans": [{
+                "scope": {"name": "app.core.tracing"},
+                "spans": [span.to_otlp() for span in spans],
+            }],
+        }]
+    }
+
+
+class RingBufferExporter:
+    """Keeps the most recent traces in memory for the admin API"""
+
+    def __init__(self, size: int):
+        self.traces: Deque[Dict[str, Any]] = deque(maxlen=size)
+
+    def export(self, spans: List[Span]):
+        root = spans[-1]
+        self.traces.append({
+            "trace_id": root.trace_id,
+            "name": root.name,
+            "duration_ms": round(root.duration_ms, 2),
+            "span_count": len(spans),
+            "spans": spans,
+        })
+
+    def recent(self, limit: int, min_duration_ms: float = 0.0) -> List[Dict[str, Any]]:
+        matching = [t for t in reversed(self.traces) if t["duration_ms"] >= min_duration_ms]
+        return matching[:limit]
+
+    def find(self, trace_id: str) -> Optional[Dict[str, Any]]:
+        return next((t for t in self.traces if t["trace_id"] == trace_id), None)
+
+
+class FileExporter:
+    """Appends one OTLP/JSON document per trace to a file from a writer thread"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: "queue.SimpleQueue[str]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self, spans: List[Span]):
+        # Started lazily so gunicorn workers forked from a preloaded master get their own thread
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._write_loop, name="trace-file-exporter", daemon=True)
+            self._thread.start()
+        # Serialized on the loop, written off it
+        self._queue.put(json.dumps(otlp_payload(spans)))
+
+    def _write_loop(self):
+        while True:
+            line = self._queue.get()
+            try:
+                with open(self.path, "a") as trace_file:
+                    trace_file.write(line + "\n")
+            except OSError as e:
+                print(f"Trace export failed: {e}")
+
+
+class Tracer:
+    """Creates spans and hands finished traces to the exporters"""
+
+    def __init__(self):
+        self.sampler = TraceIdRatioSampler(settings.trace_sample_rate)
+        self.ring_buffer = RingBufferExporter(settings.trace_buffer_size)
+        self.exporters = [self.ring_buffer]
+        if settings.trace_export_file:
+            self.exporters.append(FileExporter(settings.trace_export_file))
+
+    def start_span(self, name: str, kind: int = KIND_INTERNAL,
+                   attributes: Optional[Dict[str, Any]] = None,
+                   traceparent: Optional[str] = None) -> Span:
+        """Start a span under the current one; use it as a context manager to make it current"""
+        parent = current_span.get()
+        if parent is not None:
+            return Span(parent.trace, name, parent.span_id, kind, attributes)
+
+        remote = parse_traceparent(traceparent) if traceparent else None
+        if remote:
+            trace_id, parent_span_id, sampled = remote
+        else:
+            trace_id, parent_span_id, sampled = os.urandom(16).hex(), None, self.sampler.should_sample()
+        trace = _Trace(trace_id, sampled and settings.tracing_enabled)
+        return Span(trace, name, parent_span_id, kind, attributes, local_root=True)
+
+    def on_end(self, span: Span):
+        trace = span.trace
+        if not trace.sampled:
+            return
+        trace.spans.append(span)
+        # Spans that end after their trace was exported go out on their own
+        if trace.closed:
+            self._export([span])
+        elif span.local_root:
+            trace.closed = True
+            self._export(trace.spans)
+
+    def _export(self, spans: List[Span]):
+        for exporter in self.exporters:
+            try:
+                exporter.export(spans)
+            except Exception as e:
+                print(f"Trace exporter {type(exporter).__name__} failed: {e}")
+
+
+def parse_traceparent(header: str):
+    """Parse a W3C traceparent header into (trace_id, parent_span_id, sampled)"""
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return parts[1], parts[2], sampled
+
+
+def format_traceparent(span: Span) -> str:
+    return f"00-{span.trace_id}-{span.span_id}-{'01' if span.sampled else '00'}"
+
+
+tracer = Tracer()
+
+
+def traced(name: str, kind: int = KIND_INTERNAL):
+    """Run an async function inside a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.start_span(name, kind):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_attribute(key: str, value: Any):
+    """Set an attribute on the current span, if any"""
+    span = current_span.get()
+    if span is not None:
+        span.set_attribute(key, value)
@@ -0,0 +1,63 @@
+"""
+Per-user usage snapshot cache
+
+Usage rows are cached per worker for a few seconds, keyed by user and day.
+The billing path writes fresh rows through after every update, so a user
+always sees their own requests; writes made on other workers show up once
+the entry expires.
+"""
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, Optional, Tuple
+from app.core.config import settings
+from app.core import metrics
+
+
+class UsageSnapshotCache:
+    """TTL + LRU cache of usage rows keyed by (user_id, day)"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, date], Tuple[float, Dict]]" = OrderedDict()
+
+    def get(self, user_id: str, day: date) -> Optional[Dict]:
+        """Copy of a fresh snapshot, or None"""
+        key = (str(user_id), day)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            entry = None
+        metrics.record_cache("usage_snapshot", entry is not None)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return dict(entry[1])
+
+    def put(self, user_id: str, day: date, row: Dict):
+        if self.ttl <= 0:
+            return
+        key = (str(user_id), day)
+        # Counters only grow within a day (resets invalidate), so a row with lower
+        # counts than the cached one is from a query that finished out of order
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] >= time.monotonic() and self._counts(entry[1]) > self._counts(row):
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, dict(row))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _counts(row: Dict) -> Tuple[int, int]:
+        return row.get('requests', 0), row.get('tokens_used', 0)
+
+    def invalidate(self, user_id: str):
+        """Forget every snapshot of a user, e.g. after a plan change or reset"""
+        user_id = str(user_id)
+        for key in [key for key in self._entries if key[0] == user_id]:
+            del self._entries[key]
+
+
+usage_cache = UsageSnapshotCache(settings.usage_cache_ttl, settings.usage_cache_max_entries)
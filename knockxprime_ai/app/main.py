@@ -2,15 +2,26 @@ from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
+import asyncio
 from contextlib import asynccontextmanager
 
 from app.core.config import settings
 from app.core.database import init_db
-from app.api.v1 import chat, users, usage, plans, admin
+from app.api.v1 import chat, users, usage, plans, admin, jobs, sessions
 from app.core.keep_alive import router as keep_alive_router
+from app.core import metrics
+from app.core.loop_monitor import loop_monitor
+from app.core.plans import plan_catalog
+from app.core.json_response import FastJSONResponse
+from app.core.job_store import job_store
+from app.services.job_runner import JobRunner
+from app.services.billing_guard import billing_guard
 from app.middleware.rate_limiting import RateLimitMiddleware
 from app.middleware.logging import RequestLoggingMiddleware
 from app.middleware.security import SecurityHeadersMiddleware
+from app.middleware.metrics import MetricsMiddleware
+from app.middleware.compression import CompressionMiddleware
+from app.middleware.deadline import DeadlineMiddleware
 from app.middleware.cors import add_cors_middleware
 
 
@@ -20,7 +31,31 @@ async def lifespan(app: FastAPI):
     print("🚀 Starting KnockXPrime AI Backend...")
     await init_db()
     print("✅ Database initialized")
+    await plan_catalog.load()
+    # Runs in each worker after the fork, unlike module imports under preload_app
+    metrics.mark_process_start()
+    
+    background_tasks = [asyncio.create_task(plan_catalog.refresh_periodically())]
+    if settings.loop_monitor_enabled:
+        loop_monitor.start()
+    if settings.metrics_enabled and settings.metrics_multiproc_dir:
+        background_tasks.append(asyncio.create_task(metrics.flush_snapshots_periodically()))
+    job_runner = job_runner_task = None
+    if settings.job_worker_in_web:
+        job_runner = JobRunner(job_store, settings.job_worker_concurrency, settings.job_poll_interval)
+        job_runner_task = asyncio.create_task(job_runner.run())
+    
     yield
+    
+    loop_monitor.stop()
+    for task in background_tasks:
+        task.cancel()
+    if job_runner:
+        # Cancelling run() would cut short the refunds of the chunks it hands back
+        job_runner.stop()
+        await job_runner_task
+    # Usage written after responses went out must still land
+    await billing_guard.drain()
     print("👋 Shutting down KnockXPrime AI Backend...")
 
 
@@ -29,26 +64,48 @@ app = FastAPI(
     description="AI-powered chat service with subscription management",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=FastJSONResponse,
     docs_url="/docs" if settings.environment == "development" else None,
     redoc_url="/redoc" if settings.environment == "development" else None,
 )
 
+# Request deadlines and disconnect cancellation (innermost, so it wraps only the app)
+app.add_middleware(DeadlineMiddleware)
+
 # Add security middleware
 app.add_middleware(SecurityHeadersMiddleware)
 
 # Add request logging
 app.add_middleware(RequestLoggingMiddleware)
 
+# Add request metrics
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+
 # Add rate limiting
 app.add_middleware(RateLimitMiddleware, calls_per_minute=settings.rate_limit_requests)
 
+# Add response compression
+if settings.compression_enabled:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=settings.compression_minimum_size,
+        gzip_level=settings.compression_gzip_level,
+        brotli_quality=settings.compression_brotli_quality,
+        zstd_level=settings.compression_zstd_level
+    )
+
 # Add CORS middleware
 app = add_cors_middleware(app)
 
 # Include routers
 app.include_router(keep_alive_router, prefix="/health", tags=["health"])
+if settings.metrics_enabled:
+    app.include_router(metrics.router, tags=["metrics"])
 app.include_router(users.router, prefix="/api/v1/users", tags=["users"])
 app.include_router(chat.router, prefix="/api/v1/chat", tags=["chat"])
+app.include_router(jobs.router, prefix="/api/v1/jobs", tags=["jobs"])
+app.include_router(sessions.router, prefix="/api/v1/sessions", tags=["sessions"])
 app.include_router(usage.router, prefix="/api/v1/usage", tags=["usage"])
 app.include_router(plans.router, prefix="/api/v1/plans", tags=["plans"])
 app.include_router(admin.router, prefix="/api/v1/admin", tags=["admin"])
@@ -76,6 +133,8 @@ async def api_info():
             "health": "/health",
             "users": "/api/v1/users",
             "chat": "/api/v1/chat",
+            "jobs": "/api/v1/jobs",
+            "sessions": "/api/v1/sessions",
             "usage": "/api/v1/usage",
             "plans": "/api/v1/plans",
             "admin": "/api/v1/admin"
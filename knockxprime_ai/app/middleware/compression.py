@@ -0,0 +1,252 @@
+"""
+Response compression middleware
+
+Pure ASGI (no BaseHTTPMiddleware) so streamed bodies, including SSE, are
+compressed chunk by chunk instead of being buffered.
+"""
+import time
+import zlib
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core import metrics
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STREAMING_TYPES = ("text/event-stream", "application/x-ndjson")
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/x-ndjson",
+    "application/xml",
+    "image/svg+xml",
+}
+
+
+class GzipCompressor:
+    encoding = "gzip"
+
+    def __init__(self, level: int):
+        # wbits 31: deflate with a gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, flush: bool) -> bytes:
+        out = self._compressor.compress(data)
+        if flush:
+            out += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return out
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    encoding = "br"
+
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes, flush: bool) -> bytes:
+        out = self._compressor.process(data)
+        if flush:
+            out += self._compressor.flush()
+        return out
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    encoding = "zstd"
+
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes, flush: bool) -> bytes:
+        out = self._compressor.compress(data)
+        if flush:
+            out += self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return out
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Map each coding in Accept-Encoding to its q-value"""
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def is_compressible(content_type: str) -> bool:
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return (
+        media_type.startswith("text/")
+        or media_type in COMPRESSIBLE_TYPES
+        or media_type.endswith(("+json", "+xml"))
+    )
+
+
+class CompressionMiddleware:
+    """Negotiate zstd, brotli or gzip and compress eligible response bodies"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 5,
+                 brotli_quality: int = 4, zstd_level: int = 3):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.factories = {"gzip": lambda: GzipCompressor(gzip_level)}
+        if brotli is not None:
+            self.factories["br"] = lambda: BrotliCompressor(brotli_quality)
+        if zstandard is not None:
+            self.factories["zstd"] = lambda: ZstdCompressor(zstd_level)
+
+    def choose_encoding(self, header: str) -> Optional[str]:
+        """Best encoding the client accepts; ties go to the cheaper-to-decode, better-ratio codings"""
+        accepted = parse_accept_encoding(header)
+        wildcard = accepted.get("*", 0.0)
+        best, best_quality = None, 0.0
+        for encoding in ("zstd", "br", "gzip"):
+            if encoding not in self.factories:
+                continue
+            quality = accepted.get(encoding, wildcard)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self.choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _CompressionResponder(send, encoding, self.factories[encoding], self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressionResponder:
+    """Holds the start message until the first body chunk shows whether to compress"""
+
+    def __init__(self, send: Send, encoding: str, factory, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.factory = factory
+        self.minimum_size = minimum_size
+        self.start_message: Optional[Message] = None
+        self.compressor = None
+        self.passthrough = False
+        self.flush_each_chunk = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+
+    async def send(self, message: Message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        first_chunk = self.compressor is None
+        if first_chunk:
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            reason = self._skip_reason(headers, body, more_body)
+            if reason is not None:
+                self.passthrough = True
+                if reason != "not_eligible":
+                    metrics.compression_skipped.inc(reason=reason)
+                if reason == "too_small":
+                    # A larger body at the same URL would be compressed
+                    headers.add_vary_header("Accept-Encoding")
+                await self._send(self.start_message)
+                await self._send(message)
+                return
+            self._start(headers)
+
+        compressed = self._compress(body, more_body)
+        if first_chunk:
+            if not more_body:
+                headers["Content-Length"] = str(len(compressed))
+            await self._send(self.start_message)
+        if not more_body:
+            self._record()
+        await self._send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+    def _skip_reason(self, headers: MutableHeaders, body: bytes, more_body: bool) -> Optional[str]:
+        if self.start_message["status"] < 200 or self.start_message["status"] in (204, 304):
+            return "not_eligible"
+        if "content-encoding" in headers:
+            return "already_encoded"
+        if not is_compressible(headers.get("content-type", "")):
+            return "content_type"
+        if not more_body:
+            size = len(body)
+        else:
+            size = int(headers.get("content-length", self.minimum_size))
+        if size < self.minimum_size:
+            return "too_small"
+        return None
+
+    def _start(self, headers: MutableHeaders):
+        self.compressor = self.factory()
+        # Events and NDJSON lines must reach the client as they happen, not when a block fills up
+        self.flush_each_chunk = headers.get("content-type", "").startswith(STREAMING_TYPES)
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        if "content-length" in headers:
+            del headers["content-length"]
+        # The compressed bytes are a different representation of the same resource
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = f"W/{etag}"
+
+    def _compress(self, body: bytes, more_body: bool) -> bytes:
+        started = time.perf_counter()
+        out = self.compressor.compress(body, flush=more_body and self.flush_each_chunk)
+        if not more_body:
+            out += self.compressor.finish()
+        self.compress_time += time.perf_counter() - started
+        self.bytes_in += len(body)
+        self.bytes_out += len(out)
+        return out
+
+    def _record(self):
+        metrics.compression_duration.observe(self.compress_time, encoding=self.encoding)
+        metrics.compression_bytes.inc(self.bytes_in, encoding=self.encoding, stage="uncompressed")
+        metrics.compression_bytes.inc(self.bytes_out, encoding=self.encoding, stage="compressed")
+        if self.bytes_out:
+            metrics.compression_ratio.observe(self.bytes_in / self.bytes_out, encoding=self.encoding)
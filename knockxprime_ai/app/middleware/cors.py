@@ -38,6 +38,8 @@ def add_cors_middleware(app: FastAPI) -> FastAPI:
             "Authorization",
             "X-Requested-With",
             "X-Request-ID",
+            "Idempotency-Key",
+            "X-Request-Timeout",
             "Cache-Control"
         ],
         expose_headers=[
@@ -45,7 +47,8 @@ def add_cors_middleware(app: FastAPI) -> FastAPI:
             "X-Process-Time",
             "X-RateLimit-Limit",
             "X-RateLimit-Remaining",
-            "X-RateLimit-Reset"
+            "X-RateLimit-Reset",
+            "Idempotent-Replayed"
         ],
         max_age=600  # 10 minutes
     )
@@ -0,0 +1,91 @@
+"""
+Request deadline and client disconnect middleware
+
+Pure ASGI (no BaseHTTPMiddleware): it sets the request's deadline before the
+app runs and owns the receive channel, so it notices a client that goes away
+while the handler is still working. The handler is then cancelled, which
+stops its Neon and upstream calls, and the request is logged as 499.
+Work that must outlive the client (batch settlement, keyed idempotent calls)
+runs in tasks of its own and is not affected.
+"""
+import asyncio
+from typing import Optional
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core import deadline, metrics
+
+CLIENT_CLOSED_REQUEST = 499
+
+
+class DeadlineMiddleware:
+    """Give each request a deadline and cancel it when the client disconnects"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = deadline.deadline_var.set(deadline.from_header(Headers(scope=scope).get(deadline.HEADER)))
+        try:
+            await _Watcher(self.app, scope, receive, send).run()
+        finally:
+            deadline.deadline_var.reset(token)
+
+
+class _Watcher:
+    """Runs the app as a task while reading the client's messages on its behalf"""
+
+    def __init__(self, app: ASGIApp, scope: Scope, receive: Receive, send: Send):
+        self.app = app
+        self.scope = scope
+        self._receive = receive
+        self._send = send
+        self.messages: asyncio.Queue = asyncio.Queue()
+        self.response_started = False
+        self.response_complete = False
+        self.disconnected = False
+        self.handler: Optional[asyncio.Task] = None
+
+    async def receive(self) -> Message:
+        return await self.messages.get()
+
+    async def send(self, message: Message):
+        if message["type"] == "http.response.start":
+            self.response_started = True
+        elif message["type"] == "http.response.body" and not message.get("more_body", False):
+            self.response_complete = True
+        await self._send(message)
+
+    async def _pump(self):
+        while True:
+            message = await self._receive()
+            await self.messages.put(message)
+            if message["type"] == "http.disconnect":
+                if not self.response_complete:
+                    self.disconnected = True
+                    metrics.client_disconnects.inc()
+                    self.handler.cancel()
+                return
+
+    async def run(self):
+        self.handler = asyncio.create_task(self.app(self.scope, self.receive, self.send))
+        pump = asyncio.create_task(self._pump())
+        try:
+            await self.handler
+        except asyncio.CancelledError:
+            if not self.disconnected or asyncio.current_task().cancelling():
+                raise
+            if not self.response_started:
+                # Nobody will read it; it only gives the outer middleware a status to log
+                await self._send({"type": "http.response.start", "status": CLIENT_CLOSED_REQUEST, "headers": []})
+                await self._send({"type": "http.response.body", "body": b""})
+        finally:
+            pump.cancel()
+            if not self.handler.done():
+                self.handler.cancel()
+                await asyncio.gather(self.handler, return_exceptions=True)
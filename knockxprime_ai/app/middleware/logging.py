@@ -3,9 +3,15 @@ Request logging middleware
 """
 from fastapi import Request
 from starlette.middleware.base import BaseHTTPMiddleware
+import sys
 import time
 import json
 import uuid
+from app.core.config import settings
+from app.core.database import QueryTracker, query_tracker
+from app.core.tracing import tracer, KIND_SERVER
+from app.core.loop_monitor import request_id_var, register_current_task, unregister_current_task
+from app.core.profiler import profiler
 
 
 class RequestLoggingMiddleware(BaseHTTPMiddleware):
@@ -16,8 +22,29 @@ class RequestLoggingMiddleware(BaseHTTPMiddleware):
         request_id = getattr(request.state, 'request_id', str(uuid.uuid4()))
         request.state.request_id = request_id
         
+        # Let the loop monitor attribute stalls to this request
+        request_id_token = request_id_var.set(request_id)
+        register_current_task(request_id)
+        
         start_time = time.time()
         
+        # Count Neon queries issued on behalf of this request
+        tracker = QueryTracker(request.scope)
+        request.state.query_tracker = tracker
+        tracker_token = query_tracker.set(tracker)
+        
+        # Root span for the request; renamed to the route template once routing is done
+        span = tracer.start_span(
+            f"{request.method} {request.url.path}",
+            KIND_SERVER,
+            {"http.method": request.method, "http.target": request.url.path, "request.id": request_id},
+            traceparent=request.headers.get("traceparent")
+        )
+        span.__enter__()
+        
+        # Collect stack samples while the request is in flight (no-op unless enabled)
+        profile = profiler.begin(request_id)
+        
         # Get client information
         client_ip = self.get_client_ip(request)
         user_agent = request.headers.get("user-agent", "unknown")
@@ -30,7 +57,8 @@ class RequestLoggingMiddleware(BaseHTTPMiddleware):
             "path": request.url.path,
             "client_ip": client_ip,
             "user_agent": user_agent,
-            "timestamp": time.time()
+            "timestamp": time.time(),
+            "trace_id": span.trace_id
         }
         
         # Process request
@@ -45,12 +73,17 @@ class RequestLoggingMiddleware(BaseHTTPMiddleware):
                 **request_info,
                 "status_code": response.status_code,
                 "process_time": round(process_time, 3),
-                "response_size": response.headers.get("content-length", "unknown")
+                "response_size": response.headers.get("content-length", "unknown"),
+                **tracker.summary()
             }
             
             # Add headers
             response.headers["X-Request-ID"] = request_id
             response.headers["X-Process-Time"] = str(process_time)
+            response.headers["Server-Timing"] = f"{tracker.server_timing()}, total;dur={process_time * 1000:.1f}"
+            if span.sampled:
+                response.headers["X-Trace-ID"] = span.trace_id
+            span.set_attribute("http.status_code", response.status_code)
             
             # Log to console (in production, use proper logging)
             self.log_request(response_info)
@@ -62,10 +95,24 @@ class RequestLoggingMiddleware(BaseHTTPMiddleware):
             error_info = {
                 **request_info,
                 "error": str(e),
-                "process_time": round(time.time() - start_time, 3)
+                "process_time": round(time.time() - start_time, 3),
+                **tracker.summary()
             }
             self.log_error(error_info)
             raise
+        
+        finally:
+            route = request.scope.get("route")
+            if route is not None:
+                span.name = f"{request.method} {route.path}"
+                span.set_attribute("http.route", route.path)
+            span.set_attribute("db.queries", tracker.queries)
+            if profile is not None:
+                profiler.end(profile, request.method, route.path if route is not None else request.url.path, time.time() - start_time)
+            span.__exit__(*sys.exc_info())
+            query_tracker.reset(tracker_token)
+            unregister_current_task()
+            request_id_var.reset(request_id_token)
     
     def get_client_ip(self, request: Request) -> str:
         """Extract real client IP from headers"""
@@ -83,7 +130,20 @@ class RequestLoggingMiddleware(BaseHTTPMiddleware):
     
     def log_request(self, info: dict):
         """Log successful request"""
-        print(f"[REQUEST] {info['client_ip']} - {info['method']} {info['path']} - {info['status_code']} - {info['process_time']}s")
+        print(f"[REQUEST] {info['client_ip']} - {info['method']} {info['path']} - {info['status_code']} - {info['process_time']}s - db={info['db_queries']}q/{info['db_time_ms']}ms")
+        self.log_query_findings(info)
+    
+    def log_query_findings(self, info: dict):
+        """Flag query budget overruns and statements repeated within one request"""
+        if settings.db_query_budget_mode == "off":
+            return
+        
+        budget = info.get('db_query_budget')
+        if budget is not None and info['db_queries'] > budget:
+            print(f"[DB BUDGET] {info['method']} {info['path']} issued {info['db_queries']} queries (budget {budget}) - request_id={info['request_id']}")
+        
+        for repeated in info.get('db_repeated_statements', []):
+            print(f"[DB N+1] {info['method']} {info['path']} ran {repeated['count']}x: {repeated['statement']} - request_id={info['request_id']}")
     
     def log_error(self, info: dict):
         """Log error request"""
@@ -0,0 +1,42 @@
+"""
+Request metrics middleware
+"""
+from fastapi import Request
+from starlette.middleware.base import BaseHTTPMiddleware
+import time
+
+from app.core import metrics
+
+
+class MetricsMiddleware(BaseHTTPMiddleware):
+    """Record per-route latency and Neon round trips for every request"""
+    
+    async def dispatch(self, request: Request, call_next):
+        # Scrapes and health checks would only add noise
+        if request.url.path == "/metrics" or request.url.path.startswith("/health"):
+            return await call_next(request)
+        
+        metrics.http_requests_in_flight.inc()
+        start_time = time.perf_counter()
+        status_code = 500
+        
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            return response
+        finally:
+            duration = time.perf_counter() - start_time
+            route = request.scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            
+            metrics.http_requests_in_flight.dec()
+            metrics.http_request_duration.observe(
+                duration, method=request.method, route=route_path, status=status_code
+            )
+            
+            # Set by the request logging middleware further in
+            tracker = getattr(request.state, "query_tracker", None)
+            if tracker is not None:
+                metrics.db_queries_per_request.observe(tracker.queries, route=route_path)
+                if tracker.over_budget:
+                    metrics.db_query_budget_exceeded.inc(route=route_path)
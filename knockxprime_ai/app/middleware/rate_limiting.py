@@ -1,11 +1,13 @@
 """
 Rate limiting middleware
 """
-from fastapi import Request, HTTPException, status
+from fastapi import Request, status
+from fastapi.responses import JSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 import time
 from collections import defaultdict, deque
 from typing import Dict, Deque
+from app.core import metrics
 
 
 class RateLimitMiddleware(BaseHTTPMiddleware):
@@ -49,20 +51,25 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
         return False
     
     async def dispatch(self, request: Request, call_next):
-        # Skip rate limiting for health checks
-        if request.url.path.startswith("/health"):
+        # Skip rate limiting for health checks and metrics scrapes
+        if request.url.path.startswith("/health") or request.url.path == "/metrics":
             return await call_next(request)
         
         client_id = self.get_client_id(request)
         
         if self.is_rate_limited(client_id):
-            raise HTTPException(
+            metrics.rate_limit_rejections.inc(limiter="ip")
+            # Raising HTTPException from middleware bypasses FastAPI's handlers and becomes a 500
+            return JSONResponse(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail={
-                    "error": "Rate limit exceeded",
-                    "message": f"Maximum {self.calls_per_minute} requests per minute allowed",
-                    "retry_after": 60
-                }
+                content={
+                    "detail": {
+                        "error": "Rate limit exceeded",
+                        "message": f"Maximum {self.calls_per_minute} requests per minute allowed",
+                        "retry_after": 60
+                    }
+                },
+                headers={"Retry-After": "60"}
             )
         
         response = await call_next(request)
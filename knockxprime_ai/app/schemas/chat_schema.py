@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uuid
 
@@ -14,6 +14,34 @@ class ChatRequest(BaseModel):
     max_tokens: Optional[int] = 1000
     temperature: Optional[float] = 0.7
     stream: Optional[bool] = False
+    
+    @property
+    def content_chars(self) -> int:
+        return sum(len(msg.content) for msg in self.messages)
+
+
+class ChatBatchRequest(BaseModel):
+    requests: List[ChatRequest] = Field(..., min_length=1)
+    max_concurrency: Optional[int] = Field(None, ge=1)
+
+
+class ChatJobRequest(BaseModel):
+    requests: List[ChatRequest] = Field(..., min_length=1)
+
+
+class ChatSessionCreate(BaseModel):
+    system: Optional[str] = None
+    model: Optional[str] = "grok-beta"
+    max_tokens: Optional[int] = 1000
+    temperature: Optional[float] = 0.7
+    # Earlier history, e.g. a conversation moved over from /chat/completions
+    messages: List[ChatMessage] = []
+
+
+class ChatSessionMessage(BaseModel):
+    content: str = Field(..., min_length=1)
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
 
 
 class ChatResponse(BaseModel):
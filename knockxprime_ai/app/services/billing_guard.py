@@ -1,19 +1,34 @@
+import asyncio
+import contextvars
+from datetime import date
 from fastapi import HTTPException, status
-from typing import Dict, Any
+from typing import Coroutine, Dict, Any, List, Optional, Set, Union
+from app.core import deadline
+from app.core.admission import plan_priority
+from app.core.config import settings
 from app.core.daily_usage import daily_usage_service
+from app.core.usage_cache import usage_cache
 from app.services.grok_service import grok_service
 from app.schemas.chat_schema import ChatRequest
+from app.services.chat_passthrough import RawChatRequest
+from app.core import metrics
+from app.core.tracing import traced, set_attribute
+
+# Usage writes running in tasks of their own (see write_detached)
+_pending_writes: Set[asyncio.Task] = set()
 
 
 class BillingGuard:
     """Enforce subscription plan limits and billing rules"""
     
     @staticmethod
-    async def validate_request(user: Dict[str, Any], chat_request: ChatRequest) -> Dict[str, Any]:
+    @traced("billing.validate_request")
+    async def validate_request(user: Dict[str, Any], chat_request: Union[ChatRequest, RawChatRequest]) -> Dict[str, Any]:
         """Validate if user can make the request within their plan limits"""
         
         # Estimate tokens for the request
         estimated_tokens = grok_service.calculate_request_tokens(chat_request)
+        set_attribute("billing.estimated_tokens", estimated_tokens)
         
         # Check daily limits (both requests and tokens)
         can_proceed, usage_info = await daily_usage_service.check_daily_limits(
@@ -24,6 +39,7 @@ class BillingGuard:
             limit_type = usage_info.get('limit_type', 'unknown')
             
             if limit_type == 'requests':
+                metrics.rate_limit_rejections.inc(limiter="daily_requests")
                 raise HTTPException(
                     status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                     detail={
@@ -36,6 +52,7 @@ class BillingGuard:
                     }
                 )
             else:
+                metrics.rate_limit_rejections.inc(limiter="daily_tokens")
                 raise HTTPException(
                     status_code=status.HTTP_402_PAYMENT_REQUIRED,
                     detail={
@@ -54,9 +71,145 @@ class BillingGuard:
         }
     
     @staticmethod
-    async def log_usage(user_id: str, actual_tokens: int):
-        """Log actual token usage after successful request"""
-        await daily_usage_service.update_daily_usage(user_id, actual_tokens, 1)
+    def has_headroom(user: Dict[str, Any], chat_request: Union[ChatRequest, RawChatRequest]) -> bool:
+        """Whether a paid user's cached usage is so far from the limits that the quota check
+        can run alongside the upstream call instead of before it"""
+        # Neon returns NUMERIC as text, so a free plan's price is '0.00': compare the number
+        if not settings.speculative_execution_enabled or plan_priority(user) >= 0:
+            return False
+        usage = usage_cache.get(user['id'], date.today())
+        if usage is None:
+            return False
+        share = settings.speculative_max_usage
+        estimated_tokens = grok_service.calculate_request_tokens(chat_request)
+        return (usage['requests'] + 1 <= usage['max_requests'] * share
+                and usage['tokens_used'] + estimated_tokens <= usage['max_tokens'] * share)
+    
+    @staticmethod
+    @traced("billing.reserve_batch")
+    async def reserve_batch(user: Dict[str, Any], chat_requests: List[ChatRequest],
+                            op_id: Optional[str] = None) -> Dict[str, Any]:
+        """Reserve estimated tokens and one request per item for a whole batch, in one statement"""
+        estimates = [grok_service.calculate_request_tokens(chat_request) for chat_request in chat_requests]
+        reserved_tokens = sum(estimates)
+        reserved_requests = len(chat_requests)
+        set_attribute("billing.estimated_tokens", reserved_tokens)
+        
+        reserved, usage = await daily_usage_service.reserve_daily_usage(
+            user['id'], reserved_tokens, reserved_requests, op_id
+        )
+        
+        if not reserved:
+            if usage['requests'] + reserved_requests > usage['max_requests']:
+                metrics.rate_limit_rejections.inc(limiter="daily_requests")
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail={
+                        "error": "Daily request limit exceeded",
+                        "message": f"Batch of {reserved_requests} requests needs more than the "
+                                   f"{max(0, usage['max_requests'] - usage['requests'])} you have left today.",
+                        "current_requests": usage['requests'],
+                        "max_requests": usage['max_requests'],
+                        "plan_name": usage['plan_name'],
+                        "upgrade_required": usage['plan_name'] == 'Baby Free'
+                    }
+                )
+            metrics.rate_limit_rejections.inc(limiter="daily_tokens")
+            raise HTTPException(
+                status_code=status.HTTP_402_PAYMENT_REQUIRED,
+                detail={
+                    "error": "Daily token limit exceeded",
+                    "message": f"Batch requires {reserved_tokens} tokens, but you only have {max(0, usage['max_tokens'] - usage['tokens_used'])} remaining today.",
+                    "current_tokens": usage['tokens_used'],
+                    "max_tokens": usage['max_tokens'],
+                    "plan_name": usage['plan_name'],
+                    "upgrade_required": True
+                }
+            )
+        
+        return {
+            "estimates": estimates,
+            "reserved_tokens": reserved_tokens,
+            "reserved_requests": reserved_requests
+        }
+    
+    @staticmethod
+    @traced("billing.settle_batch")
+    async def settle_batch(user: Dict[str, Any], reservation: Dict[str, Any],
+                           tokens_used: int, requests_made: int, op_id: Optional[str] = None) -> Dict[str, Any]:
+        """Bill what a batch actually used and refund the rest of its reservation"""
+        daily_usage = await daily_usage_service.settle_reservation(
+            user['id'], reservation['reserved_tokens'], reservation['reserved_requests'],
+            tokens_used, requests_made, op_id
+        )
+        metrics.tokens_billed.inc(tokens_used, plan=user['plan_name'])
+        return daily_usage
+    
+    @staticmethod
+    @traced("billing.log_usage")
+    async def log_usage(user_id: str, actual_tokens: int, plan_name: str = "unknown",
+                        op_id: Optional[str] = None) -> Dict[str, Any]:
+        """Log actual token usage after successful request; returns the updated daily usage.
+        Usage is applied once per op_id, however often it is retried"""
+        daily_usage = await daily_usage_service.update_daily_usage(user_id, actual_tokens, 1, op_id)
+        metrics.tokens_billed.inc(actual_tokens, plan=plan_name)
+        return daily_usage
+    
+    @staticmethod
+    def log_usage_later(user_id: str, actual_tokens: int, plan_name: str = "unknown",
+                        op_id: Optional[str] = None):
+        """log_usage in the background, so the response doesn't wait for the write"""
+        async def write():
+            try:
+                await BillingGuard.log_usage(user_id, actual_tokens, plan_name, op_id)
+            except Exception as e:
+                print(f"Failed to record usage for user {user_id}: {e}")
+        
+        BillingGuard.write_detached(write())
+    
+    @staticmethod
+    def write_detached(write: Coroutine[Any, Any, Any]) -> asyncio.Task:
+        """Run a usage write in a task of its own, tracked until drain()
+
+        Tokens already spent must be billed even when the request's deadline
+        has passed or its client left, so the task runs without the deadline.
+        """
+        context = contextvars.copy_context()
+        context.run(deadline.deadline_var.set, None)
+        task = asyncio.create_task(write, context=context)
+        _pending_writes.add(task)
+        task.add_done_callback(_pending_writes.discard)
+        return task
+    
+    @staticmethod
+    async def drain():
+        """Wait for deferred usage writes, e.g. at shutdown"""
+        if _pending_writes:
+            await asyncio.gather(*_pending_writes, return_exceptions=True)
+    
+    @staticmethod
+    def projected_usage_info(checked: Dict[str, Any], tokens_used: int) -> Dict[str, Any]:
+        """usage_info from the usage the quota check saw plus this request, without reading it back"""
+        return BillingGuard.usage_info({
+            "tokens_used": checked['current_tokens'] + tokens_used,
+            "requests": checked['current_requests'] + 1,
+            "max_tokens": checked['max_tokens'],
+            "max_requests": checked['max_requests'],
+            "plan_name": checked['plan_name']
+        })
+    
+    @staticmethod
+    def usage_info(daily_usage: Dict[str, Any]) -> Dict[str, Any]:
+        """usage_info block returned with completions"""
+        return {
+            "tokens_used_today": daily_usage['tokens_used'],
+            "tokens_remaining_today": max(0, daily_usage['max_tokens'] - daily_usage['tokens_used']),
+            "requests_made_today": daily_usage['requests'],
+            "requests_remaining_today": max(0, daily_usage['max_requests'] - daily_usage['requests']),
+            "plan_name": daily_usage['plan_name'],
+            "max_tokens_daily": daily_usage['max_tokens'],
+            "max_requests_daily": daily_usage['max_requests']
+        }
     
     @staticmethod
     def extract_token_usage(grok_response: Dict[str, Any]) -> int:
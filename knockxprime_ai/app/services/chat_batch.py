@@ -0,0 +1,127 @@
+"""
+Batch chat completions
+
+A batch is authenticated and reserved once, then its items run against Grok
+with bounded concurrency in a task of its own. Results are kept as NDJSON
+lines as they finish and streamed to the client. The task settles billing
+and releases the user's in-flight slot whether or not the client stays
+connected; a client that disconnects cancels the items still running, and
+their reservation is refunded. A batch sent with an Idempotency-Key runs on
+after a disconnect instead, so a retry can stream it again from the start.
+"""
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+from fastapi import HTTPException
+
+from app.core import deadline
+from app.core.admission import plan_priority
+from app.core.json_response import dumps
+from app.schemas.chat_schema import ChatRequest
+from app.services.billing_guard import billing_guard
+from app.services.grok_service import grok_service
+
+
+def item_error(index: int, error: BaseException) -> Dict[str, Any]:
+    """NDJSON line for an item that failed"""
+    if isinstance(error, HTTPException):
+        status_code, detail = error.status_code, error.detail
+    elif isinstance(error, httpx.TimeoutException):
+        status_code, detail = 504, "Upstream request timed out"
+    elif isinstance(error, httpx.HTTPStatusError):
+        status_code, detail = 502, f"Upstream returned {error.response.status_code}"
+    else:
+        status_code, detail = 500, f"Error processing chat request: {str(error)}"
+    return {"type": "error", "index": index, "status": status_code, "error": detail}
+
+
+class ChatBatchRun:
+    """One batch: fan-out task plus the NDJSON lines its results are streamed from"""
+
+    def __init__(self, user: Dict[str, Any], requests: List[ChatRequest], reservation: Dict[str, Any],
+                 concurrency: int, on_finish: Callable[[], None],
+                 op_id: Optional[str] = None, cancel_on_disconnect: bool = True):
+        self.user = user
+        self.requests = requests
+        self.reservation = reservation
+        self.concurrency = concurrency
+        self.on_finish = on_finish
+        self.op_id = op_id
+        self.cancel_on_disconnect = cancel_on_disconnect
+        self.lines: List[bytes] = []
+        self.finished = False
+        self._changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.tokens_used = 0
+        self.succeeded = 0
+        self.failed = 0
+
+    def start(self) -> "ChatBatchRun":
+        self.task = asyncio.create_task(self._run())
+        return self
+
+    def _emit(self, line: Dict[str, Any]):
+        self.lines.append(dumps(line) + b"\n")
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _run(self):
+        # Runs in its own task, so this only affects the batch
+        deadline.drop_default()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        priority = plan_priority(self.user)
+
+        async def run_item(index: int, request: ChatRequest):
+            async with semaphore:
+                try:
+                    response = await grok_service.chat_completion(request, priority)
+                except Exception as e:
+                    self.failed += 1
+                    self._emit(item_error(index, e))
+                    return
+            actual_tokens = billing_guard.extract_token_usage(response)
+            self.tokens_used += actual_tokens if actual_tokens > 0 else self.reservation['estimates'][index]
+            self.succeeded += 1
+            self._emit({"type": "result", "index": index, "status": 200, "response": response})
+
+        try:
+            await asyncio.gather(*(run_item(index, request) for index, request in enumerate(self.requests)))
+        finally:
+            try:
+                # Not bounded by a deadline the client set: the refund must land regardless
+                daily_usage = await asyncio.shield(billing_guard.write_detached(billing_guard.settle_batch(
+                    self.user, self.reservation, self.tokens_used, self.succeeded, self.op_id
+                )))
+                self._emit({
+                    "type": "summary",
+                    "requests": len(self.requests),
+                    "succeeded": self.succeeded,
+                    "failed": self.failed,
+                    "tokens_billed": self.tokens_used,
+                    "usage_info": billing_guard.usage_info(daily_usage) if daily_usage else None
+                })
+            except Exception as e:
+                print(f"Failed to settle batch for user {self.user['id']}: {e}")
+                self._emit({"type": "summary", "error": "Usage could not be settled"})
+            finally:
+                self.finished = True
+                self._changed.set()
+                self.on_finish()
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """NDJSON lines in completion order from the first, ending with a summary line"""
+        position = 0
+        try:
+            while True:
+                if position < len(self.lines):
+                    position += 1
+                    yield self.lines[position - 1]
+                elif self.finished:
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            # Client went away: stop outstanding items; the task still settles
+            if self.cancel_on_disconnect and self.task is not None and not self.task.done():
+                self.task.cancel()
@@ -0,0 +1,89 @@
+"""
+Single chat completions
+
+The billed path behind /chat/completions and session turns: hold the user's
+in-flight slot, check the daily quota (alongside the Grok call when the
+user has headroom), call Grok and record usage once under the op id.
+"""
+import asyncio
+from typing import Any, Dict, Optional, Tuple, Union
+
+from fastapi import HTTPException, status
+
+from app.core import metrics
+from app.core.admission import plan_priority
+from app.core.inflight import user_inflight
+from app.schemas.chat_schema import ChatRequest
+from app.services.billing_guard import billing_guard
+from app.services.chat_passthrough import RawChatRequest, check_object, extract_total_tokens
+from app.services.grok_service import grok_service
+from app.services.upstream_pool import upstream_pool
+
+
+async def run_chat_completion(current_user: Dict[str, Any], request: Union[ChatRequest, RawChatRequest],
+                              op_id: Optional[str]) -> Tuple[Union[Dict[str, Any], bytes], Dict[str, Any]]:
+    """Grok's response (bytes in pass-through mode) and the usage_info to add to it
+
+    The response is known to be a JSON object, so adding usage_info to it can't fail.
+    """
+    
+    # Grok is failing: answer 503 before any quota or usage work
+    upstream_pool.check()
+    
+    # Released on success, errors and client disconnects alike
+    async with user_inflight.hold(current_user):
+        try:
+            # Make request to Grok API (paid plans are admitted first under load)
+            priority = plan_priority(current_user)
+            
+            async def call_grok():
+                # A response usage_info can't be added to fails here, before anything is billed
+                if isinstance(request, RawChatRequest):
+                    body = await grok_service.chat_completion_raw(request, priority)
+                    check_object(body)
+                    return body, extract_total_tokens(body)
+                response = await grok_service.chat_completion(request, priority)
+                if not isinstance(response, dict):
+                    raise ValueError("Upstream response is not a JSON object")
+                return response, billing_guard.extract_token_usage(response)
+            
+            speculative = billing_guard.has_headroom(current_user, request)
+            if speculative:
+                # Far from the limits: start Grok while the quota check runs; a failed check cancels it
+                upstream = asyncio.create_task(call_grok())
+                try:
+                    validation_result = await billing_guard.validate_request(current_user, request)
+                except BaseException:
+                    upstream.cancel()
+                    await asyncio.gather(upstream, return_exceptions=True)
+                    metrics.speculative_calls.inc(result="cancelled")
+                    raise
+                metrics.speculative_calls.inc(result="confirmed")
+                grok_result, actual_tokens = await upstream
+            else:
+                # Validate request against user's plan limits (daily)
+                validation_result = await billing_guard.validate_request(current_user, request)
+                grok_result, actual_tokens = await call_grok()
+            
+            # Log usage (use actual tokens if available, otherwise use estimate)
+            tokens_to_log = actual_tokens if actual_tokens > 0 else validation_result['estimated_tokens']
+            if speculative:
+                # Written after the response goes out; usage_info is projected from the checked usage
+                billing_guard.log_usage_later(current_user['id'], tokens_to_log, current_user['plan_name'], op_id)
+                usage_info = billing_guard.projected_usage_info(validation_result['usage_info'], tokens_to_log)
+            else:
+                # Past the deadline the tokens are spent all the same: bill them and answer
+                daily_usage = await asyncio.shield(billing_guard.write_detached(billing_guard.log_usage(
+                    current_user['id'], tokens_to_log, current_user['plan_name'], op_id
+                )))
+                usage_info = billing_guard.usage_info(daily_usage)
+            
+            return grok_result, usage_info
+        
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error processing chat request: {str(e)}"
+            )
@@ -0,0 +1,169 @@
+"""
+Pass-through handling of chat request and response bodies
+
+The client's JSON is still decoded in full, once, but only to check and
+extract what billing needs: no models are built and nothing is re-encoded.
+Fields ChatRequest doesn't have are rejected, since the bytes are forwarded
+as sent and the parsed path would drop them.
+The original bytes are forwarded to Grok, and usage_info is spliced into
+Grok's response bytes, which are never decoded.
+"""
+import json
+import re
+from typing import Any, Dict, Optional
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from app.core.json_response import dumps
+from app.schemas.chat_schema import ChatMessage, ChatRequest
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _DecodeError = orjson.JSONDecodeError
+
+    def _canonical_dumps(data: Dict[str, Any]) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    _loads = json.loads
+    _DecodeError = json.JSONDecodeError
+
+    def _canonical_dumps(data: Dict[str, Any]) -> bytes:
+        return json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+_TOTAL_TOKENS = re.compile(rb'"total_tokens"\s*:\s*(\d+)')
+_WHITESPACE = b" \t\r\n"
+_TYPE_NAMES = {"string": "string", "int": "integer", "float": "number", "bool": "boolean"}
+
+# Only what the parsed path would send may reach Grok: other parameters are rejected
+REQUEST_FIELDS = frozenset(ChatRequest.model_fields)
+MESSAGE_FIELDS = frozenset(ChatMessage.model_fields)
+
+# Fields GrokService always sends; spliced in when the client left them out
+UPSTREAM_DEFAULTS = {
+    name: ChatRequest.model_fields[name].default
+    for name in ("model", "max_tokens", "temperature", "stream")
+}
+
+
+def _error(error_type: str, loc: tuple, msg: str, value: Any = None) -> RequestValidationError:
+    return RequestValidationError([{"type": error_type, "loc": ("body", *loc), "msg": msg, "input": value}])
+
+
+def _reject_extra(data: Dict[str, Any], allowed: frozenset, loc: tuple):
+    for name in data:
+        if name not in allowed:
+            raise _error("extra_forbidden", (*loc, name), "Extra inputs are not permitted", data[name])
+
+
+class RawChatRequest:
+    """The parts of a chat request that billing and routing look at, plus the raw body"""
+
+    __slots__ = ("body", "messages", "model", "max_tokens", "temperature", "stream", "content_chars", "_data", "_missing")
+
+    def __init__(self, body: bytes):
+        try:
+            data = _loads(body)
+        except _DecodeError as e:
+            raise _error("json_invalid", (), f"Invalid JSON: {e}")
+        if not isinstance(data, dict):
+            raise _error("model_attributes_type", (), "Input should be a valid dictionary or object", data)
+
+        _reject_extra(data, REQUEST_FIELDS, ())
+        messages = data.get("messages")
+        if "messages" not in data:
+            raise _error("missing", ("messages",), "Field required", data)
+        if not isinstance(messages, list):
+            raise _error("list_type", ("messages",), "Input should be a valid array", messages)
+        content_chars = 0
+        for index, message in enumerate(messages):
+            if not isinstance(message, dict):
+                raise _error("model_attributes_type", ("messages", index),
+                             "Input should be a valid dictionary or object", message)
+            _reject_extra(message, MESSAGE_FIELDS, ("messages", index))
+            for field in ("role", "content"):
+                if field not in message:
+                    raise _error("missing", ("messages", index, field), "Field required", message)
+                if not isinstance(message[field], str):
+                    raise _error("string_type", ("messages", index, field), "Input should be a valid string",
+                                 message[field])
+            content_chars += len(message["content"])
+
+        self.body = body
+        self.messages = messages
+        self.content_chars = content_chars
+        self.model = self._field(data, "model", str, "string")
+        self.max_tokens = self._field(data, "max_tokens", int, "int")
+        self.temperature = self._field(data, "temperature", (int, float), "float")
+        self.stream = self._field(data, "stream", bool, "bool")
+        self._data = data
+        self._missing = {name: default for name, default in UPSTREAM_DEFAULTS.items() if name not in data}
+
+    @staticmethod
+    def _field(data: Dict[str, Any], name: str, expected, kind: str) -> Optional[Any]:
+        """Strict type check: the value is forwarded upstream exactly as sent"""
+        value = data.get(name, UPSTREAM_DEFAULTS[name])
+        if value is None:
+            return None
+        if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+            raise _error(f"{kind}_type", (name,), f"Input should be a valid {_TYPE_NAMES[kind]}", value)
+        return value
+
+    def canonical_body(self) -> bytes:
+        """Same bytes for any two bodies Grok would treat identically (key order, whitespace, defaults)"""
+        return _canonical_dumps({**self._missing, **self._data})
+
+    def upstream_body(self) -> bytes:
+        """The client's bytes, with any defaulted fields spliced in after the opening brace"""
+        if not self._missing:
+            return self.body
+        start = len(self.body) - len(self.body.lstrip(_WHITESPACE)) + 1
+        return b"{" + dumps(self._missing)[1:-1] + b"," + self.body[start:]
+
+
+def parse_chat_request(body: bytes) -> ChatRequest:
+    """Full pydantic parse, with errors shaped like FastAPI's own body validation"""
+    try:
+        return ChatRequest.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError([
+            {**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)
+        ])
+
+
+def extract_total_tokens(body: bytes) -> int:
+    """total_tokens from an upstream response without decoding it"""
+    matches = _TOTAL_TOKENS.findall(body)
+    return int(matches[-1]) if matches else 0
+
+
+def check_object(body: bytes):
+    """Raise ValueError unless the bytes look like a JSON object, as splice_field needs"""
+    end = len(body.rstrip(_WHITESPACE))
+    if not body.lstrip(_WHITESPACE).startswith(b"{") or body[end - 1:end] != b"}":
+        raise ValueError("Upstream response is not a JSON object")
+
+
+def splice_field(body: bytes, name: str, value: Any) -> bytes:
+    """Add a top-level field to a JSON object's bytes"""
+    check_object(body)
+    end = len(body.rstrip(_WHITESPACE))
+    inner = body[:end - 1].rstrip(_WHITESPACE)
+    separator = b"" if inner.endswith(b"{") else b","
+    return inner + separator + dumps(name) + b":" + dumps(value) + b"}"
+
+
+def request_schema() -> Dict[str, Any]:
+    """ChatRequest JSON schema with $defs inlined, for routes that read the body themselves"""
+    schema = ChatRequest.model_json_schema()
+    definitions = schema.pop("$defs", {})
+
+    def inline(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return inline(definitions[node["$ref"].rsplit("/", 1)[1]])
+            return {key: inline(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [inline(item) for item in node]
+        return node
+
+    return inline(schema)
@@ -1,20 +1,23 @@
-import httpx
+import hashlib
 import json
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Union
+from app.core import deadline
 from app.core.config import settings
+from app.core.tracing import tracer
+from app.core.json_response import dumps
+from app.core.singleflight import SingleFlight
+from app.core.admission import grok_admission
 from app.schemas.chat_schema import ChatRequest, ChatResponse
+from app.services.chat_passthrough import RawChatRequest
+from app.services.upstream_pool import upstream_pool
 
 
 class GrokService:
     def __init__(self):
-        self.base_url = settings.grok_base_url
-        self.api_key = settings.grok_api_key
-        self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
+        self.pool = upstream_pool
+        self.inflight = SingleFlight("grok")
     
-    async def chat_completion(self, request: ChatRequest) -> Dict[str, Any]:
+    async def chat_completion(self, request: ChatRequest, priority: float = 0.0) -> Dict[str, Any]:
         """Send chat completion request to Grok API"""
         
         # Prepare request payload
@@ -26,24 +29,66 @@ class GrokService:
             "stream": request.stream
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/chat/completions",
-                headers=self.headers,
-                json=payload,
-                timeout=60.0
-            )
-            
-            response.raise_for_status()
-            return response.json()
+        content = dumps(payload)
+        if self._coalescable(request):
+            body = await self._coalesced_post(content, content, request, priority)
+        else:
+            body = await self._post_chat(content, request, priority)
+        return json.loads(body)
+    
+    async def chat_completion_raw(self, request: RawChatRequest, priority: float = 0.0) -> bytes:
+        """Forward the client's body to Grok and return the response bytes untouched"""
+        if not self._coalescable(request):
+            return await self._post_chat(request.upstream_body(), request, priority)
+        return await self._coalesced_post(request.upstream_body(), request.canonical_body(), request, priority)
+    
+    def _coalescable(self, request: Union[ChatRequest, RawChatRequest]) -> bool:
+        """Only deterministic, non-streamed completions can be shared between callers"""
+        return settings.grok_coalesce_enabled and request.temperature == 0 and not request.stream
+    
+    async def _coalesced_post(self, content: bytes, canonical: bytes,
+                              request: Union[ChatRequest, RawChatRequest], priority: float) -> bytes:
+        """_post_chat, shared with identical requests of the same priority already in flight"""
+        # Response bytes are shared, so each caller decodes (and may mutate) its own copy.
+        # Priority is part of the key so a paid request never queues behind a free plan's flight.
+        key = (hashlib.sha256(canonical).digest(), priority)
+        
+        async def shared_post() -> bytes:
+            # Runs in its own task: the first caller's deadline must not cut it short for the rest
+            deadline.deadline_var.set(None)
+            return await self._post_chat(content, request, priority)
+        
+        with tracer.start_span("grok.singleflight") as span:
+            # Each caller waits only as long as its own deadline allows
+            async with deadline.bounded():
+                body, shared = await self.inflight.do(key, shared_post)
+            span.set_attribute("singleflight.shared", shared)
+        return body
+    
+    async def _post_chat(self, content: bytes, request: Union[ChatRequest, RawChatRequest],
+                         priority: float = 0.0) -> bytes:
+        """POST a chat completion body through the upstream pool once admission control grants a slot"""
+        # Checked before queueing too, so open circuits never cost a slot or a wait
+        self.pool.check()
+        # Queueing and the call itself (hedges included) are cancelled once the request's deadline passes
+        async with deadline.bounded():
+            async with grok_admission.slot(priority):
+                return await self.pool.send(content, request, self.calculate_request_tokens(request))
+    
+    def health_status(self) -> str:
+        """Upstream health as seen by the most recent call to each upstream"""
+        used = [upstream for upstream in self.pool.upstreams if upstream.last_request_at is not None]
+        if not used:
+            return "unknown"
+        return "healthy" if any(upstream.last_error is None for upstream in used) else "error"
     
     def estimate_tokens(self, text: str) -> int:
         """Estimate token count (rough approximation: 1 token ≈ 4 characters)"""
         return len(text) // 4
     
-    def calculate_request_tokens(self, request: ChatRequest) -> int:
+    def calculate_request_tokens(self, request: Union[ChatRequest, RawChatRequest]) -> int:
         """Calculate estimated tokens for the request"""
-        total_chars = sum(len(msg.content) for msg in request.messages)
+        total_chars = request.content_chars
         input_tokens = self.estimate_tokens(str(total_chars))
         
         # Add estimated output tokens
@@ -0,0 +1,208 @@
+"""
+Job runner
+
+Leases jobs from the job store and works through their items in chunks of
+the owner's plan concurrency (plans.max_concurrent). Each chunk is reserved
+against the daily quota in one statement before it runs and settled after,
+exactly like an NDJSON batch, and outcomes are recorded with the lease
+renewed. Items are paced per user at the plan's rate (JOB_RATE_PER_MINUTE).
+A job the user cancels stops after the current chunk; one that runs out of
+quota fails the chunk that could not be reserved and cancels the rest.
+"""
+import asyncio
+import os
+import socket
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException
+
+from app.core import metrics
+from app.core.admission import plan_priority
+from app.core.auth import get_user_by_id
+from app.services.upstream_pool import upstream_pool
+from app.core.config import settings
+from app.core.inflight import user_inflight
+from app.core.job_store import CANCELLED, JobStore
+from app.schemas.chat_schema import ChatRequest
+from app.services.billing_guard import billing_guard
+from app.services.chat_batch import item_error
+from app.services.grok_service import grok_service
+
+
+class RatePacer:
+    """Token bucket of job items per minute; burst is one chunk"""
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def take(self, count: int):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                await asyncio.sleep((count - self.tokens) / self.rate)
+
+
+class JobRunner:
+    """Drains the job store, running up to `concurrency` jobs at once"""
+
+    def __init__(self, store: JobStore, concurrency: int, poll_interval: float):
+        self.store = store
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.pacers: Dict[str, RatePacer] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        # Chunk settlements, which outlive a cancelled job
+        self.settling: Set[asyncio.Task] = set()
+        self._stopping = asyncio.Event()
+
+    async def run(self):
+        """Claim and process jobs until stop() is called"""
+        slots = asyncio.Semaphore(self.concurrency)
+        print(f"🧵 Job runner {self.owner} started ({self.concurrency} jobs at once)")
+        try:
+            while not self._stopping.is_set():
+                # With every slot busy, a stop must not wait for a job to finish
+                if not await self._acquire_or_stop(slots):
+                    break
+                try:
+                    job = await self.store.claim(self.owner)
+                except Exception as e:
+                    print(f"Failed to claim a job: {e}")
+                    job = None
+                if job is None:
+                    slots.release()
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                task = asyncio.create_task(self._process(job))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+        finally:
+            # Unfinished jobs go back to the queue; the chunk in progress is refunded and rerun
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            # Those refunds run in tasks of their own and must land before the process exits
+            await asyncio.gather(*self.settling, return_exceptions=True)
+            print(f"👋 Job runner {self.owner} stopped")
+
+    def stop(self):
+        self._stopping.set()
+
+    async def _acquire_or_stop(self, slots: asyncio.Semaphore) -> bool:
+        """Take a job slot; False, holding none, once stop() is called"""
+        acquire = asyncio.ensure_future(slots.acquire())
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        try:
+            await asyncio.wait((acquire, stopping), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopping.cancel()
+            if not acquire.done():
+                acquire.cancel()
+                await asyncio.gather(acquire, return_exceptions=True)
+        if acquire.cancelled() or acquire.exception() is not None:
+            return False
+        if self._stopping.is_set():
+            slots.release()
+            return False
+        return True
+
+    def _pacer(self, user: Dict[str, Any], chunk_size: int) -> RatePacer:
+        key = str(user['id'])
+        per_minute = settings.job_rates.get(user['plan_name'], settings.job_rate_default)
+        pacer = self.pacers.get(key)
+        if pacer is None or pacer.rate != per_minute / 60 or pacer.capacity != max(1, chunk_size):
+            pacer = self.pacers[key] = RatePacer(per_minute, chunk_size)
+        return pacer
+
+    async def _process(self, job: Dict[str, Any]):
+        job_id = job['id']
+        try:
+            user = await get_user_by_id(job['user_id'])
+            if user is not None and job['status'] != CANCELLED:
+                await self._drain(job_id, user)
+            await self.store.finish(job_id, self.owner)
+        except asyncio.CancelledError:
+            await self.store.release(job_id, self.owner)
+            raise
+        except Exception as e:
+            # The lease runs out and another worker (or this one) picks the job up again
+            print(f"Job {job_id} failed: {e}")
+
+    async def _drain(self, job_id: str, user: Dict[str, Any]):
+        limit = user_inflight.limit_for(user)
+        chunk_size = limit if limit > 0 else settings.job_worker_concurrency
+        pacer = self._pacer(user, chunk_size)
+        priority = plan_priority(user)
+        while True:
+            items = await self.store.pending_items(job_id, chunk_size)
+            if not items:
+                return
+            if upstream_pool.retry_after() > 0:
+                # Grok is failing: wait it out rather than fail the job's items, keeping the lease
+                await asyncio.sleep(upstream_pool.retry_after())
+                if await self.store.record(job_id, self.owner, []) == CANCELLED:
+                    return
+                continue
+            await pacer.take(len(items))
+            job = await self.store.get(job_id)
+            if job is None or job['status'] == CANCELLED:
+                return
+            requests = [ChatRequest(**request) for _, request in items]
+            try:
+                reservation = await billing_guard.reserve_batch(user, requests)
+            except HTTPException as e:
+                outcomes = [(index, "error", e.status_code, e.detail, 0) for index, _ in items]
+                await self.store.record(job_id, self.owner, outcomes)
+                metrics.job_items.inc(len(outcomes), status="error")
+                return
+            outcomes = await self._run_chunk(user, items, requests, reservation, priority)
+            if await self.store.record(job_id, self.owner, outcomes) == CANCELLED:
+                return
+
+    async def _run_chunk(self, user: Dict[str, Any], items: List[Tuple[int, Dict[str, Any]]],
+                         requests: List[ChatRequest], reservation: Dict[str, Any],
+                         priority: float) -> List[Tuple[int, str, int, Any, int]]:
+        async def run_item(position: int, index: int, request: ChatRequest):
+            try:
+                response = await grok_service.chat_completion(request, priority)
+            except Exception as e:
+                error = item_error(index, e)
+                return (index, "error", error['status'], error['error'], 0)
+            actual_tokens = billing_guard.extract_token_usage(response)
+            tokens = actual_tokens if actual_tokens > 0 else reservation['estimates'][position]
+            return (index, "done", 200, response, tokens)
+
+        outcomes: Optional[List[Tuple[int, str, int, Any, int]]] = None
+        try:
+            outcomes = await asyncio.gather(*(
+                run_item(position, index, request)
+                for position, ((index, _), request) in enumerate(zip(items, requests))
+            ))
+        finally:
+            # Cancelled mid-chunk: nothing is recorded, so refund it all and let the chunk rerun
+            done = [outcome for outcome in outcomes or () if outcome[1] == "done"]
+            settle = asyncio.create_task(billing_guard.settle_batch(
+                user, reservation, sum(outcome[4] for outcome in done), len(done)
+            ))
+            self.settling.add(settle)
+            settle.add_done_callback(self.settling.discard)
+            await asyncio.shield(settle)
+        metrics.job_items.inc(len(done), status="done")
+        metrics.job_items.inc(len(outcomes) - len(done), status="error")
+        return outcomes
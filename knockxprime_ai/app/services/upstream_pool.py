@@ -0,0 +1,375 @@
+"""
+Pool of OpenAI-compatible chat upstreams
+
+Upstreams come from UPSTREAMS (several Grok keys or regions, a local
+fallback model) or default to the single GROK_API_KEY endpoint. Each has its
+own circuit breaker, an EWMA of time to first byte and a rate budget: the
+configured requests and tokens per minute, tightened by the
+x-ratelimit-* headers and 429s it returns. A call goes to the better of two
+randomly chosen healthy upstreams with budget left (power of two choices),
+scored by EWMA latency times load. Fallback upstreams are used only when no
+primary can take the call.
+
+With hedging on, a call that has no response headers after the primary's
+p95 time to first byte is also sent to a second upstream. The first
+successful response wins and the other call is cancelled. Hedges are
+limited to UPSTREAM_HEDGE_MAX_RATIO of calls. A call that fails on an
+unhealthy upstream before any hedge went out is retried once elsewhere.
+"""
+import asyncio
+import json
+import random
+import re
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Set, Union
+
+import httpx
+from fastapi import HTTPException, status
+
+from app.core import metrics
+from app.core.circuit_breaker import is_failure, upstream_breaker
+from app.core.config import settings
+from app.core.json_response import dumps
+from app.core.tracing import tracer, KIND_CLIENT
+from app.schemas.chat_schema import ChatRequest
+from app.services.chat_passthrough import RawChatRequest, extract_total_tokens
+
+EWMA_ALPHA = 0.2
+TTFB_SAMPLES = 200
+MIN_HEDGE_SAMPLES = 20
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: Optional[str]) -> float:
+    """Seconds from a rate-limit reset header: "20ms", "1.5s", "6m0s" or a plain number"""
+    if not value:
+        return 1.0
+    try:
+        return float(value)
+    except ValueError:
+        seconds = sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in _DURATION_PART.findall(value))
+        return seconds or 1.0
+
+
+class RateBudget:
+    """Requests and tokens per minute for one upstream key"""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.calls: deque = deque()
+        self.tokens = 0
+        self.exhausted_until = 0.0
+
+    def _prune(self, now: float):
+        while self.calls and self.calls[0][0] <= now - 60:
+            self.tokens -= self.calls.popleft()[1]
+
+    def allows(self, tokens: int) -> bool:
+        now = time.monotonic()
+        if now < self.exhausted_until:
+            return False
+        self._prune(now)
+        if self.requests_per_minute and len(self.calls) >= self.requests_per_minute:
+            return False
+        return not (self.tokens_per_minute and self.calls and self.tokens + tokens > self.tokens_per_minute)
+
+    def spend(self, tokens: int):
+        self.calls.append((time.monotonic(), tokens))
+        self.tokens += tokens
+
+    def observe(self, response: httpx.Response):
+        """Stop using the key until the upstream says its budget resets"""
+        headers = response.headers
+        if response.status_code == 429:
+            self.exhaust(parse_reset(headers.get("retry-after")))
+            return
+        for kind in ("requests", "tokens"):
+            if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+                self.exhaust(parse_reset(headers.get(f"x-ratelimit-reset-{kind}")))
+
+    def exhaust(self, seconds: float):
+        self.exhausted_until = max(self.exhausted_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        self._prune(time.monotonic())
+        return {
+            "requests_last_minute": len(self.calls),
+            "tokens_last_minute": self.tokens,
+            "requests_per_minute": self.requests_per_minute or None,
+            "tokens_per_minute": self.tokens_per_minute or None,
+            "exhausted_for_seconds": round(max(0.0, self.exhausted_until - time.monotonic()), 1),
+        }
+
+
+class Upstream:
+    """One OpenAI-compatible endpoint and key"""
+
+    def __init__(self, name: str, base_url: str, api_key: str, weight: float = 1.0,
+                 requests_per_minute: int = 0, tokens_per_minute: int = 0,
+                 model: Optional[str] = None, fallback: bool = False):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        self.weight = max(0.01, float(weight))
+        self.model = model
+        self.fallback = fallback
+        self.breaker = upstream_breaker(name)
+        self.budget = RateBudget(requests_per_minute, tokens_per_minute)
+        self.ewma_ttfb: Optional[float] = None
+        self.ttfb_samples: deque = deque(maxlen=TTFB_SAMPLES)
+        self.in_flight = 0
+        self.last_request_at: Optional[float] = None
+        self.last_status: Optional[int] = None
+        self.last_error: Optional[str] = None
+
+    def available(self, tokens: int) -> bool:
+        return self.breaker.allows() and self.budget.allows(tokens)
+
+    def score(self) -> float:
+        """Lower is better; unmeasured upstreams score 0 so they get tried"""
+        return (self.ewma_ttfb or 0.0) * (self.in_flight + 1) / self.weight
+
+    def hedge_delay(self, minimum: float) -> Optional[float]:
+        """p95 time to first byte, or None until there are enough samples"""
+        if len(self.ttfb_samples) < MIN_HEDGE_SAMPLES:
+            return None
+        samples = sorted(self.ttfb_samples)
+        return max(minimum, samples[int(len(samples) * 0.95) - 1])
+
+    def _observe_latency(self, seconds: float):
+        self.ewma_ttfb = seconds if self.ewma_ttfb is None else (
+            EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * self.ewma_ttfb
+        )
+        metrics.upstream_latency_ewma.set(self.ewma_ttfb, upstream=self.name)
+
+    def _body_for(self, content: bytes) -> bytes:
+        if not self.model:
+            return content
+        payload = json.loads(content)
+        payload["model"] = self.model
+        return dumps(payload)
+
+    async def post(self, content: bytes, request: Union[ChatRequest, RawChatRequest], tokens: int,
+                   first_byte: Optional[asyncio.Event] = None) -> bytes:
+        """POST a chat completion body and return the raw response body"""
+        started = time.perf_counter()
+        self.last_request_at = time.time()
+        self.in_flight += 1
+        self.budget.spend(tokens)
+        status_label = "error"
+
+        with tracer.start_span("grok.chat_completion", KIND_CLIENT, {
+            "llm.model": request.model,
+            "llm.max_tokens": request.max_tokens,
+            "llm.messages": len(request.messages),
+            "upstream.name": self.name
+        }) as span:
+            try:
+                async with self.breaker.call():
+                    async with httpx.AsyncClient() as client:
+                        upstream_request = client.build_request(
+                            "POST",
+                            f"{self.base_url}/chat/completions",
+                            headers=self.headers,
+                            content=self._body_for(content),
+                            timeout=60.0
+                        )
+                        response = await client.send(upstream_request, stream=True)
+                        try:
+                            ttfb = time.perf_counter() - started
+                            if first_byte is not None:
+                                first_byte.set()
+                            self.ttfb_samples.append(ttfb)
+                            self._observe_latency(ttfb)
+                            metrics.upstream_ttfb.observe(ttfb, upstream=self.name)
+                            span.set_attribute("http.ttfb_ms", round(ttfb * 1000, 2))
+                            body = await response.aread()
+                        finally:
+                            await response.aclose()
+
+                        status_label = str(response.status_code)
+                        self.last_status = response.status_code
+                        self.budget.observe(response)
+                        span.set_attribute("http.status_code", response.status_code)
+                        response.raise_for_status()
+                        self.last_error = None
+
+                        span.set_attribute("llm.total_tokens", extract_total_tokens(body))
+                        return body
+            except httpx.TimeoutException:
+                status_label = "timeout"
+                self.last_error = "timeout"
+                self._observe_latency(time.perf_counter() - started)
+                raise
+            except httpx.HTTPError as e:
+                self.last_error = str(e)
+                raise
+            except asyncio.CancelledError:
+                status_label = "cancelled"
+                raise
+            finally:
+                self.in_flight -= 1
+                metrics.upstream_duration.observe(
+                    time.perf_counter() - started, upstream=self.name, status=status_label
+                )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "fallback": self.fallback,
+            "in_flight": self.in_flight,
+            "ewma_ttfb_ms": round(self.ewma_ttfb * 1000, 1) if self.ewma_ttfb is not None else None,
+            "p95_ttfb_ms": round(self.hedge_delay(0) * 1000, 1) if self.hedge_delay(0) is not None else None,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+            "circuit": self.breaker.stats(),
+            "budget": self.budget.stats(),
+        }
+
+
+class UpstreamPool:
+    """Routes each chat call to an upstream, hedging slow ones when enabled"""
+
+    def __init__(self, upstreams: List[Upstream], hedging: bool, hedge_min_delay: float, hedge_max_ratio: float):
+        self.upstreams = upstreams
+        self.hedging = hedging
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        # Earned at hedge_max_ratio per call, spent one per hedge
+        self._hedge_credit = 1.0
+
+    def pick(self, tokens: int, exclude: Set[Upstream] = frozenset()) -> Optional[Upstream]:
+        candidates = [u for u in self.upstreams if u not in exclude and not u.fallback and u.available(tokens)]
+        if not candidates:
+            candidates = [u for u in self.upstreams if u not in exclude and u.fallback and u.available(tokens)]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+        first, second = random.sample(candidates, 2)
+        return first if first.score() <= second.score() else second
+
+    def check(self):
+        """Fail fast with 503 when every upstream's circuit is open"""
+        breakers = [u.breaker for u in self.upstreams]
+        if not any(breaker.allows() for breaker in breakers):
+            raise min(breakers, key=lambda breaker: breaker.retry_after()).reject()
+
+    def retry_after(self) -> float:
+        """Seconds until some upstream's circuit lets calls through; 0 if one already does"""
+        if any(u.breaker.allows() for u in self.upstreams):
+            return 0.0
+        return min(u.breaker.retry_after() for u in self.upstreams)
+
+    def _unavailable(self) -> HTTPException:
+        self.check()
+        # Circuits allow calls, so every upstream is out of rate budget
+        retry_after = max(1, int(min(u.budget.exhausted_until for u in self.upstreams) - time.monotonic()) + 1)
+        metrics.upstream_shed.inc(upstream="pool", reason="rate_budget")
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={
+                "error": "Service overloaded",
+                "message": "Every AI upstream is at its rate limit. Please retry shortly.",
+                "reason": "rate_budget",
+                "retry_after": retry_after
+            },
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    def _take_hedge(self) -> bool:
+        if self._hedge_credit < 1:
+            return False
+        self._hedge_credit -= 1
+        return True
+
+    async def send(self, content: bytes, request: Union[ChatRequest, RawChatRequest], tokens: int) -> bytes:
+        """Send a chat body to the best upstream, hedging or failing over as configured"""
+        primary = self.pick(tokens)
+        if primary is None:
+            raise self._unavailable()
+        metrics.upstream_picks.inc(upstream=primary.name)
+        self._hedge_credit = min(10.0, self._hedge_credit + self.hedge_max_ratio)
+
+        first_byte = asyncio.Event()
+        tried = {primary}
+        calls = {asyncio.create_task(primary.post(content, request, tokens, first_byte)): primary}
+        hedge_delay = primary.hedge_delay(self.hedge_min_delay) if self.hedging else None
+        hedged = False
+        error: Optional[BaseException] = None
+        try:
+            if hedge_delay is not None:
+                waiter = asyncio.create_task(first_byte.wait())
+                try:
+                    await asyncio.wait([waiter, *calls], timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+                if not first_byte.is_set() and not any(call.done() for call in calls):
+                    backup = self.pick(tokens, tried)
+                    if backup is not None and self._take_hedge():
+                        hedged = True
+                        tried.add(backup)
+                        metrics.upstream_hedges.inc(upstream=backup.name, result="fired")
+                        calls[asyncio.create_task(backup.post(content, request, tokens))] = backup
+
+            while calls:
+                done, _ = await asyncio.wait(calls, return_when=asyncio.FIRST_COMPLETED)
+                for call in done:
+                    upstream = calls.pop(call)
+                    if call.exception() is None:
+                        if hedged:
+                            metrics.upstream_hedges.inc(
+                                upstream=upstream.name, result="primary_won" if upstream is primary else "hedge_won"
+                            )
+                        return call.result()
+                    error = call.exception()
+                if not calls and not hedged and is_failure(error):
+                    # Nothing else in flight: try one other upstream before giving up
+                    backup = self.pick(tokens, tried)
+                    if backup is not None:
+                        hedged = True
+                        tried.add(backup)
+                        metrics.upstream_hedges.inc(upstream=backup.name, result="failover")
+                        calls[asyncio.create_task(backup.post(content, request, tokens))] = backup
+            raise error
+        finally:
+            # The losing call is cancelled and its connection closed before returning
+            for call in calls:
+                call.cancel()
+            if calls:
+                await asyncio.gather(*calls, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedging": self.hedging,
+            "upstreams": [upstream.stats() for upstream in self.upstreams],
+        }
+
+
+def build_pool() -> UpstreamPool:
+    upstreams = [
+        Upstream(
+            name=entry.get("name") or f"upstream{index}",
+            base_url=entry.get("base_url") or settings.grok_base_url,
+            api_key=entry.get("api_key") or "",
+            weight=entry.get("weight", 1.0),
+            requests_per_minute=int(entry.get("requests_per_minute") or 0),
+            tokens_per_minute=int(entry.get("tokens_per_minute") or 0),
+            model=entry.get("model"),
+            fallback=bool(entry.get("fallback", False))
+        )
+        for index, entry in enumerate(settings.upstreams)
+    ]
+    return UpstreamPool(
+        upstreams,
+        hedging=settings.upstream_hedging_enabled,
+        hedge_min_delay=settings.upstream_hedge_min_delay_ms / 1000,
+        hedge_max_ratio=settings.upstream_hedge_max_ratio
+    )
+
+
+upstream_pool = build_pool()
@@ -0,0 +1,36 @@
+"""
+Job worker process: python -m app.worker
+
+Drains the job queue shared with the web workers (JOB_STORE_PATH must point
+at the same SQLite file). SIGTERM and SIGINT hand unfinished jobs back to
+the queue before exiting, once the chunks they cut short are refunded.
+
+The queue is a local file, so this process only sees jobs submitted on web
+when both run on one machine or share a disk. The Procfile's `worker` entry
+runs as its own process type, which on Heroku-style platforms (Render
+included) has a filesystem of its own: there, leave it scaled to zero and
+set JOB_WORKER_IN_WEB=true on a single web instance instead.
+"""
+import asyncio
+import signal
+
+from app.core.config import settings
+from app.core.database import init_db
+from app.core.job_store import job_store
+from app.services.billing_guard import billing_guard
+from app.services.job_runner import JobRunner
+
+
+async def main():
+    print("🚀 Starting KnockXPrime AI job worker...")
+    await init_db()
+    runner = JobRunner(job_store, settings.job_worker_concurrency, settings.job_poll_interval)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, runner.stop)
+    await runner.run()
+    await billing_guard.drain()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
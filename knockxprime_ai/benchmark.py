@@ -0,0 +1,822 @@
+#!/usr/bin/env python3
+"""
+Load and latency benchmark for KnockXPrime AI
+Drives the chat hot path against local Neon and Grok stand-ins and writes a
+JSON report so runs can be compared across commits.
+
+Examples:
+    python benchmark.py --concurrency 32 --requests 2000
+    python benchmark.py --plan-mix "Baby Free=0.4,Leveler=0.3,Log Min=0.2,High Max=0.1"
+    python benchmark.py --server-workers 4 --duration 30
+    python benchmark.py --compare benchmark_results/baseline.json
+    python benchmark.py --serialization
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+
+ENDPOINTS = {
+    "chat": ("POST", "/api/v1/chat/completions"),
+    "usage": ("GET", "/api/v1/usage/current"),
+    "profile": ("GET", "/api/v1/users/profile"),
+    "login": ("POST", "/api/v1/users/login"),
+}
+
+DEFAULT_PLANS = [
+    ("Baby Free", "0.00", 1000, 10, 1),
+    ("Leveler", "4.00", 5000, 100, 2),
+    ("Log Min", "10.00", 20000, 500, 4),
+    ("High Max", "100.00", 100000, 2000, 10),
+]
+
+BENCHMARK_PASSWORD = "benchmark-password"
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """Parse a 'name=weight,name=weight' mix into normalized weights"""
+    weights = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError(f"Mix '{spec}' has no positive weights")
+    return {name: weight / total for name, weight in weights.items()}
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def read_rss_mb(pid: int) -> Optional[Dict[str, float]]:
+    """Read current and peak RSS of a process from /proc (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            fields = dict(line.split(":", 1) for line in status_file if ":" in line)
+        return {
+            "rss_mb": round(int(fields["VmRSS"].split()[0]) / 1024, 1),
+            "peak_rss_mb": round(int(fields["VmHWM"].split()[0]) / 1024, 1),
+        }
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def child_pids(parent_pid: int) -> List[int]:
+    """List direct children of a process by scanning /proc (Linux only)"""
+    children = []
+    for entry in Path("/proc").iterdir() if Path("/proc").exists() else []:
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+            ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == parent_pid:
+            children.append(int(entry.name))
+    return children
+
+
+class StandInState:
+    """In-memory data behind the Neon stand-in"""
+
+    def __init__(self, quota_scale: int):
+        self.lock = threading.Lock()
+        self.query_count = 0
+        self.upstream_calls = 0
+        self.plans: Dict[str, Dict[str, Any]] = {}
+        self.users_by_key: Dict[str, Dict[str, Any]] = {}
+        self.users_by_name: Dict[str, Dict[str, Any]] = {}
+        self.usage: Dict[tuple, Dict[str, int]] = {}
+        self.usage_ops: set = set()
+        self.sessions: Dict[str, Dict[str, Any]] = {}
+
+        created = datetime(2024, 1, 1).isoformat()
+        for name, price, max_tokens, max_requests, max_concurrent in DEFAULT_PLANS:
+            self.plans[name] = {
+                "id": str(uuid.uuid4()),
+                "name": name,
+                "price": price,
+                "max_tokens": max_tokens * quota_scale,
+                "max_requests": max_requests * quota_scale,
+                "max_concurrent": max_concurrent * quota_scale,
+                "created_at": created,
+            }
+
+    def add_user(self, plan_name: str, index: int, hashed_pass: str) -> Dict[str, Any]:
+        plan = self.plans[plan_name]
+        username = f"bench_{plan_name.replace(' ', '_').lower()}_{index}"
+        user = {
+            "id": str(uuid.uuid4()),
+            "username": username,
+            "email": f"{username}@benchmark.local",
+            "hashed_pass": hashed_pass,
+            "api_key": f"bench-{uuid.uuid4().hex}",
+            "plan_id": plan["id"],
+            "created_at": plan["created_at"],
+            "updated_at": plan["created_at"],
+        }
+        self.users_by_key[user["api_key"]] = user
+        self.users_by_name[username] = user
+        return user
+
+    def plan_for(self, user: Dict[str, Any]) -> Dict[str, Any]:
+        return next(p for p in self.plans.values() if p["id"] == user["plan_id"])
+
+
+def result_set(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Shape rows the way the Neon REST API returns them"""
+    if not rows:
+        return {"rows": [], "fields": [], "rowCount": 0}
+    names = list(rows[0].keys())
+    return {
+        "rows": [[row[name] for name in names] for row in rows],
+        "fields": [{"name": name} for name in names],
+        "rowCount": len(rows),
+    }
+
+
+def usage_rows(state: StandInState, user_id: str, day: str) -> List[Dict[str, Any]]:
+    """Today's usage row joined with the user's plan limits"""
+    usage = state.usage.get((user_id, day))
+    if not usage:
+        return []
+    user = next(u for u in state.users_by_key.values() if u["id"] == user_id)
+    plan = state.plan_for(user)
+    return [{
+        "user_id": user_id,
+        "day": day,
+        "tokens_used": usage["tokens_used"],
+        "requests": usage["requests"],
+        "plan_name": plan["name"],
+        "max_tokens": plan["max_tokens"],
+        "max_requests": plan["max_requests"],
+    }]
+
+
+def handle_query(state: StandInState, query: str, params: List[Any]) -> Dict[str, Any]:
+    """Answer the statements issued by the benchmarked endpoints"""
+    sql = re.sub(r"\s+", " ", query).strip().lower()
+
+    if sql.startswith(("create ", "alter ")):
+        return result_set([])
+
+    if sql.startswith("select 1"):
+        return {"rows": [[1]], "fields": [{"name": "?column?"}], "rowCount": 1}
+
+    if "as catalog_version" in sql:
+        return result_set([{**plan, "catalog_version": "standin"} for plan in state.plans.values()])
+
+    if "as version from plans" in sql:
+        return result_set([{"version": "standin"}])
+
+    if "from plans" in sql and "join" not in sql:
+        plans = list(state.plans.values())
+        if "where name = $1" in sql:
+            plans = [p for p in plans if p["name"] == params[0]]
+        elif "where id = $1" in sql:
+            plans = [p for p in plans if p["id"] == params[0]]
+        return result_set(plans)
+
+    if sql.startswith("insert into plans"):
+        return {"rows": [], "fields": [], "rowCount": 1}
+
+    if "from users u join plans p" in sql:
+        if "u.api_key = $1" in sql:
+            user = state.users_by_key.get(params[0])
+        elif "u.username = $1" in sql:
+            user = state.users_by_name.get(params[0])
+        elif "u.id = $1" in sql:
+            user = next((u for u in state.users_by_key.values() if str(u["id"]) == str(params[0])), None)
+        else:
+            user = None
+        if not user:
+            return result_set([])
+        plan = state.plan_for(user)
+        return result_set([{
+            **user,
+            "plan_name": plan["name"],
+            "max_tokens": plan["max_tokens"],
+            "price": plan["price"],
+            "max_concurrent": plan["max_concurrent"],
+        }])
+
+    if "from usage u join users usr" in sql and "u.day = $2" in sql:
+        return result_set(usage_rows(state, params[0], params[1]))
+
+    if sql.startswith("insert into usage") and "on conflict (user_id, day) do nothing" in sql:
+        state.usage.setdefault((params[0], params[2]), {"tokens_used": 0, "requests": 0})
+        return {"rows": [], "fields": [], "rowCount": 1}
+
+    # Usage writes carry an op id (last parameter) and apply at most once
+    if " updated as ( update usage set tokens_used = tokens_used + $1" in sql:
+        usage = state.usage.get((params[2], params[3]))
+        if usage and params[4] not in state.usage_ops:
+            state.usage_ops.add(params[4])
+            usage["tokens_used"] += int(params[0])
+            usage["requests"] += int(params[1])
+        return result_set(usage_rows(state, params[2], params[3]))
+
+    if " reserved as ( update usage" in sql:
+        usage = state.usage.get((params[2], params[3]))
+        rows = usage_rows(state, params[2], params[3])
+        if params[4] in state.usage_ops:
+            return result_set(rows)
+        if not usage or usage["requests"] + int(params[1]) > rows[0]["max_requests"] \
+                or usage["tokens_used"] + int(params[0]) > rows[0]["max_tokens"]:
+            return result_set([])
+        state.usage_ops.add(params[4])
+        usage["tokens_used"] += int(params[0])
+        usage["requests"] += int(params[1])
+        return result_set(usage_rows(state, params[2], params[3]))
+
+    if sql.startswith("insert into sessions"):
+        session_id = str(uuid.uuid4())
+        state.sessions[session_id] = {
+            "user_id": str(params[0]), "data": json.loads(params[1]), "updated_at": datetime.now().isoformat()
+        }
+        return result_set([{"id": session_id, "updated_at": state.sessions[session_id]["updated_at"]}])
+
+    if sql.startswith("select id, session_data") and "from sessions where id = $1 and user_id = $2" in sql:
+        session = state.sessions.get(params[0])
+        if not session or session["user_id"] != str(params[1]):
+            return result_set([])
+        return result_set([{"id": params[0], "session_data": session["data"], "updated_at": session["updated_at"]}])
+
+    if sql.startswith("select updated_at from sessions where id = $1 and user_id = $2"):
+        session = state.sessions.get(params[0])
+        if not session or session["user_id"] != str(params[1]):
+            return result_set([])
+        return result_set([{"updated_at": session["updated_at"]}])
+
+    # Turn appends carry an op id (last parameter) and apply at most once in a row
+    if sql.startswith("update sessions set session_data"):
+        session = state.sessions.get(params[0])
+        if not session or session["user_id"] != str(params[1]):
+            return result_set([])
+        data = session["data"]
+        if data.get("op") != params[3]:
+            data["turns"] = data.get("turns", []) + json.loads(params[2])
+            data["op"] = params[3]
+        session["updated_at"] = datetime.now().isoformat()
+        return result_set([{"turns": len(data["turns"]), "updated_at": session["updated_at"]}])
+
+    if sql.startswith("delete from sessions"):
+        session = state.sessions.get(params[0])
+        deleted = bool(session and session["user_id"] == str(params[1]))
+        if deleted:
+            del state.sessions[params[0]]
+        return {"rows": [], "fields": [], "rowCount": int(deleted)}
+
+    # Monthly upserts and anything else the hot path does not read back
+    return {"rows": [], "fields": [], "rowCount": 1}
+
+
+def build_standin_app(state: StandInState, args: argparse.Namespace):
+    """Starlette app serving the Neon REST and Grok stand-ins"""
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    completion_text = "x" * args.completion_chars
+
+    async def jittered_sleep(mean_ms: float):
+        if mean_ms > 0:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * mean_ms / 1000)
+
+    async def neon_query(request):
+        body = await request.json()
+        with state.lock:
+            state.query_count += 1
+            result = handle_query(state, body.get("query", ""), body.get("params") or [])
+        await jittered_sleep(args.db_latency_ms)
+        return JSONResponse(result)
+
+    async def grok_completion(request):
+        body = await request.json()
+        with state.lock:
+            state.upstream_calls += 1
+        await jittered_sleep(args.upstream_latency_ms)
+        prompt_chars = sum(len(m.get("content", "")) for m in body.get("messages", []))
+        prompt_tokens = max(1, prompt_chars // 4)
+        completion_tokens = max(1, len(completion_text) // 4)
+        return JSONResponse({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "grok-beta"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": completion_text},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    async def counters(request):
+        with state.lock:
+            return JSONResponse({"queries": state.query_count, "upstream_calls": state.upstream_calls})
+
+    return Starlette(routes=[
+        Route("/neon/query", neon_query, methods=["POST"]),
+        Route("/grok/chat/completions", grok_completion, methods=["POST"]),
+        Route("/counters", counters, methods=["GET"]),
+    ])
+
+
+def start_standins(state: StandInState, args: argparse.Namespace) -> str:
+    """Run the stand-in server on a background thread and return its base URL"""
+    import uvicorn
+
+    port = free_port()
+    config = uvicorn.Config(
+        build_standin_app(state, args),
+        host="127.0.0.1",
+        port=port,
+        loop="asyncio",
+        lifespan="off",
+        access_log=False,
+        log_level="warning",
+    )
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, name="benchmark-standins", daemon=True)
+    thread.start()
+
+    deadline = time.time() + 10
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("Stand-in server did not start")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def configure_environment(standin_url: str, args: argparse.Namespace) -> Dict[str, str]:
+    """Point the app at the stand-ins; must run before app modules are imported"""
+    env = {
+        "NEON_API_URL": f"{standin_url}/neon",
+        "NEON_API_KEY": "benchmark",
+        "GROK_API_KEY": "benchmark",
+        "GROK_BASE_URL": f"{standin_url}/grok",
+        "ENVIRONMENT": "benchmark",
+        "RATE_LIMIT_REQUESTS": str(10 ** 9),
+        "RENDER_EXTERNAL_URL": "http://127.0.0.1",
+    }
+    os.environ.update(env)
+    return env
+
+
+class LoadRunner:
+    """Closed-loop load generator with a weighted endpoint and plan mix"""
+
+    def __init__(self, client, state: StandInState, users: Dict[str, List[Dict]], args: argparse.Namespace):
+        self.client = client
+        self.state = state
+        self.users = users
+        self.args = args
+        self.endpoint_mix = parse_mix(args.endpoint_mix)
+        self.plan_mix = parse_mix(args.plan_mix)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.status_codes: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.transport_errors: Dict[str, int] = defaultdict(int)
+        self.chat_body = {
+            "messages": [
+                {"role": "system", "content": "You are a benchmark assistant."},
+                {"role": "user", "content": "y" * args.prompt_chars},
+            ],
+            "max_tokens": args.max_tokens,
+            "temperature": 0.7,
+        }
+
+    def pick(self, mix: Dict[str, float]) -> str:
+        return random.choices(list(mix), weights=list(mix.values()))[0]
+
+    async def issue(self, endpoint: str, user: Dict[str, Any]):
+        method, path = ENDPOINTS[endpoint]
+        if endpoint == "login":
+            return await self.client.request(
+                method, path, json={"username": user["username"], "password": BENCHMARK_PASSWORD}
+            )
+        headers = {"Authorization": f"Bearer {user['api_key']}"}
+        body = self.chat_body if endpoint == "chat" else None
+        return await self.client.request(method, path, headers=headers, json=body)
+
+    async def timed(self, endpoint: str, record: bool = True):
+        user = random.choice(self.users[self.pick(self.plan_mix)])
+        started = time.perf_counter()
+        try:
+            response = await self.issue(endpoint, user)
+            status_code = response.status_code
+        except Exception:
+            status_code = None
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if not record:
+            return
+        if status_code is None:
+            self.transport_errors[endpoint] += 1
+        else:
+            self.status_codes[endpoint][status_code] += 1
+            self.latencies[endpoint].append(elapsed_ms)
+
+    async def calibrate(self, samples: int) -> Dict[str, float]:
+        """Measure DB round trips per request by issuing each endpoint serially"""
+        per_request = {}
+        for endpoint in self.endpoint_mix:
+            before = self.state.query_count
+            for _ in range(samples):
+                await self.timed(endpoint, record=False)
+            per_request[endpoint] = round((self.state.query_count - before) / samples, 2)
+        return per_request
+
+    async def run(self) -> float:
+        remaining = self.args.requests
+        stop_at = time.perf_counter() + self.args.duration if self.args.duration else None
+
+        async def worker():
+            nonlocal remaining
+            while True:
+                if stop_at is not None:
+                    if time.perf_counter() >= stop_at:
+                        return
+                else:
+                    if remaining <= 0:
+                        return
+                    remaining -= 1
+                await self.timed(self.pick(self.endpoint_mix))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        return time.perf_counter() - started
+
+
+def summarize(runner: LoadRunner, elapsed: float, db_per_request: Dict[str, float]) -> Dict[str, Any]:
+    endpoints = {}
+    for endpoint in runner.endpoint_mix:
+        values = sorted(runner.latencies.get(endpoint, []))
+        codes = runner.status_codes.get(endpoint, {})
+        endpoints[endpoint] = {
+            "requests": len(values) + runner.transport_errors.get(endpoint, 0),
+            "rps": round(len(values) / elapsed, 2) if elapsed else 0,
+            "status_codes": {str(code): count for code, count in sorted(codes.items())},
+            "transport_errors": runner.transport_errors.get(endpoint, 0),
+            "latency_ms": {
+                "p50": round(percentile(values, 50), 2),
+                "p95": round(percentile(values, 95), 2),
+                "p99": round(percentile(values, 99), 2),
+                "mean": round(sum(values) / len(values), 2) if values else 0,
+                "max": round(values[-1], 2) if values else 0,
+            },
+            "db_round_trips_per_request": db_per_request.get(endpoint),
+        }
+
+    all_values = sorted(v for values in runner.latencies.values() for v in values)
+    completed = len(all_values)
+    errors = sum(runner.transport_errors.values()) + sum(
+        count for codes in runner.status_codes.values() for code, count in codes.items() if code >= 400
+    )
+    return {
+        "overall": {
+            "requests": completed + sum(runner.transport_errors.values()),
+            "errors": errors,
+            "duration_s": round(elapsed, 3),
+            "rps": round(completed / elapsed, 2) if elapsed else 0,
+            "latency_ms": {
+                "p50": round(percentile(all_values, 50), 2),
+                "p95": round(percentile(all_values, 95), 2),
+                "p99": round(percentile(all_values, 99), 2),
+            },
+        },
+        "endpoints": endpoints,
+    }
+
+
+def seed_users(state: StandInState, args: argparse.Namespace) -> Dict[str, List[Dict]]:
+    from app.core.auth import hash_password
+
+    # One hash shared by every user keeps seeding fast while login still pays for bcrypt
+    hashed = hash_password(BENCHMARK_PASSWORD)
+    return {
+        plan_name: [state.add_user(plan_name, i, hashed) for i in range(args.users_per_plan)]
+        for plan_name in parse_mix(args.plan_mix)
+    }
+
+
+@contextlib.contextmanager
+def quiet_app_logs(enabled: bool):
+    """Keep per-request console logging from dominating the measurement"""
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+async def run_in_process(state: StandInState, args: argparse.Namespace) -> Dict[str, Any]:
+    import httpx
+    from app.main import app, lifespan
+
+    users = seed_users(state, args)
+    transport = httpx.ASGITransport(app=app)
+    async with lifespan(app), httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        runner = LoadRunner(client, state, users, args)
+        with quiet_app_logs(not args.show_app_logs):
+            for _ in range(args.warmup):
+                await runner.timed(runner.pick(runner.endpoint_mix), record=False)
+            db_per_request = await runner.calibrate(args.calibrate)
+            queries_before = state.query_count
+            elapsed = await runner.run()
+            queries_during = state.query_count - queries_before
+
+    report = summarize(runner, elapsed, db_per_request)
+    report["memory"] = {
+        "mode": "in-process",
+        "workers": [{
+            "pid": os.getpid(),
+            **(read_rss_mb(os.getpid()) or {
+                "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+            }),
+        }],
+    }
+    report["db"] = {
+        "round_trips_total": queries_during,
+        "round_trips_per_request": round(queries_during / max(1, report["overall"]["requests"]), 2),
+    }
+    return report
+
+
+async def run_against_server(state: StandInState, env: Dict[str, str], args: argparse.Namespace) -> Dict[str, Any]:
+    import httpx
+
+    users = seed_users(state, args)
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(args.server_workers), "--log-level", "warning", "--no-access-log"],
+        cwd=Path(__file__).parent,
+        env={**os.environ, **env},
+        stdout=None if args.show_app_logs else subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120.0) as client:
+            for _ in range(100):
+                try:
+                    if (await client.get("/health/ping")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn did not become ready")
+
+            runner = LoadRunner(client, state, users, args)
+            for _ in range(args.warmup):
+                await runner.timed(runner.pick(runner.endpoint_mix), record=False)
+            db_per_request = await runner.calibrate(args.calibrate)
+            queries_before = state.query_count
+            elapsed = await runner.run()
+            queries_during = state.query_count - queries_before
+
+        workers = [{"pid": pid, **(read_rss_mb(pid) or {})} for pid in child_pids(server.pid)]
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+    report = summarize(runner, elapsed, db_per_request)
+    report["memory"] = {"mode": f"uvicorn --workers {args.server_workers}", "workers": workers}
+    report["db"] = {
+        "round_trips_total": queries_during,
+        "round_trips_per_request": round(queries_during / max(1, report["overall"]["requests"]), 2),
+    }
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    overall = report["overall"]
+    print(f"\n📊 {overall['requests']} requests in {overall['duration_s']}s "
+          f"({overall['rps']} req/s, {overall['errors']} errors)")
+    print(f"{'endpoint':<10} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'db/req':>7}  status")
+    for name, data in report["endpoints"].items():
+        latency = data["latency_ms"]
+        print(f"{name:<10} {data['requests']:>7} {latency['p50']:>8.1f}ms {latency['p95']:>8.1f}ms "
+              f"{latency['p99']:>8.1f}ms {data['db_round_trips_per_request'] or 0:>7}  {data['status_codes']}")
+    for worker in report["memory"]["workers"]:
+        print(f"worker {worker['pid']}: rss={worker.get('rss_mb', '?')}MB peak={worker.get('peak_rss_mb', '?')}MB")
+
+
+def print_comparison(report: Dict[str, Any], baseline_path: str):
+    baseline = json.loads(Path(baseline_path).read_text())
+    print(f"\n🔁 Compared with {baseline_path} (commit {baseline.get('commit', '?')})")
+    for name, data in report["endpoints"].items():
+        old = baseline.get("endpoints", {}).get(name)
+        if not old:
+            continue
+        deltas = []
+        for pct in ("p50", "p95", "p99"):
+            before, after = old["latency_ms"][pct], data["latency_ms"][pct]
+            change = ((after - before) / before * 100) if before else 0
+            deltas.append(f"{pct} {before:.1f}→{after:.1f}ms ({change:+.1f}%)")
+        print(f"{name:<10} " + "  ".join(deltas))
+    before_rps, after_rps = baseline["overall"]["rps"], report["overall"]["rps"]
+    print(f"{'overall':<10} rps {before_rps}→{after_rps}")
+
+
+def serialization_payloads() -> Dict[str, Any]:
+    """Chat completions of growing size and admin listings with UUID/datetime/Decimal rows"""
+    from decimal import Decimal
+
+    payloads = {}
+    for chars in (1_000, 10_000, 100_000, 1_000_000):
+        payloads[f"chat {chars // 1000}k chars"] = {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": 1700000000,
+            "model": "grok-beta",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "x" * chars},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": chars // 4, "total_tokens": 100 + chars // 4},
+            "usage_info": {"tokens_used_today": 1234, "tokens_remaining_today": 98766, "plan_name": "High Max"},
+        }
+    for rows in (50, 500, 5000):
+        payloads[f"admin users x{rows}"] = {
+            "users": [{
+                "id": uuid.uuid4(),
+                "username": f"user_{i}",
+                "email": f"user_{i}@example.com",
+                "created_at": datetime(2024, 1, 1, 12, 0, i % 60, 123456),
+                "updated_at": datetime(2024, 6, 1, 8, 30, i % 60),
+                "plan_name": "Leveler",
+                "price": Decimal("4.00"),
+            } for i in range(rows)],
+            "pagination": {"limit": rows, "offset": 0, "has_more": True},
+        }
+    return payloads
+
+
+def time_per_call(func, min_seconds: float = 0.2) -> float:
+    """Mean seconds per call, repeating until the run is long enough to trust"""
+    func()
+    calls, started = 0, time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+
+def run_serialization_benchmark() -> Dict[str, Any]:
+    """Cost of FastAPI's default dict path versus FastJSONResponse, per response size"""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from app.core.json_response import FastJSONResponse, orjson
+
+    results = {}
+    for name, payload in serialization_payloads().items():
+        default_path = lambda: JSONResponse(jsonable_encoder(payload))
+        fast_path = lambda: FastJSONResponse(payload)
+        default_s, fast_s = time_per_call(default_path), time_per_call(fast_path)
+        results[name] = {
+            "bytes": len(fast_path().body),
+            "default_us": round(default_s * 1e6, 1),
+            "fast_us": round(fast_s * 1e6, 1),
+            "speedup": round(default_s / fast_s, 1),
+        }
+    return {"serializer": "orjson" if orjson is not None else "json", "payloads": results}
+
+
+def print_serialization_report(report: Dict[str, Any]):
+    print(f"\n🧮 Serialization cost per response ({report['serializer']})")
+    print(f"{'payload':<22} {'bytes':>10} {'jsonable_encoder+json':>22} {'FastJSONResponse':>17} {'speedup':>8}")
+    for name, data in report["payloads"].items():
+        print(f"{name:<22} {data['bytes']:>10} {data['default_us']:>20.1f}us {data['fast_us']:>15.1f}us "
+              f"{data['speedup']:>7}x")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="KnockXPrime AI hot path benchmark")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent client connections")
+    parser.add_argument("--requests", type=int, default=1000, help="Total measured requests")
+    parser.add_argument("--duration", type=float, default=0, help="Run for N seconds instead of a request count")
+    parser.add_argument("--warmup", type=int, default=50, help="Unmeasured requests before the run")
+    parser.add_argument("--calibrate", type=int, default=5, help="Serial requests per endpoint to count DB round trips")
+    parser.add_argument("--endpoint-mix", default="chat=0.6,usage=0.2,profile=0.15,login=0.05")
+    parser.add_argument("--plan-mix", default="Baby Free=0.4,Leveler=0.3,Log Min=0.2,High Max=0.1")
+    parser.add_argument("--users-per-plan", type=int, default=25)
+    parser.add_argument("--quota-scale", type=int, default=1000,
+                        help="Multiplier on plan limits so the run measures the full path, not 429s")
+    parser.add_argument("--db-latency-ms", type=float, default=5.0, help="Mean Neon stand-in latency")
+    parser.add_argument("--upstream-latency-ms", type=float, default=50.0, help="Mean Grok stand-in latency")
+    parser.add_argument("--prompt-chars", type=int, default=2000)
+    parser.add_argument("--completion-chars", type=int, default=2000)
+    parser.add_argument("--max-tokens", type=int, default=500)
+    parser.add_argument("--server-workers", type=int, default=0,
+                        help="Benchmark a local uvicorn with N workers instead of the in-process ASGI app")
+    parser.add_argument("--output", default=None, help="Report path (default: benchmark_results/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Baseline report to diff against")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--show-app-logs", action="store_true")
+    parser.add_argument("--serialization", action="store_true",
+                        help="Only measure response serialization cost per payload size")
+    args = parser.parse_args(argv)
+    unknown = set(parse_mix(args.endpoint_mix)) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"Unknown endpoints in --endpoint-mix: {', '.join(sorted(unknown))}")
+    unknown = set(parse_mix(args.plan_mix)) - {name for name, *_ in DEFAULT_PLANS}
+    if unknown:
+        parser.error(f"Unknown plans in --plan-mix: {', '.join(sorted(unknown))}")
+    return args
+
+
+async def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    print("🚀 KnockXPrime AI Benchmark")
+    print("=" * 50)
+
+    if args.serialization:
+        sys.path.insert(0, str(Path(__file__).parent))
+        print_serialization_report(run_serialization_benchmark())
+        return 0
+
+    state = StandInState(args.quota_scale)
+    standin_url = start_standins(state, args)
+    env = configure_environment(standin_url, args)
+    sys.path.insert(0, str(Path(__file__).parent))
+
+    if args.server_workers:
+        report = await run_against_server(state, env, args)
+    else:
+        report = await run_in_process(state, args)
+
+    commit = git_commit()
+    report = {
+        "benchmark": "knockxprime-hot-path",
+        "schema_version": 1,
+        "commit": commit,
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        **report,
+        "upstream": {"calls": state.upstream_calls},
+    }
+
+    output = Path(args.output or Path(__file__).parent / "benchmark_results" / f"{commit}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, default=str))
+
+    print_report(report)
+    if args.compare:
+        print_comparison(report, args.compare)
+    print(f"\n💾 Report written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import multiprocessing
 
 # Server socket
@@ -9,7 +11,7 @@ backlog = 2048
 workers = multiprocessing.cpu_count() * 2 + 1
 worker_class = "uvicorn.workers.UvicornWorker"
 worker_connections = 1000
-timeout = 30
+timeout = 30  # request deadlines (REQUEST_TIMEOUT_MAX) stay below this
 keepalive = 2
 
 # Restart workers after this many requests, to help prevent memory leaks
@@ -41,6 +43,26 @@ raw_env = [
     f"ENVIRONMENT={os.getenv('ENVIRONMENT', 'production')}",
 ]
 
+# Metrics: each worker writes snapshots to a shared directory that /metrics merges
+metrics_dir = os.getenv("METRICS_MULTIPROC_DIR") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    "knockxprime-metrics"
+)
+os.environ["METRICS_MULTIPROC_DIR"] = metrics_dir
+raw_env.append(f"METRICS_MULTIPROC_DIR={metrics_dir}")
+
+
+def on_starting(server):
+    # Drop snapshots left over from a previous master
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from app.core.metrics import archive_worker_snapshot
+    archive_worker_snapshot(worker.pid)
+
+
 # Preload app for better performance
 preload_app = True
 
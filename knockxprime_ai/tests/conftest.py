@@ -0,0 +1,16 @@
+"""
+Shared test setup
+
+Settings are read at import, so the test environment (strict query budgets
+among others) is set before any app module is imported.
+"""
+import os
+
+os.environ.setdefault("ENVIRONMENT", "test")
+
+import pytest
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.admission import AdmissionController, plan_priority
+
+pytestmark = pytest.mark.anyio
+
+
+def controller(**kwargs) -> AdmissionController:
+    options = dict(max_concurrency=1, max_queue=8, queue_timeout=5.0, target=0.01, interval=0.02)
+    options.update(kwargs)
+    return AdmissionController("test", **options)
+
+
+async def test_paid_plans_are_served_first():
+    admission = controller()
+    order = []
+
+    async def call(name, priority):
+        async with admission.slot(priority):
+            order.append(name)
+
+    holder = await admission.acquire(0.0)
+    tasks = [
+        asyncio.create_task(call("free", plan_priority({'price': '0.00'}))),
+        asyncio.create_task(call("pro", plan_priority({'price': '29.99'}))),
+    ]
+    await asyncio.sleep(0)
+    admission.release(holder, None)
+    await asyncio.gather(*tasks)
+    assert order == ["pro", "free"]
+
+
+async def test_queue_timeout_sheds_with_retry_after():
+    admission = controller(queue_timeout=0.02)
+    holder = await admission.acquire(0.0)
+    with pytest.raises(HTTPException) as shed:
+        await admission.acquire(0.0)
+    assert shed.value.status_code == 503
+    assert shed.value.detail["reason"] == "deadline"
+    assert int(shed.value.headers["Retry-After"]) >= 1
+    assert admission.queued == 0
+    admission.release(holder, None)
+
+
+async def test_full_queue_sheds_the_lowest_priority_waiter():
+    admission = controller(max_queue=1)
+    holder = await admission.acquire(0.0)
+    low = asyncio.create_task(admission.acquire(0.0))
+    await asyncio.sleep(0)
+
+    # An arrival that doesn't outrank the waiter is turned away
+    with pytest.raises(HTTPException) as shed:
+        await admission.acquire(0.0)
+    assert shed.value.detail["reason"] == "queue_full"
+
+    # One that does takes the waiter's place
+    high = asyncio.create_task(admission.acquire(-10.0))
+    await asyncio.sleep(0)
+    with pytest.raises(HTTPException) as displaced:
+        await low
+    assert displaced.value.detail["reason"] == "queue_full"
+
+    admission.release(holder, None)
+    admission.release(await high, None)
+    assert admission.active == 0
+    assert admission.queued == 0
+
+
+async def test_codel_sheds_arrivals_once_delay_stands_above_target():
+    admission = controller()
+    holder = await admission.acquire(0.0)
+    waiters = [asyncio.create_task(admission.acquire(0.0)) for _ in range(3)]
+    await asyncio.sleep(0.05)
+
+    # First grant above target starts the interval; one a full interval later starts shedding
+    admission.release(holder, None)
+    first = await waiters[0]
+    assert not admission.dropping
+    await asyncio.sleep(0.03)
+    admission.release(first, None)
+    second = await waiters[1]
+    assert admission.dropping
+
+    with pytest.raises(HTTPException) as shed:
+        await admission.acquire(0.0)
+    assert shed.value.status_code == 503
+    assert shed.value.detail["reason"] == "overload"
+
+    # A higher-priority arrival still gets in, in place of the last waiter
+    urgent = asyncio.create_task(admission.acquire(-10.0))
+    await asyncio.sleep(0)
+    with pytest.raises(HTTPException):
+        await waiters[2]
+
+    # Draining the queue ends the standing delay
+    admission.release(second, None)
+    admission.release(await urgent, None)
+    assert not admission.dropping
+    assert admission.active == 0
+
+
+async def test_cancelled_waiter_leaves_the_queue():
+    admission = controller()
+    holder = await admission.acquire(0.0)
+    waiter = asyncio.create_task(admission.acquire(0.0))
+    await asyncio.sleep(0)
+    assert admission.queued == 1
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert admission.queued == 0
+    admission.release(holder, None)
+    assert admission.active == 0
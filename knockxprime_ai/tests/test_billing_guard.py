@@ -0,0 +1,87 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from app.core.config import settings
+from app.core.usage_cache import usage_cache
+from app.schemas.chat_schema import ChatMessage, ChatRequest
+from app.services import chat_completion
+from app.services.billing_guard import BillingGuard, billing_guard
+
+pytestmark = pytest.mark.anyio
+
+# As loaded from Neon, which returns NUMERIC columns as text
+FREE_USER = {'id': "free-user", 'plan_name': "Baby Free", 'price': "0.00", 'max_concurrent': 0}
+PAID_USER = {'id': "paid-user", 'plan_name': "Pro", 'price': "29.99", 'max_concurrent': 0}
+
+
+def chat_request() -> ChatRequest:
+    return ChatRequest(messages=[ChatMessage(role="user", content="hello")], max_tokens=10)
+
+
+@pytest.fixture(autouse=True)
+def low_usage(monkeypatch):
+    """Both users far below their limits, as seen by a recent quota check"""
+    monkeypatch.setattr(settings, "speculative_execution_enabled", True)
+    for user in (FREE_USER, PAID_USER):
+        usage_cache.put(user['id'], date.today(), {
+            'requests': 1, 'tokens_used': 10, 'max_requests': 1000, 'max_tokens': 100000, 'plan_name': user['plan_name']
+        })
+    yield
+    for user in (FREE_USER, PAID_USER):
+        usage_cache.invalidate(user['id'])
+
+
+def test_paid_user_with_headroom_is_speculative():
+    assert billing_guard.has_headroom(PAID_USER, chat_request())
+
+
+def test_free_plan_with_text_price_is_never_speculative():
+    assert not billing_guard.has_headroom(FREE_USER, chat_request())
+    assert not billing_guard.has_headroom({**FREE_USER, 'price': None}, chat_request())
+
+
+def test_no_cached_usage_is_not_speculative():
+    usage_cache.invalidate(PAID_USER['id'])
+    assert not billing_guard.has_headroom(PAID_USER, chat_request())
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Record the order of quota check and Grok call in the completion path"""
+    order = []
+
+    async def validate_request(user, request):
+        order.append("check started")
+        await asyncio.sleep(0.01)
+        order.append("check done")
+        usage_info = {'current_tokens': 10, 'current_requests': 1, 'max_tokens': 100000,
+                      'max_requests': 1000, 'plan_name': user['plan_name']}
+        return {'estimated_tokens': 20, 'usage_info': usage_info}
+
+    async def chat_completion_call(request, priority):
+        order.append("grok")
+        return {'choices': [], 'usage': {'total_tokens': 15}}
+
+    async def log_usage(user_id, actual_tokens, plan_name="unknown", op_id=None):
+        order.append("usage logged")
+        return {'tokens_used': 25, 'requests': 2, 'max_tokens': 100000, 'max_requests': 1000, 'plan_name': plan_name}
+
+    monkeypatch.setattr(BillingGuard, "validate_request", staticmethod(validate_request))
+    monkeypatch.setattr(BillingGuard, "log_usage", staticmethod(log_usage))
+    monkeypatch.setattr(chat_completion.grok_service, "chat_completion", chat_completion_call)
+    monkeypatch.setattr(chat_completion.upstream_pool, "check", lambda: None)
+    return order
+
+
+async def test_free_plan_checks_quota_before_calling_grok(calls):
+    await chat_completion.run_chat_completion(FREE_USER, chat_request(), "op-free")
+    assert calls == ["check started", "check done", "grok", "usage logged"]
+
+
+async def test_paid_plan_calls_grok_alongside_the_check(calls):
+    _, usage_info = await chat_completion.run_chat_completion(PAID_USER, chat_request(), "op-paid")
+    await billing_guard.drain()
+    assert calls == ["check started", "grok", "check done", "usage logged"]
+    assert usage_info['tokens_used_today'] == 25
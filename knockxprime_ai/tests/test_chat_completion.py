@@ -0,0 +1,69 @@
+import pytest
+from fastapi import HTTPException
+
+from app.api.v1 import chat
+from app.schemas.chat_schema import ChatMessage, ChatRequest
+from app.services import chat_completion
+from app.services.billing_guard import BillingGuard
+from app.services.chat_passthrough import RawChatRequest
+
+pytestmark = pytest.mark.anyio
+
+USER = {'id': "user-1", 'plan_name': "Baby Free", 'price': "0.00", 'max_concurrent': 0}
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Grok answers with whatever the test sets; usage writes are recorded"""
+    state = {'response': None, 'logged': []}
+
+    async def validate_request(user, request):
+        usage_info = {'current_tokens': 0, 'current_requests': 0, 'max_tokens': 1000,
+                      'max_requests': 10, 'plan_name': user['plan_name']}
+        return {'estimated_tokens': 20, 'usage_info': usage_info}
+
+    async def log_usage(user_id, actual_tokens, plan_name="unknown", op_id=None):
+        state['logged'].append(op_id)
+        return {'tokens_used': actual_tokens, 'requests': 1, 'max_tokens': 1000, 'max_requests': 10,
+                'plan_name': plan_name}
+
+    async def chat_completion_call(request, priority):
+        return state['response']
+
+    async def chat_completion_raw(request, priority):
+        return state['response']
+
+    monkeypatch.setattr(BillingGuard, "validate_request", staticmethod(validate_request))
+    monkeypatch.setattr(BillingGuard, "log_usage", staticmethod(log_usage))
+    monkeypatch.setattr(chat_completion.grok_service, "chat_completion", chat_completion_call)
+    monkeypatch.setattr(chat_completion.grok_service, "chat_completion_raw", chat_completion_raw)
+    monkeypatch.setattr(chat_completion.upstream_pool, "check", lambda: None)
+    return state
+
+
+def parsed_request() -> ChatRequest:
+    return ChatRequest(messages=[ChatMessage(role="user", content="hello")])
+
+
+def raw_request() -> RawChatRequest:
+    return RawChatRequest(b'{"messages": [{"role": "user", "content": "hello"}]}')
+
+
+async def test_usage_info_is_added_to_the_response(upstream):
+    upstream['response'] = b'{"choices": [], "usage": {"total_tokens": 7}}'
+    response = await chat.complete_chat(USER, raw_request(), "op-1")
+    assert b'"usage_info":{"tokens_used_today":7' in response.body
+    assert upstream['logged'] == ["op-1"]
+
+
+@pytest.mark.parametrize("make_request, response", [
+    (raw_request, b'["not", "an", "object"]'),
+    (parsed_request, ["not", "an", "object"]),
+])
+async def test_non_object_response_is_a_500_and_not_billed(upstream, make_request, response):
+    upstream['response'] = response
+    with pytest.raises(HTTPException) as failed:
+        await chat.complete_chat(USER, make_request(), "op-1")
+    assert failed.value.status_code == 500
+    assert failed.value.detail == "Error processing chat request: Upstream response is not a JSON object"
+    assert upstream['logged'] == []
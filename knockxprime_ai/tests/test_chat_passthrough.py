@@ -0,0 +1,28 @@
+import pytest
+from fastapi.exceptions import RequestValidationError
+
+from app.services.chat_passthrough import RawChatRequest
+
+MESSAGE = b'{"role": "user", "content": "hi"}'
+
+
+def test_known_fields_are_forwarded_as_sent():
+    body = b'{"messages": [' + MESSAGE + b'], "model": "grok-beta", "max_tokens": 5, "temperature": 0, "stream": false}'
+    assert RawChatRequest(body).upstream_body() == body
+
+
+def test_missing_defaults_are_spliced_in():
+    upstream = RawChatRequest(b'{"messages": [' + MESSAGE + b']}').upstream_body()
+    assert upstream.startswith(b'{"model":"grok-beta","max_tokens":1000,"temperature":0.7,"stream":false,')
+
+
+@pytest.mark.parametrize("body, loc", [
+    (b'{"messages": [' + MESSAGE + b'], "top_p": 0.1}', ("body", "top_p")),
+    (b'{"messages": [{"role": "user", "content": "hi", "name": "x"}]}', ("body", "messages", 0, "name")),
+])
+def test_fields_the_parsed_path_drops_are_rejected(body, loc):
+    with pytest.raises(RequestValidationError) as rejected:
+        RawChatRequest(body)
+    error = rejected.value.errors()[0]
+    assert error["type"] == "extra_forbidden"
+    assert error["loc"] == loc
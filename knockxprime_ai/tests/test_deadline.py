@@ -0,0 +1,232 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.core import deadline
+from app.core.circuit_breaker import CLOSED, OPEN, CircuitBreaker
+from app.core.config import settings
+from app.middleware.deadline import CLIENT_CLOSED_REQUEST, DeadlineMiddleware
+from app.schemas.chat_schema import ChatMessage, ChatRequest
+from app.services import chat_completion
+from app.services.billing_guard import BillingGuard
+from app.services.chat_batch import ChatBatchRun
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def request_deadline():
+    """Run the test as if inside a request with a deadline the test sets"""
+    token = deadline.deadline_var.set(None)
+    yield lambda value: deadline.deadline_var.set(value)
+    deadline.deadline_var.reset(token)
+
+
+def test_header_sets_an_explicit_deadline_capped_at_the_maximum():
+    explicit = deadline.from_header("5")
+    assert explicit.explicit
+    assert explicit.remaining() == pytest.approx(5, abs=0.1)
+    assert deadline.from_header("3600").remaining() <= settings.request_timeout_max
+
+
+@pytest.mark.parametrize("value", [None, "", "soon", "0", "-1"])
+def test_unusable_header_falls_back_to_the_maximum(value):
+    fallback = deadline.from_header(value)
+    assert not fallback.explicit
+    assert fallback.remaining() == pytest.approx(settings.request_timeout_max, abs=0.1)
+
+
+def test_plan_default_narrows_only_implicit_deadlines(request_deadline, monkeypatch):
+    monkeypatch.setattr(settings, "request_timeout_default", 3)
+    request_deadline(deadline.from_header(None))
+    deadline.apply_plan("No Such Plan")
+    assert deadline.remaining() == pytest.approx(3, abs=0.1)
+
+    request_deadline(deadline.from_header("10"))
+    deadline.apply_plan("No Such Plan")
+    assert deadline.remaining() == pytest.approx(10, abs=0.1)
+
+
+def test_timeouts_shrink_to_the_time_left(request_deadline):
+    assert deadline.timeout(30) == 30
+    request_deadline(deadline.Deadline(2))
+    assert deadline.timeout(30) <= 2
+    request_deadline(deadline.Deadline(-1))
+    with pytest.raises(HTTPException) as exceeded:
+        deadline.timeout(30)
+    assert exceeded.value.status_code == 504
+    assert exceeded.value.detail["reason"] == "deadline_exceeded"
+
+
+async def test_bounded_cancels_work_past_the_deadline(request_deadline):
+    request_deadline(deadline.Deadline(0.05))
+    cancelled = False
+    with pytest.raises(HTTPException) as exceeded:
+        async with deadline.bounded():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+    assert cancelled
+    assert exceeded.value.status_code == 504
+
+
+class Client:
+    """ASGI receive/send for one request; disconnects when told to"""
+
+    def __init__(self):
+        self.sent = []
+        self.gone = asyncio.Event()
+        self.body_sent = False
+
+    async def receive(self):
+        if not self.body_sent:
+            self.body_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await self.gone.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+def scope(headers=()):
+    return {"type": "http", "method": "POST", "path": "/", "headers": list(headers)}
+
+
+async def test_handler_sees_the_request_deadline():
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(deadline.deadline_var.get())
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    client = Client()
+    await DeadlineMiddleware(app)(scope([(b"x-request-timeout", b"4")]), client.receive, client.send)
+    assert seen[0].explicit
+    assert seen[0].remaining() <= 4
+    assert client.sent[0]["status"] == 200
+    # The deadline is gone once the request is
+    assert deadline.deadline_var.get() is None
+
+
+async def test_disconnect_cancels_the_handler():
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def app(scope, receive, send):
+        await receive()
+        started.set()
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    client = Client()
+    request = asyncio.create_task(DeadlineMiddleware(app)(scope(), client.receive, client.send))
+    await started.wait()
+    client.gone.set()
+    await asyncio.wait_for(request, 1)
+    assert cancelled.is_set()
+    assert client.sent[0]["status"] == CLIENT_CLOSED_REQUEST
+
+
+async def test_disconnect_after_the_response_changes_nothing():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    client = Client()
+    client.gone.set()
+    await DeadlineMiddleware(app)(scope(), client.receive, client.send)
+    assert [message.get("status") for message in client.sent] == [200, None]
+
+
+def breaker(slow_call_seconds: float) -> CircuitBreaker:
+    return CircuitBreaker("test", window_seconds=10, min_calls=1, failure_rate=0.5,
+                          slow_call_seconds=slow_call_seconds, slow_call_rate=1.0, open_seconds=30,
+                          half_open_calls=1)
+
+
+async def hang_until_the_deadline(upstream: CircuitBreaker):
+    with pytest.raises(HTTPException):
+        async with deadline.bounded():
+            async with upstream.call():
+                await asyncio.sleep(5)
+
+
+async def test_call_cut_short_after_running_slow_trips_the_breaker(request_deadline):
+    upstream = breaker(slow_call_seconds=0.05)
+    request_deadline(deadline.Deadline(0.1))
+    await hang_until_the_deadline(upstream)
+    assert upstream.state == OPEN
+
+
+async def test_call_cut_short_by_a_tight_deadline_is_not_counted(request_deadline):
+    upstream = breaker(slow_call_seconds=1)
+    request_deadline(deadline.Deadline(0.05))
+    await hang_until_the_deadline(upstream)
+    assert upstream.state == CLOSED
+    assert upstream._window() == (0, 0, 0)
+
+
+USER = {'id': "user-1", 'plan_name': "Baby Free", 'price': "0.00", 'max_concurrent': 0}
+DAILY_USAGE = {'tokens_used': 7, 'requests': 1, 'max_tokens': 1000, 'max_requests': 10, 'plan_name': "Baby Free"}
+
+
+def chat_request() -> ChatRequest:
+    return ChatRequest(messages=[ChatMessage(role="user", content="hello")])
+
+
+@pytest.fixture
+def slow_grok(monkeypatch):
+    """Grok answers after the test's deadline; usage writes fail as Neon would once it passes"""
+    written = []
+
+    async def chat_completion_call(request, priority):
+        await asyncio.sleep(0.05)
+        return {'choices': [], 'usage': {'total_tokens': 7}}
+
+    async def validate_request(user, request):
+        usage_info = {'current_tokens': 0, 'current_requests': 0, 'max_tokens': 1000,
+                      'max_requests': 10, 'plan_name': user['plan_name']}
+        return {'estimated_tokens': 20, 'usage_info': usage_info}
+
+    async def log_usage(user_id, actual_tokens, plan_name="unknown", op_id=None):
+        deadline.check()
+        written.append(actual_tokens)
+        return DAILY_USAGE
+
+    async def settle_batch(user, reservation, tokens_used, requests_made, op_id=None):
+        deadline.check()
+        written.append(tokens_used)
+        return DAILY_USAGE
+
+    monkeypatch.setattr(chat_completion.grok_service, "chat_completion", chat_completion_call)
+    monkeypatch.setattr(chat_completion.upstream_pool, "check", lambda: None)
+    monkeypatch.setattr(BillingGuard, "validate_request", staticmethod(validate_request))
+    monkeypatch.setattr(BillingGuard, "log_usage", staticmethod(log_usage))
+    monkeypatch.setattr(BillingGuard, "settle_batch", staticmethod(settle_batch))
+    return written
+
+
+async def test_completion_past_the_deadline_is_billed_and_returned(request_deadline, slow_grok):
+    request_deadline(deadline.Deadline(0.01))
+    response, usage_info = await chat_completion.run_chat_completion(USER, chat_request(), "op-1")
+    assert response['usage'] == {'total_tokens': 7}
+    assert usage_info['tokens_used_today'] == 7
+    assert slow_grok == [7]
+
+
+async def test_batch_past_a_client_deadline_is_settled(request_deadline, slow_grok):
+    request_deadline(deadline.Deadline(0.01, explicit=True))
+    reservation = {'reserved_tokens': 20, 'reserved_requests': 1, 'estimates': [20]}
+    run = ChatBatchRun(USER, [chat_request()], reservation, 1, lambda: None).start()
+    await run.task
+    assert b'"tokens_billed":7' in run.lines[-1]
+    assert b'"usage_info":{' in run.lines[-1]
+    assert slow_grok == [7]
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Response
+
+from app.core import idempotency
+from app.core.idempotency import IdempotencyStore
+
+pytestmark = pytest.mark.anyio
+
+FINGERPRINT = idempotency.fingerprint(b"completions", b'{"messages": []}')
+OTHER_FINGERPRINT = idempotency.fingerprint(b"completions", b'{"messages": [1]}')
+
+
+class Handler:
+    """Counts runs; each run waits for release and returns the given response"""
+
+    def __init__(self, response: Response = None):
+        self.runs = 0
+        self.release = asyncio.Event()
+        self.response = response or Response(b'{"ok": true}', media_type="application/json")
+
+    async def __call__(self) -> Response:
+        self.runs += 1
+        await self.release.wait()
+        return self.response
+
+
+def store(**kwargs) -> IdempotencyStore:
+    options = dict(ttl=60, max_entries=16, max_body_bytes=1024)
+    options.update(kwargs)
+    return IdempotencyStore(**options)
+
+
+def test_op_id_is_stable_per_user_and_key():
+    assert idempotency.op_id("user-1", "key") == idempotency.op_id("user-1", "key")
+    assert idempotency.op_id("user-1", "key") != idempotency.op_id("user-2", "key")
+
+
+def test_key_length_is_checked():
+    idempotency.check_key("k" * idempotency.MAX_KEY_LENGTH)
+    with pytest.raises(HTTPException) as rejected:
+        idempotency.check_key("k" * (idempotency.MAX_KEY_LENGTH + 1))
+    assert rejected.value.status_code == 400
+
+
+async def test_duplicate_in_flight_attaches_to_the_first_call():
+    keys = store()
+    handler = Handler()
+    first = asyncio.create_task(keys.call("user-1", "key", FINGERPRINT, handler))
+    duplicate = asyncio.create_task(keys.call("user-1", "key", FINGERPRINT, handler))
+    await asyncio.sleep(0)
+    handler.release.set()
+    first, duplicate = await asyncio.gather(first, duplicate)
+    assert handler.runs == 1
+    assert idempotency.REPLAYED_HEADER.lower() not in first.headers
+    assert duplicate.headers[idempotency.REPLAYED_HEADER] == "true"
+    assert duplicate.body == first.body
+
+
+async def test_finished_call_is_replayed():
+    keys = store()
+    handler = Handler()
+    handler.release.set()
+    await keys.call("user-1", "key", FINGERPRINT, handler)
+    replay = await keys.call("user-1", "key", FINGERPRINT, handler)
+    assert handler.runs == 1
+    assert replay.headers[idempotency.REPLAYED_HEADER] == "true"
+    assert replay.body == b'{"ok": true}'
+
+
+async def test_keys_are_per_user():
+    keys = store()
+    handler = Handler()
+    handler.release.set()
+    await keys.call("user-1", "key", FINGERPRINT, handler)
+    await keys.call("user-2", "key", FINGERPRINT, handler)
+    assert handler.runs == 2
+
+
+async def test_key_reused_for_another_request_is_422():
+    keys = store()
+    handler = Handler()
+    running = asyncio.create_task(keys.call("user-1", "key", FINGERPRINT, handler))
+    await asyncio.sleep(0)
+    with pytest.raises(HTTPException) as while_running:
+        await keys.call("user-1", "key", OTHER_FINGERPRINT, handler)
+    handler.release.set()
+    await running
+    with pytest.raises(HTTPException) as once_done:
+        await keys.call("user-1", "key", OTHER_FINGERPRINT, handler)
+    assert while_running.value.status_code == once_done.value.status_code == 422
+    assert handler.runs == 1
+
+
+async def test_failed_call_forgets_the_key():
+    keys = store()
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise HTTPException(status_code=503, detail="upstream down")
+        return Response(b"{}", media_type="application/json")
+
+    with pytest.raises(HTTPException):
+        await keys.call("user-1", "key", FINGERPRINT, flaky)
+    response = await keys.call("user-1", "key", FINGERPRINT, flaky)
+    assert response.status_code == 200
+    assert len(attempts) == 2
+
+
+async def test_errors_and_large_bodies_are_not_stored():
+    keys = store(max_body_bytes=8)
+    for key, response in (("error", Response(b"{}", status_code=500)), ("large", Response(b"x" * 9))):
+        handler = Handler(response)
+        handler.release.set()
+        await keys.call("user-1", key, FINGERPRINT, handler)
+        await keys.call("user-1", key, FINGERPRINT, handler)
+        assert handler.runs == 2
+
+
+async def test_call_outlives_a_client_that_goes_away():
+    keys = store()
+    handler = Handler()
+    client = asyncio.create_task(keys.call("user-1", "key", FINGERPRINT, handler))
+    await asyncio.sleep(0)
+    client.cancel()
+    await asyncio.gather(client, return_exceptions=True)
+
+    # The retry attaches to the call still running instead of starting another
+    retry = asyncio.create_task(keys.call("user-1", "key", FINGERPRINT, handler))
+    await asyncio.sleep(0)
+    handler.release.set()
+    response = await retry
+    assert handler.runs == 1
+    assert response.headers[idempotency.REPLAYED_HEADER] == "true"
@@ -0,0 +1,110 @@
+import multiprocessing
+
+import pytest
+from fastapi import HTTPException
+
+from app.core import inflight
+from app.core.inflight import InFlightTable, UserInFlightLimiter, _user_key
+
+pytestmark = pytest.mark.anyio
+
+fork = multiprocessing.get_context("fork")
+
+
+def hold_in_child(table: InFlightTable, key: int, limit: int, held, done):
+    """Claim an entry from another process; keep it until done is set, or die holding it"""
+    held.send(table.try_acquire(key, limit))
+    if done is not None:
+        done.wait(5)
+
+
+def acquire_in_child(table: InFlightTable, key: int, limit: int, done=None):
+    receiver, sender = fork.Pipe(duplex=False)
+    child = fork.Process(target=hold_in_child, args=(table, key, limit, sender, done))
+    child.start()
+    index = receiver.recv()
+    if done is None:
+        child.join()
+    return index, child
+
+
+def test_limit_per_user():
+    table = InFlightTable(16)
+    alice, bob = _user_key("alice"), _user_key("bob")
+    first = table.try_acquire(alice, 2)
+    second = table.try_acquire(alice, 2)
+    assert first is not None and second is not None and first != second
+    assert table.try_acquire(alice, 2) is None
+    # Other users are unaffected
+    assert table.try_acquire(bob, 2) is not None
+    table.release(first)
+    assert table.try_acquire(alice, 2) is not None
+
+
+def test_entries_are_shared_between_processes():
+    table = InFlightTable(16)
+    key = _user_key("alice")
+    done = fork.Event()
+    index, child = acquire_in_child(table, key, 1, done)
+    try:
+        assert index is not None
+        assert table.try_acquire(key, 1) is None
+    finally:
+        done.set()
+        child.join()
+
+
+def test_entries_of_dead_workers_are_ignored():
+    table = InFlightTable(16)
+    key = _user_key("alice")
+    index, _ = acquire_in_child(table, key, 1)
+    assert index is not None
+    assert table.try_acquire(key, 1) is not None
+
+
+def test_claims_check_no_owners_below_the_limit(monkeypatch):
+    def pid_alive(pid):
+        raise AssertionError("owner checked on the fast path")
+
+    monkeypatch.setattr(inflight, "_pid_alive", pid_alive)
+    table = InFlightTable(4096)
+    key = _user_key("alice")
+    indexes = [table.try_acquire(key, 3) for _ in range(3)]
+    # Entries stay within the probe window of the key's home slot
+    assert all((index - key % table.size) % table.size < table.probe for index in indexes)
+
+
+def test_full_window_clears_entries_of_dead_workers():
+    table = InFlightTable(2)
+    index, _ = acquire_in_child(table, _user_key("a"), 1)
+    assert index is not None
+    assert table.try_acquire(_user_key("b"), 1) is not None
+    assert table.try_acquire(_user_key("c"), 1) == index
+
+
+def test_full_table_fails_open():
+    table = InFlightTable(2)
+    assert table.try_acquire(_user_key("a"), 1) is not None
+    assert table.try_acquire(_user_key("b"), 1) is not None
+    assert table.try_acquire(_user_key("c"), 1) == -1
+    table.release(-1)
+
+
+async def test_limiter_answers_429_after_waiting():
+    limiter = UserInFlightLimiter(16, default_limit=1, wait=0.05)
+    user = {'id': "alice", 'plan_name': "Baby Free", 'max_concurrent': 1}
+    async with limiter.hold(user):
+        with pytest.raises(HTTPException) as rejected:
+            async with limiter.hold(user):
+                pass
+    assert rejected.value.status_code == 429
+    assert rejected.value.headers["X-Concurrency-Limit"] == "1"
+    assert rejected.value.detail["upgrade_required"] is True
+    # Released on exit, even after the failed attempt
+    async with limiter.hold(user):
+        pass
+
+
+async def test_unlimited_plans_skip_the_table():
+    limiter = UserInFlightLimiter(1, default_limit=0, wait=0.01)
+    assert await limiter.acquire({'id': "alice"}) == -1
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from app.core.job_store import QUEUED, JobStore
+from app.services import job_runner
+from app.services.billing_guard import BillingGuard
+from app.services.job_runner import JobRunner
+
+pytestmark = pytest.mark.anyio
+
+USER = {'id': "user-1", 'plan_name': "Pro", 'price': "29.99", 'max_concurrent': 1}
+
+
+@pytest.fixture
+def grok(monkeypatch):
+    """Grok calls hang until cancelled; reservations are recorded as they settle"""
+    state = {'called': asyncio.Event(), 'settled': []}
+
+    async def get_user_by_id(user_id):
+        return USER
+
+    async def chat_completion(request, priority):
+        state['called'].set()
+        await asyncio.Event().wait()
+
+    async def reserve_batch(user, chat_requests, op_id=None):
+        return {'reserved_tokens': 20 * len(chat_requests), 'reserved_requests': len(chat_requests),
+                'estimates': [20] * len(chat_requests)}
+
+    async def settle_batch(user, reservation, tokens_used, requests_made, op_id=None):
+        # Slower than the cancellation that starts it
+        await asyncio.sleep(0.05)
+        state['settled'].append((reservation['reserved_tokens'], tokens_used, requests_made))
+
+    monkeypatch.setattr(job_runner, "get_user_by_id", get_user_by_id)
+    monkeypatch.setattr(job_runner.grok_service, "chat_completion", chat_completion)
+    monkeypatch.setattr(BillingGuard, "reserve_batch", staticmethod(reserve_batch))
+    monkeypatch.setattr(BillingGuard, "settle_batch", staticmethod(settle_batch))
+    return state
+
+
+async def test_stop_with_every_slot_busy_claims_nothing_more(tmp_path, grok):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    first = await store.submit(USER['id'], 0, [{'messages': [{'role': "user", 'content': "hi"}]}])
+    second = await store.submit(USER['id'], 1, [{'messages': [{'role': "user", 'content': "hi"}]}])
+    runner = JobRunner(store, concurrency=1, poll_interval=0.01)
+    running = asyncio.create_task(runner.run())
+    await asyncio.wait_for(grok['called'].wait(), 2)
+
+    runner.stop()
+    await asyncio.wait_for(running, 2)
+    assert (await store.get(first['id']))['status'] == QUEUED
+    assert (await store.get(second['id']))['started_at'] is None
+
+
+async def test_chunk_cut_short_is_refunded_before_run_returns(tmp_path, grok):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    await store.submit(USER['id'], 0, [{'messages': [{'role': "user", 'content': "hi"}]}])
+    runner = JobRunner(store, concurrency=1, poll_interval=0.01)
+    running = asyncio.create_task(runner.run())
+    await asyncio.wait_for(grok['called'].wait(), 2)
+
+    runner.stop()
+    await asyncio.wait_for(running, 2)
+    assert grok['settled'] == [(20, 0, 0)]
+    assert not runner.settling
@@ -0,0 +1,34 @@
+import uuid
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import pytest
+
+from app.core import database
+from app.core.database import db
+from app.core.neon_utils import convert_params_for_neon
+
+pytestmark = pytest.mark.anyio
+
+
+def test_values_are_sent_in_postgres_input_syntax():
+    user_id = uuid.uuid4()
+    assert convert_params_for_neon((
+        None, True, False, 5, 0.5, Decimal("29.99"), "text", user_id,
+        date(2026, 1, 2), datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc), {"a": [1]}
+    )) == [
+        None, "true", "false", "5", "0.5", "29.99", "text", str(user_id),
+        "2026-01-02", "2026-01-02T03:04:05+00:00", '{"a": [1]}'
+    ]
+
+
+async def test_queries_send_converted_params(monkeypatch):
+    sent = []
+
+    async def execute_with_retry(query, params, idempotent):
+        sent.append(params)
+        return {"rows": [], "fields": [], "rowCount": 1}
+
+    monkeypatch.setattr(database, "execute_with_retry", execute_with_retry)
+    await db.execute("UPDATE daily_usage SET active = $1 WHERE day = $2 AND note = $3", False, date(2026, 1, 2), None)
+    assert sent == [["false", "2026-01-02", None]]
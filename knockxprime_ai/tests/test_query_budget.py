@@ -0,0 +1,115 @@
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from app.core import database
+from app.core.config import settings
+from app.core.database import QueryBudgetExceeded, QueryTracker, db, query_budget
+from app.middleware.logging import RequestLoggingMiddleware
+
+pytestmark = pytest.mark.anyio
+
+
+def tracker_for(endpoint) -> QueryTracker:
+    return QueryTracker({"endpoint": endpoint})
+
+
+def test_test_environment_is_strict():
+    assert settings.db_query_budget_mode == "strict"
+
+
+def test_within_budget():
+    @query_budget(2)
+    async def endpoint():
+        pass
+
+    tracker = tracker_for(endpoint)
+    tracker.record("SELECT 1", 0.001)
+    tracker.record("SELECT 2", 0.002)
+    assert tracker.queries == 2
+    assert not tracker.over_budget
+
+
+def test_strict_mode_fails_the_query_past_the_budget():
+    @query_budget(1)
+    async def endpoint():
+        pass
+
+    tracker = tracker_for(endpoint)
+    tracker.record("SELECT 1", 0.001)
+    with pytest.raises(QueryBudgetExceeded, match="Query budget of 1 exceeded"):
+        tracker.record("SELECT  *\n FROM users", 0.001)
+
+
+def test_warn_mode_only_flags(monkeypatch):
+    monkeypatch.setattr(settings, "db_query_budget_mode", "warn")
+
+    @query_budget(1)
+    async def endpoint():
+        pass
+
+    tracker = tracker_for(endpoint)
+    tracker.record("SELECT 1", 0.001)
+    tracker.record("SELECT 1", 0.001)
+    assert tracker.over_budget
+
+
+def test_no_budget_before_routing():
+    tracker = QueryTracker({})
+    for _ in range(10):
+        tracker.record("SELECT 1", 0.001)
+    assert tracker.budget is None
+    assert not tracker.over_budget
+
+
+def test_repeated_statements_are_grouped(monkeypatch):
+    monkeypatch.setattr(settings, "db_repeated_query_threshold", 3)
+    tracker = QueryTracker()
+    for _ in range(3):
+        tracker.record("SELECT *  FROM plans\n WHERE id = $1", 0.001)
+    tracker.record("SELECT 1", 0.001)
+    assert tracker.repeated_statements() == [{"statement": "SELECT * FROM plans WHERE id = $1", "count": 3}]
+
+
+def budget_app(budget: int, queries: int) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(RequestLoggingMiddleware)
+
+    @app.get("/items")
+    @query_budget(budget)
+    async def items():
+        for index in range(queries):
+            await db.execute_query("UPDATE items SET seen = $1", [index])
+        return {"ok": True}
+
+    return app
+
+
+@pytest.fixture
+def fake_neon(monkeypatch):
+    calls = []
+
+    async def execute_with_retry(query, params, idempotent):
+        calls.append(query)
+        return {"rows": [], "fields": [], "rowCount": 1}
+
+    monkeypatch.setattr(database, "execute_with_retry", execute_with_retry)
+    return calls
+
+
+async def test_endpoint_within_budget_reports_its_queries(fake_neon):
+    transport = httpx.ASGITransport(app=budget_app(budget=2, queries=2))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/items")
+    assert response.status_code == 200
+    assert 'desc="2 queries"' in response.headers["server-timing"]
+    assert len(fake_neon) == 2
+
+
+async def test_endpoint_over_budget_fails_in_strict_mode(fake_neon):
+    transport = httpx.ASGITransport(app=budget_app(budget=1, queries=3))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        with pytest.raises(QueryBudgetExceeded):
+            await client.get("/items")
+    # The query over budget reached Neon; the one after it never ran
+    assert len(fake_neon) == 2
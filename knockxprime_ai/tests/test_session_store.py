@@ -0,0 +1,180 @@
+import asyncio
+import base64
+import copy
+import json
+import os
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+from app.api.v1 import sessions
+from app.core import session_store
+from app.core.json_response import dumps
+from app.core.session_store import SessionStore, decode_turn, encode_turn
+from app.schemas.chat_schema import ChatSessionMessage
+
+pytestmark = pytest.mark.anyio
+
+
+def stored_size(turn) -> int:
+    return len(dumps(turn))
+
+
+def test_short_turns_are_stored_plain():
+    turn = [("user", "hi"), ("assistant", "hello")]
+    assert encode_turn(turn) == [["user", "hi"], ["assistant", "hello"]]
+
+
+def test_compressible_turns_are_stored_compressed():
+    turn = [("user", "tell me more " * 100), ("assistant", "and more " * 100)]
+    encoded = encode_turn(turn)
+    assert isinstance(encoded, str) and encoded.startswith("z:")
+    assert stored_size(encoded) < stored_size([list(message) for message in turn])
+    assert decode_turn(encoded) == turn
+
+
+def test_turns_that_compress_poorly_are_not_stored_larger():
+    # Random base64 shrinks by about a fifth, less than the third base64 adds back when stored
+    text = base64.b64encode(os.urandom(600)).decode()
+    turn = [("user", text), ("assistant", text[::-1])]
+    encoded = encode_turn(turn)
+    assert encoded == [list(message) for message in turn]
+    assert decode_turn(encoded) == turn
+
+
+class FakeSessions:
+    """The sessions table, as the store's statements see it"""
+
+    def __init__(self):
+        self.rows = {}
+        self.writes = 0
+        self.loads = 0
+
+    def _stamp(self):
+        self.writes += 1
+        return f"2026-01-01T00:00:{self.writes:02d}"
+
+    async def fetchrow(self, query, *args, idempotent=False):
+        if query is session_store.CREATE_SESSION:
+            session_id = str(uuid.uuid4())
+            self.rows[session_id] = {"user_id": args[0], "data": json.loads(args[1]), "updated_at": self._stamp()}
+            return {"id": session_id, "updated_at": self.rows[session_id]["updated_at"]}
+        row = self.rows.get(args[0])
+        if row is None or row["user_id"] != args[1]:
+            return None
+        if query is session_store.LOAD_SESSION:
+            self.loads += 1
+            return {"id": args[0], "session_data": copy.deepcopy(row["data"]), "updated_at": row["updated_at"]}
+        if query is session_store.CHECK_SESSION:
+            return {"updated_at": row["updated_at"]}
+        if query is session_store.APPEND_TURN:
+            if row["data"].get("op") != args[3]:
+                row["data"]["turns"] += json.loads(args[2])
+                row["data"]["op"] = args[3]
+            row["updated_at"] = self._stamp()
+            return {"turns": len(row["data"]["turns"]), "updated_at": row["updated_at"]}
+        raise AssertionError(f"unexpected statement: {query}")
+
+    async def execute(self, query, *args, idempotent=False):
+        assert query is session_store.DELETE_SESSION
+        # A retried DELETE finds 0 rows and would report the session as missing
+        assert not idempotent
+        row = self.rows.get(args[0])
+        if row is None or row["user_id"] != args[1]:
+            return 0
+        del self.rows[args[0]]
+        return 1
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeSessions()
+    monkeypatch.setattr(session_store.db, "fetchrow", table.fetchrow)
+    monkeypatch.setattr(session_store.db, "execute", table.execute)
+    return table
+
+
+def worker() -> SessionStore:
+    return SessionStore(ttl=60, max_entries=16)
+
+
+async def test_cached_session_is_served_without_reloading(table):
+    store = worker()
+    created = await store.create("alice", None, None, None, None, [("user", "hi")])
+    assert await store.get("alice", created.id) is created
+    assert table.loads == 0
+    assert await store.get("bob", created.id) is None
+
+
+async def test_session_deleted_by_another_worker_is_gone(table):
+    first, second = worker(), worker()
+    created = await first.create("alice", None, None, None, None, [])
+    assert await second.delete("alice", created.id)
+    assert await first.get("alice", created.id) is None
+    assert created.id not in first._hot
+
+
+async def test_session_appended_by_another_worker_is_reloaded(table):
+    first, second = worker(), worker()
+    created = await first.create("alice", None, None, None, None, [])
+    other = await second.get("alice", created.id)
+    assert await second.append(other, [("user", "hi"), ("assistant", "hello")], "op-1")
+
+    current = await first.get("alice", created.id)
+    assert current is not created
+    assert current.messages == [("user", "hi"), ("assistant", "hello")]
+
+
+async def test_delete_reports_whether_the_session_existed(table):
+    store = worker()
+    created = await store.create("alice", None, None, None, None, [])
+    assert not await store.delete("bob", created.id)
+    assert await store.delete("alice", created.id)
+    assert not await store.delete("alice", created.id)
+
+
+@pytest.fixture
+def uncached(table, monkeypatch):
+    """Turns against a store whose cache is off; Grok replies after a moment"""
+    store = SessionStore(ttl=0, max_entries=16)
+    monkeypatch.setattr(sessions, "session_store", store)
+    state = {'store': store, 'seen': [], 'response': None}
+
+    async def run_chat_completion(user, request, op_id):
+        state['seen'].append([message.content for message in request.messages])
+        await asyncio.sleep(0.01)
+        response = state['response'] or {'choices': [{'message': {'role': "assistant", 'content': f"re {op_id}"}}]}
+        return response, {}
+
+    monkeypatch.setattr(sessions, "run_chat_completion", run_chat_completion)
+    return state
+
+
+async def test_turns_are_serialized_without_the_cache(uncached):
+    store = uncached['store']
+    created = await store.create("alice", None, None, None, None, [])
+    first, second = await store.get("alice", created.id), await store.get("alice", created.id)
+    assert first is not second
+
+    await asyncio.gather(
+        sessions.run_turn({'id': "alice"}, first, ChatSessionMessage(content="one"), "op-1"),
+        sessions.run_turn({'id': "alice"}, second, ChatSessionMessage(content="two"), "op-2"),
+    )
+    assert uncached['seen'] == [["one"], ["one", "re op-1", "two"]]
+    assert not store._locks
+
+
+@pytest.mark.parametrize("response", [
+    {'choices': []},
+    {'choices': ["text"]},
+    {'choices': [{'message': "text"}]},
+    {'choices': [{'message': {'content': ["text"]}}]},
+])
+async def test_reply_that_cannot_be_stored_is_a_500(uncached, table, response):
+    uncached['response'] = response
+    created = await uncached['store'].create("alice", None, None, None, None, [])
+    with pytest.raises(HTTPException) as failed:
+        await sessions.run_turn({'id': "alice"}, created, ChatSessionMessage(content="hi"), "op-1")
+    assert failed.value.status_code == 500
+    assert table.rows[created.id]["data"]["turns"] == []
@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.core import deadline
+from app.core.singleflight import SingleFlight
+from app.schemas.chat_schema import ChatMessage, ChatRequest
+
+pytestmark = pytest.mark.anyio
+
+
+class Upstream:
+    """Counts calls and holds each one open until released"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return self.calls
+
+
+async def test_concurrent_callers_share_one_call():
+    group = SingleFlight("test")
+    upstream = Upstream()
+    callers = [asyncio.create_task(group.do("key", upstream)) for _ in range(3)]
+    await asyncio.sleep(0)
+    upstream.release.set()
+    results = await asyncio.gather(*callers)
+    assert upstream.calls == 1
+    assert [result for result, _ in results] == [1, 1, 1]
+    assert [shared for _, shared in results] == [False, True, True]
+    assert len(group) == 0
+
+
+async def test_exceptions_reach_every_caller():
+    group = SingleFlight("test")
+
+    async def failing():
+        await asyncio.sleep(0)
+        raise ValueError("upstream failed")
+
+    results = await asyncio.gather(group.do("key", failing), group.do("key", failing), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+async def test_one_caller_leaving_does_not_cancel_the_others():
+    group = SingleFlight("test")
+    upstream = Upstream()
+    leaving = asyncio.create_task(group.do("key", upstream))
+    staying = asyncio.create_task(group.do("key", upstream))
+    await asyncio.sleep(0)
+    leaving.cancel()
+    await asyncio.gather(leaving, return_exceptions=True)
+    upstream.release.set()
+    assert await staying == (1, True)
+    assert upstream.cancelled == 0
+
+
+async def test_call_is_cancelled_when_every_caller_leaves():
+    group = SingleFlight("test")
+    upstream = Upstream()
+    callers = [asyncio.create_task(group.do("key", upstream)) for _ in range(2)]
+    await asyncio.sleep(0)
+    for caller in callers:
+        caller.cancel()
+    await asyncio.gather(*callers, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert upstream.cancelled == 1
+    assert len(group) == 0
+
+
+async def test_stale_call_is_not_joined():
+    group = SingleFlight("test")
+    upstream = Upstream()
+    old = asyncio.create_task(group.do("key", upstream, version=1))
+    await asyncio.sleep(0)
+    # Issued after a write at version 2: it must not see a read started before it
+    fresh = asyncio.create_task(group.do("key", upstream, version=2, min_version=2))
+    await asyncio.sleep(0)
+    upstream.release.set()
+    assert (await old)[1] is False
+    assert (await fresh)[1] is False
+    assert upstream.calls == 2
+
+
+@pytest.fixture
+def grok(monkeypatch):
+    """GrokService with an upstream that answers after a short delay and counts its calls"""
+    from app.services.grok_service import GrokService
+
+    service = GrokService()
+    sent = []
+
+    async def send(content, request, estimated_tokens):
+        sent.append(deadline.deadline_var.get())
+        await asyncio.sleep(0.1)
+        return b'{"choices": []}'
+
+    monkeypatch.setattr(service.pool, "check", lambda: None)
+    monkeypatch.setattr(service.pool, "send", send)
+    return service, sent
+
+
+def deterministic_request():
+    return ChatRequest(messages=[ChatMessage(role="user", content="hi")], temperature=0)
+
+
+async def call_with_deadline(service, seconds, priority=0.0):
+    token = deadline.deadline_var.set(deadline.Deadline(seconds))
+    try:
+        return await service.chat_completion(deterministic_request(), priority)
+    finally:
+        deadline.deadline_var.reset(token)
+
+
+async def test_shared_call_outlives_the_first_callers_deadline(grok):
+    service, sent = grok
+    short = asyncio.create_task(call_with_deadline(service, 0.03))
+    await asyncio.sleep(0)
+    long = asyncio.create_task(call_with_deadline(service, 5))
+    with pytest.raises(HTTPException) as exceeded:
+        await short
+    assert exceeded.value.status_code == 504
+    assert await long == {"choices": []}
+    # One upstream call, made without any one caller's deadline
+    assert sent == [None]
+
+
+async def test_callers_of_different_priority_do_not_share(grok):
+    service, sent = grok
+    await asyncio.gather(call_with_deadline(service, 5, 0.0), call_with_deadline(service, 5, -29.99))
+    assert len(sent) == 2